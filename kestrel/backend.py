@@ -1,12 +1,277 @@
 import logging
+import time
+
+from redis.exceptions import NoScriptError, WatchError
+
+from kestrel.metrics import bucket
+from kestrel.scripts import SCRIPTS
+
 
 log = logging.getLogger(__name__)
 
 
+# The most tasks an automatically sized bundle may hold.
+BUNDLE_LIMIT = 100
+
+# The number of bits of a claimed bitmap read by each BITFIELD GET,
+# the most an unsigned field may have.
+BITFIELD_WIDTH = 63
+
+
+def canonical(requirements):
+    """
+    Return the sorted, upper cased list of requirement names with
+    blank entries removed.
+    """
+    return sorted(set([req.strip().upper() for req in requirements
+                       if req and req.strip()]))
+
+
+def signature(requirements):
+    """
+    Return the canonical signature string for a set of requirements.
+
+    Every job with the same requirement set shares one signature, so
+    matching work scales with the number of distinct signatures instead
+    of the number of jobs.
+    """
+    return ','.join(canonical(requirements))
+
+
+def signature_requirements(sig):
+    """Return the set of requirements encoded in a signature."""
+    if not sig:
+        return set()
+    return set(sig.split(','))
+
+
+def job_rank(job, priority=0):
+    """
+    Return the position of a job in its owner's run queue. Jobs with
+    a higher priority come first, and jobs with the same priority are
+    taken in the order they were submitted.
+    """
+    return -int(priority or 0) * 2 ** 32 + int(job)
+
+
+def bundle_size(bundle, seconds, tasks, target):
+    """
+    Return the number of tasks of a job to hand to a worker slot at
+    once.
+
+    Arguments:
+        bundle  -- The job's bundle setting. A positive number is used
+                   as is, 0 sizes bundles automatically and None means
+                   no bundling.
+        seconds -- The total observed run time of the job's tasks.
+        tasks   -- The number of tasks the run time was observed over.
+        target  -- The number of seconds an automatically sized
+                   bundle should take to run.
+    """
+    if bundle is None or int(bundle) > 0:
+        return int(bundle or 1)
+    tasks = int(tasks or 0)
+    if not tasks:
+        return 1
+    average = float(seconds) / tasks
+    if average <= 0:
+        return BUNDLE_LIMIT
+    return max(1, min(BUNDLE_LIMIT, int(target / average)))
+
+
+def task_seconds(tasks, resources, started):
+    """
+    Return the time a worker took to run finished tasks, using the
+    times the worker measured when it reported them for every task,
+    and the time since the tasks were handed out otherwise.
+
+    Arguments:
+        tasks     -- The list of finished tasks.
+        resources -- A dictionary of the resources each task used.
+        started   -- The time the tasks were handed to the worker.
+    """
+    if resources and all('wall' in resources.get(task, {})
+                         for task in tasks):
+        return sum(resources[task]['wall'] +
+                   resources[task].get('cleanup', 0.0)
+                   for task in tasks)
+    return time.time() - started
+
+
+def resource_counts(used):
+    """
+    Return what one task's resources add to its job's totals, and
+    the wall time and memory histogram buckets it falls in.
+
+    Arguments:
+        used -- The resources of the task, as reported by the worker.
+    """
+    counts = {'tasks': 1}
+    for field in ('wall', 'utime', 'stime', 'cleanup', 'maxrss'):
+        if field in used:
+            counts[field] = used[field]
+    if used.get('exit'):
+        counts['failed'] = 1
+    if used.get('timeout'):
+        counts['timeouts'] = 1
+    wall = maxrss = None
+    if 'wall' in used:
+        wall = '%g' % bucket(used['wall'])
+    if 'maxrss' in used:
+        maxrss = '%g' % bucket(used['maxrss'])
+    return counts, wall, maxrss
+
+
+def resource_summary(totals, wall, maxrss):
+    """
+    Return the resources a job's finished tasks used on average, with
+    the number of tasks that failed or ran out of time and histograms
+    of the wall times and peak memory use.
+
+    The histograms are sorted lists of (bound, count) tuples, counting
+    the tasks above half of the bound and up to the bound.
+
+    Arguments:
+        totals -- The job's resource totals.
+        wall   -- The histogram of wall times, by bucket.
+        maxrss -- The histogram of peak memory use, by bucket.
+    """
+    tasks = int(totals.get('tasks', 0))
+    summary = {'tasks': tasks,
+               'failed': int(totals.get('failed', 0)),
+               'timeouts': int(totals.get('timeouts', 0))}
+    for field in ('wall', 'utime', 'stime', 'cleanup', 'maxrss'):
+        total = float(totals.get(field, 0))
+        summary[field] = total / tasks if tasks else 0.0
+    summary['wall_histogram'] = sorted((float(bound), int(count))
+                                       for bound, count in wall.items())
+    summary['maxrss_histogram'] = sorted((float(bound), int(count))
+                                         for bound, count in maxrss.items())
+    return summary
+
+
 class Kestrel(object):
 
-    def __init__(self, redis):
+    """
+    Redis keys used for matching workers and jobs:
+
+        worker:[name]                -- set of worker capabilities
+        worker:[name]:signatures     -- set of signatures the worker meets
+        worker:[name]:slots          -- number of bundles the worker
+                                        accepts at once, counting those
+                                        it holds in its prefetch queue
+        worker:[name]:tasks          -- set of the worker's in flight
+                                        tasks, as "job,task"
+        worker:[name]:bundles        -- hash of the number of in flight
+                                        tasks of each bundle the worker
+                                        holds a slot for
+        worker:[name]:task_bundles   -- hash of the bundle each in flight
+                                        task belongs to
+        capability:[cap]:workers     -- set of online workers with cap
+        capability:[cap]:signatures  -- set of signatures requiring cap
+        signatures                   -- set of all known signatures
+        signature:[sig]:jobs         -- set of queued jobs using sig
+        signature:[sig]:workers      -- set of online workers meeting sig
+
+    Redis keys used for storing jobs:
+
+        job:[id]                     -- hash of the job's owner, command,
+                                        cleanup, size, priority, bundle,
+                                        walltime, retries and signature
+        job:[id]:runtime             -- hash of the total run time and
+                                        number of observed tasks
+        job:[id]:resources           -- hash of the number of measured,
+                                        failed and timed out tasks, and
+                                        the total wall time, CPU time, peak
+                                        memory and cleanup time they used
+        job:[id]:resources:wall      -- hash of the number of measured
+                                        tasks in each wall time bucket
+        job:[id]:resources:maxrss    -- hash of the number of measured
+                                        tasks in each peak memory bucket
+        job:[id]:timeouts            -- hash of the number of times each
+                                        task ran past the job's walltime
+        user:[owner]:jobs            -- set of an owner's queued jobs
+        jobs:finished                -- list of jobs completed by pull
+                                        mode workers, for the manager
+                                        to announce
+
+    Redis keys used for choosing the next job to run:
+
+        owners:usage                 -- sorted set of owners, scored by
+                                        their decayed task usage
+        usage:epoch                  -- the time usage charges grow from
+        signature:[sig]:owners       -- sorted set of owners with
+                                        queued tasks using sig, scored
+                                        by their decayed usage
+        signature:[sig]:owner:[owner]:jobs
+                                     -- sorted set of an owner's jobs
+                                        with queued tasks using sig,
+                                        scored by job_rank()
+        user:[owner]:signatures      -- set of signatures the owner has
+                                        run queues for
+        signature:[sig]:ready        -- list holding a wake up token for
+                                        pull mode workers while sig has
+                                        queued tasks
+
+    Redis keys used for tracking the tasks of a job:
+
+        job:[id]:bits:claimed        -- bitmap of tasks that are pending,
+                                        running or completed
+        job:[id]:bits:completed      -- bitmap of completed tasks
+        job:[id]:tasks:pending       -- set of pending tasks
+        job:[id]:tasks:running       -- set of running tasks
+        job:[id]:task:[task]         -- the worker running a task
+        tasks:leases                 -- sorted set of in flight tasks,
+                                        as "job,task", scored by the
+                                        time their lease expires
+        job:[id]:counts              -- hash of the job's queued, pending,
+                                        running and completed task counts
+        pool:counts                  -- hash of the same counts summed
+                                        over every job
+
+    A task is queued when its claimed bit is clear, so submitting a job
+    costs the same no matter how many tasks it has, and per task keys
+    only exist while a task is in flight.
+
+    The counters are updated by the same transitions that move tasks
+    between states, so status queries never have to count set members.
+
+    Pending tasks hold a lease of pending_lease seconds, which is
+    replaced by one of running_lease seconds once the task starts.
+    Running leases are renewed by worker heartbeats, and the pending
+    leases of tasks waiting behind the rest of a bundle by
+    task_hold(). Tasks whose lease runs out are requeued by
+    expire_leases().
+
+    An available worker takes its next task from the owner with the
+    least usage among the signatures it meets, and from that owner's
+    highest priority job. Every claimed task charges its owner, and
+    past charges lose half their weight every halflife seconds.
+    Rather than decaying every score, new charges grow by the same
+    factor, and all scores are scaled back down once they grow large.
+
+    Each worker slot is filled with a bundle of one or more tasks from
+    the same job, which the worker runs one after the other. A bundle
+    is named after its first task and holds its slot until every one
+    of its tasks has finished or been requeued. Jobs may ask for
+    bundles to be sized so that each takes about bundle_target seconds.
+
+    Workers in pull mode claim their own tasks with pull_task() instead
+    of waiting for the manager. A worker with a free slot blocks on the
+    ready lists of the signatures it meets. A job entering an empty run
+    queue places a token there. The worker that pops the token puts it
+    back after its claim while work remains, waking the next worker.
+    Tokens lost with a worker that died holding one are put back by
+    expire_leases().
+    """
+
+    def __init__(self, redis, pending_lease=15, running_lease=60,
+                 halflife=86400, bundle_target=5):
         self.redis = redis
+        self.pending_lease = pending_lease
+        self.running_lease = running_lease
+        self.halflife = halflife
+        self.bundle_target = bundle_target
 
     def job_id(self):
         p = self.redis.pipeline()
@@ -17,57 +282,553 @@ class Kestrel(object):
 
     def register_worker(self, name, capabilities):
         log.debug('POOL: Register %s' % name)
-        capabilities = set([cap.upper() for cap in capabilities])
-        jobs = self.redis.smembers('jobs:queued')
-        worker_jobs = set()
-        for job in jobs:
-            reqs = self.redis.smembers('job:%s:requirements' % job)
-            if reqs.issubset(capabilities):
-                worker_jobs.add(job)
+        capabilities = set(canonical(capabilities))
+
+        # Only signatures that require at least one of the worker's
+        # capabilities (or nothing at all) can possibly match.
+        keys = ['capability:%s:signatures' % cap for cap in capabilities]
+        candidates = self.redis.sunion(keys) if keys else set()
+        if self.redis.sismember('signatures', ''):
+            candidates.add('')
+
+        sigs = set()
+        for sig in candidates:
+            if signature_requirements(sig).issubset(capabilities):
+                sigs.add(sig)
 
         p = self.redis.pipeline()
         for cap in capabilities:
             p.sadd('worker:%s' % name, cap)
             p.sadd('workers:capabilities', cap)
-        for job in worker_jobs:
-            p.sadd('worker:%s:jobs' % name, job)
-            p.sadd('job:%s:workers' % job, name)
+            p.sadd('capability:%s:workers' % cap, name)
+        for sig in sigs:
+            p.sadd('worker:%s:signatures' % name, sig)
+            p.sadd('signature:%s:workers' % sig, name)
         p.sadd('workers:online', name)
         p.execute()
 
+    def index_signature(self, sig):
+        """
+        Add a signature to the matching index, linking it to every
+        online worker that meets its requirements.
+
+        Returns the set of workers that meet the signature.
+        """
+        if not self.redis.sadd('signatures', sig):
+            return self.redis.smembers('signature:%s:workers' % sig)
+
+        reqs = signature_requirements(sig)
+        if reqs:
+            workers = self.redis.sinter(['capability:%s:workers' % req
+                                         for req in reqs])
+        else:
+            workers = self.redis.smembers('workers:online')
+
+        p = self.redis.pipeline()
+        for req in reqs:
+            p.sadd('capability:%s:signatures' % req, sig)
+        for worker in workers:
+            p.sadd('signature:%s:workers' % sig, worker)
+            p.sadd('worker:%s:signatures' % worker, sig)
+        p.execute()
+        return workers
+
+    def worker_jobs(self, name):
+        """Return the set of queued jobs that a worker can run."""
+        sigs = self.redis.smembers('worker:%s:signatures' % name)
+        if not sigs:
+            return set()
+        return self.redis.sunion(['signature:%s:jobs' % sig for sig in sigs])
+
     def worker_capabilities(self, name):
         return self.redis.smembers('worker:%s' % name)
 
-    def worker_available(self, name):
+    def worker_available(self, name, slots=None):
+        """
+        Mark a worker as available and assign it a bundle of tasks
+        for each of its free slots.
+
+        Arguments:
+            name  -- The worker's JID.
+            slots -- The number of bundles the worker accepts at once,
+                     if it has announced it.
+
+        Returns a list of (job, tasks) tuples.
+        """
         log.debug('POOL: Worker %s available' % name)
+        matches = []
         if self.redis.sismember('workers:online', name):
             p = self.redis.pipeline()
             p.srem('workers:busy', name)
             p.sadd('workers:available', name)
-            p.execute()
+            if slots:
+                p.set('worker:%s:slots' % name, slots)
+            p.get('worker:%s:slots' % name)
+            p.hlen('worker:%s:bundles' % name)
+            total, held = p.execute()[-2:]
+            free = int(total or 1) - held
+
+            while len(matches) < free:
+                job = self._next_job(name)
+                if job is None:
+                    break
+                tasks = self._claim_bundle(job, name)
+                if not tasks:
+                    self._dequeue_job(job)
+                    continue
+                log.debug('MATCH: Matched worker %s to ' % name + \
+                          'tasks %s,%s' % (job, ','.join(tasks)))
+                matches.append((job, tasks))
+        return matches
+
+    def workers_available(self, workers):
+        """
+        Mark several workers as available at once and assign bundles
+        of tasks to their free slots. The workers take turns claiming
+        one bundle at a time, so that a short queue is spread over
+        the pool instead of going to the first worker.
+
+        Arguments:
+            workers -- A dictionary of worker JIDs and the number of
+                       bundles each accepts at once, or None if the
+                       worker has not announced it.
+
+        Returns a list of (worker, job, tasks) tuples.
+        """
+        log.debug('POOL: %s workers available' % len(workers))
+        names = sorted(workers)
+        p = self.redis.pipeline()
+        for name in names:
+            p.sismember('workers:online', name)
+        names = [name for name, online in zip(names, p.execute()) if online]
+
+        p = self.redis.pipeline()
+        for name in names:
+            p.srem('workers:busy', name)
+            p.sadd('workers:available', name)
+            if workers[name]:
+                p.set('worker:%s:slots' % name, workers[name])
+        p.execute()
+
+        free = self._free_slots(names)
+        waiting = [name for name in names if free[name] > 0]
+        matches = []
+        while waiting:
+            for name in list(waiting):
+                tasks = None
+                job = self._next_job(name)
+                while job is not None:
+                    tasks = self._claim_bundle(job, name)
+                    if tasks:
+                        break
+                    self._dequeue_job(job)
+                    job = self._next_job(name)
+                if not tasks:
+                    waiting.remove(name)
+                    continue
+                log.debug('MATCH: Matched worker %s to ' % name + \
+                          'tasks %s,%s' % (job, ','.join(tasks)))
+                matches.append((name, job, tasks))
+                free[name] -= 1
+                if free[name] <= 0:
+                    waiting.remove(name)
+        return matches
+
+    def pull_queues(self, name):
+        """
+        Return the ready lists a pull mode worker waits on, one for
+        each signature the worker meets.
+        """
+        sigs = self.redis.smembers('worker:%s:signatures' % name)
+        return ['signature:%s:ready' % sig for sig in sorted(sigs)]
+
+    def pull_task(self, name, sig):
+        """
+        Claim and start a bundle of tasks for a pull mode worker that
+        took the wake up token from the ready list of a signature.
+
+        Arguments:
+            name -- The worker's JID.
+            sig  -- The signature whose token the worker took.
+
+        Returns a (job, tasks) tuple, or None if no task was claimed.
+        """
+        match = None
+        if self.redis.sismember('workers:online', name):
+            job = self._next_job(name)
+            while job is not None:
+                tasks = self._claim_bundle(job, name)
+                if tasks:
+                    match = (job, tasks)
+                    break
+                self._dequeue_job(job)
+                job = self._next_job(name)
+
+        if self.redis.exists('signature:%s:owners' % sig):
+            self.redis.rpush('signature:%s:ready' % sig, sig)
+
+        if match is not None:
+            job, tasks = match
+            log.debug('MATCH: Worker %s pulled ' % name + \
+                      'tasks %s,%s' % (job, ','.join(tasks)))
+            for task in tasks:
+                self.task_start(name, job, task)
+        return match
+
+    def pull_finish(self, worker, job, task):
+        """
+        Mark a task run by a pull mode worker as completed. A job that
+        is completed by the task is added to the jobs:finished list.
+
+        Returns True if the task completed the job.
+        """
+        if self.task_finish(worker, job, task):
+            self.redis.rpush('jobs:finished', job)
+            return True
+        return False
+
+    def pull_timeout(self, worker, job, task):
+        """
+        Requeue or fail a task that a pull mode worker stopped for
+        running past its job's walltime, as task_timeout does. A job
+        that is completed by failing the task is added to the
+        jobs:finished list.
+        """
+        outcome = self.task_timeout(worker, job, task)
+        if outcome == 'completed':
+            self.redis.rpush('jobs:finished', job)
+        return outcome
+
+    def _free_slots(self, workers):
+        """Return a dictionary of the number of free slots of workers."""
+        p = self.redis.pipeline()
+        for worker in workers:
+            p.get('worker:%s:slots' % worker)
+            p.hlen('worker:%s:bundles' % worker)
+        results = p.execute()
+        free = {}
+        for i, worker in enumerate(workers):
+            total, held = results[2 * i:2 * i + 2]
+            free[worker] = int(total or 1) - held
+        return free
+
+    def _next_job(self, name):
+        """
+        Return the job a worker should take its next task from, or
+        None if no job the worker can run has queued tasks.
+        """
+        while True:
+            sigs = list(self.redis.smembers('worker:%s:signatures' % name))
+            p = self.redis.pipeline()
+            for sig in sigs:
+                p.zrange('signature:%s:owners' % sig, 0, 0, withscores=True)
+            heads = []
+            for sig, head in zip(sigs, p.execute()):
+                if head:
+                    owner, usage = head[0]
+                    heads.append((usage, owner, sig))
+            if not heads:
+                return None
+
+            owner = min(heads)[1]
+            sigs = [sig for usage, head, sig in heads if head == owner]
+            p = self.redis.pipeline()
+            for sig in sigs:
+                p.zrange('signature:%s:owner:%s:jobs' % (sig, owner), 0, 0,
+                         withscores=True)
+            jobs = []
+            for sig, head in zip(sigs, p.execute()):
+                if head:
+                    jobs.append((head[0][1], head[0][0]))
+                else:
+                    # The owner's last job left the queue in the meantime.
+                    self._prune_owner(sig, owner)
+            if jobs:
+                return min(jobs)[1]
+
+    def _enqueue_job(self, job):
+        """Add a job with queued tasks to its owner's run queue."""
+        owner, sig, priority = self.redis.hmget(
+                'job:%s' % job, ['owner', 'signature', 'priority'])
+        if owner is None:
+            return
+        usage = self.redis.zscore('owners:usage', owner) or 0
+        p = self.redis.pipeline()
+        p.execute_command('ZADD', 'signature:%s:owner:%s:jobs' % (sig, owner),
+                          job_rank(job, priority), job)
+        p.execute_command('ZADD', 'signature:%s:owners' % sig,
+                          'NX', usage, owner)
+        p.sadd('user:%s:signatures' % owner, sig)
+        p.llen('signature:%s:ready' % sig)
+        if not p.execute()[-1]:
+            self.redis.rpush('signature:%s:ready' % sig, sig)
+
+    def _dequeue_job(self, job):
+        """Remove a job without queued tasks from its run queue."""
+        owner, sig = self.redis.hmget('job:%s' % job, ['owner', 'signature'])
+        if owner is None:
+            return
+        self.redis.zrem('signature:%s:owner:%s:jobs' % (sig, owner), job)
+        self._prune_owner(sig, owner)
 
-            queued_jobs = self.redis.smembers('jobs:queued')
-            jobs = self.redis.sinter(('jobs:queued', 'worker:%s:jobs' % name))
-            for job in jobs:
-                task = self.redis.srandmember('job:%s:tasks:queued' % job)
-                if task is not None:
-                    if self.redis.sismember('worker:%s:task' % name,
-                                            '%s,%s' % (job, task)):
+    def _prune_owner(self, sig, owner):
+        """
+        Remove an owner from the run queue of a signature if it has no
+        queued jobs there. The owner's job queue is watched, so a job
+        enqueued in the meantime keeps the owner in place.
+        """
+        queue = 'signature:%s:owner:%s:jobs' % (sig, owner)
+
+        def prune(p):
+            if p.zcard(queue):
+                return
+            p.multi()
+            p.zrem('signature:%s:owners' % sig, owner)
+            p.srem('user:%s:signatures' % owner, sig)
+
+        self.redis.transaction(prune, queue)
+
+    def _usage_scale(self, p):
+        """
+        Return the usage one claimed task adds, reading usage:epoch on
+        a pipeline that watches it, or None if there is no epoch yet or
+        all usage must be rescaled first.
+        """
+        epoch = p.get('usage:epoch')
+        if epoch is None:
+            return None
+        exponent = (time.time() - float(epoch)) / self.halflife
+        if exponent > 32:
+            return None
+        return 2 ** exponent
+
+    def _rescale(self):
+        """
+        Scale every owner's usage down and start a new epoch once
+        charges have grown large, or start the first epoch. Nothing is
+        done if another thread got there first.
+        """
+        def rescale(p):
+            now = time.time()
+            epoch = p.get('usage:epoch')
+            if epoch is None:
+                p.multi()
+                p.set('usage:epoch', now)
+                return
+            exponent = (now - float(epoch)) / self.halflife
+            if exponent <= 32:
+                return
+            log.debug('USAGE: Rescaling owner usage')
+            keys = self._usage_keys()
+            p.multi()
+            for key in keys:
+                p.execute_command('ZUNIONSTORE', key, 1, key,
+                                  'WEIGHTS', 2 ** -exponent)
+            p.set('usage:epoch', now)
+
+        self.redis.transaction(rescale, 'usage:epoch')
+
+    def _usage_keys(self):
+        """
+        Return the sorted sets holding usage scores, leaving out the
+        signatures that have no queued jobs.
+        """
+        sigs = list(self.redis.smembers('signatures'))
+        p = self.redis.pipeline(transaction=False)
+        for sig in sigs:
+            p.exists('signature:%s:owners' % sig)
+        return ['owners:usage'] + ['signature:%s:owners' % sig
+                                   for sig, used in zip(sigs, p.execute())
+                                   if used]
+
+    def _add_usage(self, pipe, owner, sigs, amount):
+        """Queue an increase of an owner's usage onto a pipeline."""
+        pipe.execute_command('ZINCRBY', 'owners:usage', amount, owner)
+        for sig in sigs:
+            # ZADD's reply callback takes the reply of INCR as a count,
+            # so the command is sent through zadd() to parse it as the
+            # new score instead.
+            pipe.zadd('signature:%s:owners' % sig, {owner: amount},
+                      xx=True, incr=True)
+
+    def _claim_bundle(self, job, worker):
+        """
+        Assign a bundle of queued tasks of a job to one slot of a
+        worker, and charge the job's owner for them.
+
+        The unclaimed tasks are found with a single scan of the job's
+        claimed bitmap, and are claimed and charged in one transaction
+        that fails if the bitmap or the usage epoch changed since.
+
+        Returns the list of tasks, which is empty if the job has no
+        queued tasks.
+        """
+        p = self.redis.pipeline()
+        p.hmget('job:%s' % job, ['size', 'owner', 'bundle'])
+        p.hmget('job:%s:runtime' % job, ['seconds', 'tasks'])
+        (size, owner, bundle), (seconds, observed) = p.execute()
+        if size is None:
+            return []
+        want = bundle_size(bundle, seconds, observed, self.bundle_target)
+        sigs = self.redis.smembers('user:%s:signatures' % owner)
+
+        claimed = 'job:%s:bits:claimed' % job
+        with self.redis.pipeline() as p:
+            while True:
+                try:
+                    p.watch(claimed, 'usage:epoch')
+                    tasks = self._unclaimed(p, claimed, int(size), want)
+                    if not tasks:
+                        return []
+                    amount = self._usage_scale(p)
+                    if amount is None:
+                        p.reset()
+                        self._rescale()
                         continue
-                    p = self.redis.pipeline()
-                    p.smove('job:%s:tasks:queued' % job,
-                            'job:%s:tasks:pending' % job,
-                            task)
-                    p.set('job:%s:task:%s:is_pending' % (job, task), 'True')
-                    p.expire('job:%s:task:%s:is_pending' % (job, task), 15)
-                    p.sadd('worker:%s:tasks' % name,
-                           '%s,%s' % (job, task))
-                    p.set('job:%s:task:%s' % (job, task), name)
+                    p.multi()
+                    self._queue_claims(p, job, worker, tasks)
+                    self._add_usage(p, owner, sigs, amount * len(tasks))
                     p.execute()
-                    log.debug('MATCH: Matched worker %s to ' % name + \
-                              'task %s,%s' % (job, task))
-                    return job, task
-            return None
+                    return tasks
+                except WatchError:
+                    # Claimed by somebody else in the meantime.
+                    continue
+
+    def _unclaimed(self, pipe, key, size, want):
+        """
+        Return up to a number of the lowest numbered unclaimed tasks
+        of a job, reading its claimed bitmap with one BITPOS and one
+        BITFIELD from the first unclaimed task on.
+
+        Arguments:
+            pipe -- A pipeline watching the bitmap.
+            key  -- The job's claimed bitmap.
+            size -- The number of tasks in the job.
+            want -- The number of tasks to return at most.
+        """
+        start = pipe.bitpos(key, 0)
+        if start < 0 or start >= size:
+            return []
+        # Requeued tasks leave gaps below the first task never handed
+        # out, so a few more bits than wanted are read.
+        span = min(size - start, 4 * want + BITFIELD_WIDTH)
+        words = (span + BITFIELD_WIDTH - 1) // BITFIELD_WIDTH
+        args = []
+        for i in range(words):
+            args.extend(('GET', 'u%s' % BITFIELD_WIDTH,
+                         start + i * BITFIELD_WIDTH))
+        values = pipe.execute_command('BITFIELD', key, *args)
+
+        tasks = []
+        for i, value in enumerate(values):
+            for bit in range(BITFIELD_WIDTH):
+                task = start + i * BITFIELD_WIDTH + bit
+                if task >= size or len(tasks) >= want:
+                    return tasks
+                if not value >> (BITFIELD_WIDTH - 1 - bit) & 1:
+                    tasks.append(str(task))
+        return tasks
+
+    def _queue_claims(self, pipe, job, worker, tasks):
+        """
+        Queue the claim of a bundle of tasks by one slot of a worker
+        onto a pipeline. The bundle is named after its first task.
+        """
+        tag = '%s,%s' % (job, tasks[0])
+        expires = time.time() + self.pending_lease
+        for task in tasks:
+            item = '%s,%s' % (job, task)
+            pipe.setbit('job:%s:bits:claimed' % job, task, 1)
+            pipe.sadd('job:%s:tasks:pending' % job, task)
+            pipe.execute_command('ZADD', 'tasks:leases', expires, item)
+            pipe.sadd('worker:%s:tasks' % worker, item)
+            pipe.hset('worker:%s:task_bundles' % worker, item, tag)
+            pipe.set('job:%s:task:%s' % (job, task), worker)
+        pipe.hincrby('worker:%s:bundles' % worker, tag, len(tasks))
+        self._count(pipe, job, queued=-len(tasks), pending=len(tasks))
+
+    def _count(self, pipe, job, **deltas):
+        """
+        Queue updates to the task state counters of a job and of
+        the whole pool onto a pipeline.
+        """
+        for field, delta in deltas.items():
+            if delta:
+                pipe.hincrby('job:%s:counts' % job, field, delta)
+                pipe.hincrby('pool:counts', field, delta)
+
+    def _release_slots(self, tasks):
+        """
+        Remove in flight tasks from their bundles, freeing the slot
+        of every bundle that has no tasks left.
+
+        Arguments:
+            tasks -- A list of (worker, job, task) tuples.
+        """
+        tasks = [(worker, '%s,%s' % (job, task))
+                 for worker, job, task in tasks if worker]
+        p = self.redis.pipeline()
+        for worker, item in tasks:
+            p.hget('worker:%s:task_bundles' % worker, item)
+        bundles = p.execute()
+
+        held = []
+        p = self.redis.pipeline()
+        for (worker, item), bundle in zip(tasks, bundles):
+            if bundle is not None:
+                p.hdel('worker:%s:task_bundles' % worker, item)
+                p.hincrby('worker:%s:bundles' % worker, bundle, -1)
+                held.append((worker, bundle))
+        results = p.execute()
+
+        p = self.redis.pipeline()
+        for i, (worker, bundle) in enumerate(held):
+            if results[2 * i + 1] <= 0:
+                p.hdel('worker:%s:bundles' % worker, bundle)
+        p.execute()
+
+    def _requeue_tasks(self, tasks):
+        """
+        Return in flight tasks to the queue.
+
+        Arguments:
+            tasks -- A list of (worker, job, task) tuples.
+        """
+        p = self.redis.pipeline()
+        for worker, job, task in tasks:
+            p.srem('job:%s:tasks:pending' % job, task)
+            p.srem('job:%s:tasks:running' % job, task)
+            p.zrem('tasks:leases', '%s,%s' % (job, task))
+            p.srem('worker:%s:tasks' % worker, '%s,%s' % (job, task))
+            p.delete('job:%s:task:%s' % (job, task))
+        results = p.execute()
+
+        # Only tasks that were still in flight go back to the queue,
+        # not those that were completed or cancelled in the meantime.
+        inflight = []
+        p = self.redis.pipeline()
+        for i, (worker, job, task) in enumerate(tasks):
+            pending, running = results[5 * i:5 * i + 2]
+            if pending or running:
+                inflight.append(job)
+                p.setbit('job:%s:bits:claimed' % job, task, 0)
+        claims = p.execute()
+
+        requeued = set()
+        p = self.redis.pipeline()
+        for i, (worker, job, task) in enumerate(tasks):
+            pending, running = results[5 * i:5 * i + 2]
+            self._count(p, job, pending=-pending, running=-running)
+        for job, claimed in zip(inflight, claims):
+            self._count(p, job, queued=claimed)
+            if claimed:
+                requeued.add(job)
+        p.execute()
+        self._release_slots(tasks)
+
+        for job in requeued:
+            if self.redis.sismember('jobs:queued', job):
+                self._enqueue_job(job)
 
     def worker_busy(self, name):
         log.debug('POOL: Worker %s busy' % name)
@@ -87,203 +848,432 @@ class Kestrel(object):
             p.execute()
 
             reset_tasks = {}
-            tasks = self.redis.smembers('worker:%s:tasks' % name)
             p = self.redis.pipeline()
-            p.delete('worker:%s')
-            p.delete('worker:%s:jobs' % name)
-            p.delete('worker:%s:tasks' % name)
+            p.smembers('worker:%s:tasks' % name)
+            p.smembers('worker:%s' % name)
+            p.smembers('worker:%s:signatures' % name)
+            tasks, caps, sigs = p.execute()
+
+            requeue = []
             for task in tasks:
                 job, task = task.split(',')
                 if job not in reset_tasks:
                     reset_tasks[job] = set()
                 reset_tasks[job].add(task)
-
-                p.smove('job:%s:tasks:pending' % job,
-                        'job:%s:tasks:queued' % job,
-                        task)
-                p.set('job:%s:task:%s:is_pending' % (job, task), 'True')
-                p.expire('job:%s:task:%s:is_pending' % (job, task), 15)
-                p.smove('job:%s:tasks:running' %job,
-                        'job:%s:tasks:queued' % job,
-                        task)
-                p.delete('job:%s:task:%s' % (job, task))
+                requeue.append((name, job, task))
                 log.debug('RESET: Resetting task %s,%s' % (job, task))
+            self._requeue_tasks(requeue)
+
+            p = self.redis.pipeline()
+            for cap in caps:
+                p.srem('capability:%s:workers' % cap, name)
+            for sig in sigs:
+                p.srem('signature:%s:workers' % sig, name)
+            p.delete('worker:%s' % name)
+            p.delete('worker:%s:signatures' % name)
+            p.delete('worker:%s:tasks' % name)
+            p.delete('worker:%s:slots' % name)
+            p.delete('worker:%s:bundles' % name)
+            p.delete('worker:%s:task_bundles' % name)
             p.execute()
             return reset_tasks
 
-    def submit_job(self, job, owner, command, cleanup, size, requirements):
+    def submit_job(self, job, owner, command, cleanup, size, requirements,
+                   priority=0, bundle=1, walltime=0, retries=0):
+        """
+        Queue a new job.
+
+        Arguments:
+            job          -- The ID of the job.
+            owner        -- The JID of the user submitting the job.
+            command      -- The command run for each task, given the
+                            task's number.
+            cleanup      -- A command to run after each task command.
+            size         -- The number of tasks.
+            requirements -- The capabilities a worker must have.
+            priority     -- The job's priority among the owner's jobs.
+            bundle       -- The number of tasks sent to a worker at
+                            once, or 0 to size bundles automatically.
+            walltime     -- The number of seconds a task command may
+                            run before the worker stops it, or 0.
+            retries      -- The number of times a task that ran out of
+                            time is requeued before it is failed.
+
+        Returns the job's ID, and the workers that may run its tasks
+        straight away along with the tasks for each.
+        """
         log.debug('JOB: Job %s submitted by %s' % (job, owner))
 
-        requirements = set(requirements)
+        requirements = canonical(requirements)
+        sig = signature(requirements)
 
         p = self.redis.pipeline()
-        p.set('job:%s:owner' % job, owner)
-        p.set('job:%s:command' % job, command)
-        p.set('job:%s:cleanup' % job, cleanup)
-        p.set('job:%s:size' % job, size)
-        for req in requirements:
-            p.sadd('job:%s:requirements' % job, req)
-        for task in xrange(0, int(size)):
-            p.sadd('job:%s:tasks:queued' % job, task)
+        p.hmset('job:%s' % job, {'owner': owner,
+                                 'command': command,
+                                 'cleanup': cleanup,
+                                 'size': size,
+                                 'priority': int(priority or 0),
+                                 'bundle': int(bundle),
+                                 'walltime': float(walltime or 0),
+                                 'retries': int(retries or 0),
+                                 'signature': sig})
+        p.sadd('signature:%s:jobs' % sig, job)
+        p.sadd('user:%s:jobs' % owner, job)
         p.sadd('jobs:queued', job)
+        self._count(p, job, queued=int(size))
         p.execute()
 
-        p = self.redis.pipeline()
-        matches = {}
-        workers = self.redis.smembers('workers:online')
-        for worker in workers:
-            caps = self.redis.smembers('worker:%s' % worker)
-            if caps.issuperset(requirements):
-                p.sadd('job:%s:workers' % job, worker)
-                p.sadd('worker:%s:jobs' % worker, job)
-
-                if self.redis.sismember('workers:available', worker):
-                    task = self.redis.srandmember('job:%s:tasks:queued' % job)
-                    if task is not None:
-                        if not self.redis.sismember('worker:%s:task' % worker,
-                                                    '%s,%s' % (job, task)):
-                            p.smove('job:%s:tasks:queued' % job,
-                                    'job:%s:tasks:pending' % job,
-                                    task)
-                            p.set('job:%s:task:%s:is_pending' % (job, task), 'True')
-                            p.expire('job:%s:task:%s:is_pending' % (job, task), 15)
-                            p.sadd('worker:%s:tasks' % worker,
-                                   '%s,%s' % (job, task))
-                            p.set('job:%s:task:%s' % (job, task), worker)
-                            log.debug('MATCH: Matched worker %s to ' % worker + \
-                                      'task %s,%s' % (job, task))
-                            matches[task] = worker
-        p.execute()
-        return job, matches
+        self.index_signature(sig)
+        if int(size):
+            self._enqueue_job(job)
+        return job, self.job_matches(job)
 
     def cancel_job(self, job, canceller):
-        owner = self.redis.get('job:%s:owner' % job)
+        owner, sig = self.redis.hmget('job:%s' % job, ['owner', 'signature'])
         if owner != canceller:
             return None
         log.debug('JOB: Job %s cancelled by %s' % (job, owner))
-        self.redis.srem('jobs:queued', job)
+        self._dequeue_job(job)
+        p = self.redis.pipeline()
+        p.srem('jobs:queued', job)
+        p.srem('signature:%s:jobs' % sig, job)
+        p.srem('user:%s:jobs' % owner, job)
+        p.hget('job:%s:counts' % job, 'queued')
+        queued = int(p.execute()[-1] or 0)
+
+        # The remaining queued tasks will never be handed out.
+        p = self.redis.pipeline()
+        self._count(p, job, queued=-queued)
+        p.execute()
 
         cancellations = {}
-        tasks = self.redis.sunion(['job:%s:tasks:running' % job,
-                                   'job:%s:tasks:pending' % job])
-        self.redis.sunionstore('job:%s:tasks:completed',
-                               ['job:%s:tasks:queued' % job,
-                                'job:%s:tasks:completed' % job])
+        tasks = list(self.redis.sunion(['job:%s:tasks:running' % job,
+                                        'job:%s:tasks:pending' % job]))
+        p = self.redis.pipeline()
         for task in tasks:
-            worker = self.redis.get('job:%s:task:%s' % (job, task))
-            if worker and worker not in cancellations:
-                cancellations[worker] = set()
-            cancellations[worker].add(task)
+            p.get('job:%s:task:%s' % (job, task))
+        owners = p.execute()
+        for task, worker in zip(tasks, owners):
+            if worker:
+                cancellations.setdefault(worker, set()).add(task)
+
+        # Take the tasks in flight off their workers so that their
+        # slots can be filled straight away. The tasks stay claimed,
+        # and since they no longer have an owner, a late finish, reset
+        # or timeout report from a worker is ignored.
+        p = self.redis.pipeline()
+        for task, worker in zip(tasks, owners):
+            item = '%s,%s' % (job, task)
+            p.srem('job:%s:tasks:pending' % job, task)
+            p.srem('job:%s:tasks:running' % job, task)
+            p.zrem('tasks:leases', item)
+            p.srem('worker:%s:tasks' % worker, item)
+            p.delete('job:%s:task:%s' % (job, task))
+        results = p.execute()
+        p = self.redis.pipeline()
+        self._count(p, job,
+                    pending=-sum(results[0::5]),
+                    running=-sum(results[1::5]))
+        p.execute()
+        self._release_slots([(worker, job, task)
+                             for task, worker in zip(tasks, owners)])
         return cancellations
 
     def job_matches(self, job):
-        requirements = self.redis.smembers('job:%s:requirements' % job)
-        p = self.redis.pipeline()
-        matches = {}
-        workers = self.redis.smembers('workers:available')
+        sig = self.redis.hget('job:%s' % job, 'signature')
+        if sig is None or not self.redis.sismember('jobs:queued', job):
+            return []
+        workers = sorted(self.redis.sinter(['signature:%s:workers' % sig,
+                                            'workers:available']))
+        free = self._free_slots(workers)
+        matches = []
         for worker in workers:
-            caps = self.redis.smembers('worker:%s' % worker)
-            if caps.issuperset(requirements):
-                p.sadd('job:%s:workers' % job, worker)
-                p.sadd('worker:%s:jobs' % worker, job)
-
-                if self.redis.sismember('workers:available', worker):
-                    task = self.redis.srandmember('job:%s:tasks:queued' % job)
-                    if task is not None:
-                        p.smove('job:%s:tasks:queued' % job,
-                                'job:%s:tasks:pending' % job,
-                                task)
-                        p.set('job:%s:task:%s:is_pending' % (job, task), 'True')
-                        p.expire('job:%s:task:%s:is_pending' % (job, task), 15)
-                        p.sadd('worker:%s:tasks' % worker,
-                               '%s,%s' % (job, task))
-                        p.set('job:%s:task:%s' % (job, task), worker)
-                        log.debug('MATCH: Matched worker %s to ' % worker + \
-                                  'task %s,%s' % (job, task))
-                        matches[task] = worker
-        p.execute()
+            for slot in range(free[worker]):
+                tasks = self._claim_bundle(job, worker)
+                if not tasks:
+                    self._dequeue_job(job)
+                    return matches
+                log.debug('MATCH: Matched worker %s to ' % worker + \
+                          'tasks %s,%s' % (job, ','.join(tasks)))
+                matches.append((worker, tasks))
         return matches
 
     def task_start(self, worker, job, task):
+        """
+        Mark a pending task as running on the worker it was given to.
+
+        Returns True if the task was started, or False if the worker
+        no longer holds it, as after a cancel or an expired lease.
+        """
+        job, task = str(job), str(task)
         log.debug('TASK: Task %s,%s started by %s' % (job, task, worker))
+        if self.redis.get('job:%s:task:%s' % (job, task)) != str(worker):
+            return False
+        started = self.redis.smove('job:%s:tasks:pending' % job,
+                                   'job:%s:tasks:running' % job,
+                                   task)
+        if started:
+            p = self.redis.pipeline()
+            p.execute_command('ZADD', 'tasks:leases', 'XX',
+                              time.time() + self.running_lease,
+                              '%s,%s' % (job, task))
+            self._count(p, job, pending=-1, running=1)
+            p.execute()
+        return bool(started)
+
+    def task_hold(self, worker, job, tasks):
+        """
+        Renew the pending leases of tasks a worker was given but has
+        not been sent yet, such as the later tasks of a bundle sent to
+        a worker one task at a time.
+
+        Returns the list of tasks the worker still holds.
+
+        Arguments:
+            worker -- The worker's name.
+            job    -- The job's ID.
+            tasks  -- The tasks waiting to be sent.
+        """
+        job, tasks = str(job), [str(task) for task in tasks]
+        if not tasks:
+            return []
+        p = self.redis.pipeline(transaction=False)
+        for task in tasks:
+            p.get('job:%s:task:%s' % (job, task))
+            p.sismember('job:%s:tasks:pending' % job, task)
+        results = p.execute()
+        held = [task for task, owner, pending in
+                zip(tasks, results[::2], results[1::2])
+                if owner == str(worker) and pending]
+
+        expires = time.time() + self.pending_lease
         p = self.redis.pipeline()
-        p.smove('job:%s:tasks:pending' % job,
-                'job:%s:tasks:running' % job,
-                task)
-        p.set('job:%s:task:%s:is_pending' % (job, task), 'True')
-        p.expire('job:%s:task:%s:is_pending' % (job, task), 15)
+        for task in held:
+            p.execute_command('ZADD', 'tasks:leases', 'XX', expires,
+                              '%s,%s' % (job, task))
         p.execute()
+        return held
 
     def task_finish(self, worker, job, task):
         job, task = str(job), str(task)
         log.debug('TASK: Task %s,%s finished by %s' % (job, task, worker))
+        if self.redis.get('job:%s:task:%s' % (job, task)) != str(worker):
+            # The task was cancelled, requeued or reported since the
+            # worker was given it.
+            return False
         p = self.redis.pipeline()
-        p.smove('job:%s:tasks:running' % job,
-                'job:%s:tasks:completed' % job,
-                task)
+        p.srem('job:%s:tasks:pending' % job, task)
+        p.srem('job:%s:tasks:running' % job, task)
+        p.setbit('job:%s:bits:completed' % job, task, 1)
         p.srem('worker:%s:tasks' % worker, '%s,%s' % (job, task))
-        p.delete('job:%s:task:%s' % (job, task), worker)
-        p.scard('job:%s:tasks:completed' % job)
+        p.zrem('tasks:leases', '%s,%s' % (job, task))
+        p.delete('job:%s:task:%s' % (job, task))
+        pending, running, done = p.execute()[:3]
+        self._release_slots([(worker, job, task)])
+
+        p = self.redis.pipeline()
+        self._count(p, job, pending=-pending, running=-running)
+        if done:
+            # A repeated completion report for the same task.
+            p.execute()
+            return False
+        p.hincrby('job:%s:counts' % job, 'completed', 1)
+        p.hincrby('pool:counts', 'completed', 1)
+        p.hmget('job:%s' % job, ['size', 'signature', 'owner'])
         results = p.execute()
-        num_completed = results[-1]
-        job_size = int(self.redis.get('job:%s:size' % job))
-        if num_completed == job_size:
-            return self.redis.smove('jobs:queued', 'jobs:completed', job)
+        num_completed, _, (size, sig, owner) = results[-3:]
+        if num_completed == int(size):
+            self._dequeue_job(job)
+            p = self.redis.pipeline()
+            p.srem('signature:%s:jobs' % sig, job)
+            p.srem('user:%s:jobs' % owner, job)
+            p.smove('jobs:queued', 'jobs:completed', job)
+            return p.execute()[-1]
         return False
 
     def task_reset(self, worker, job, task):
         log.debug('TASK: Task %s,%s for %s reset.' % (job, task, worker))
+        owner = self.redis.get('job:%s:task:%s' % (job, task))
+        if owner and owner != str(worker):
+            return
+        self._requeue_tasks([(worker, job, task)])
+
+    def task_timeout(self, worker, job, task):
+        """
+        Handle a task that a worker stopped for running past its job's
+        walltime. The task is requeued until it has run out of time
+        more often than the job's retries allow, and is then finished
+        as a failure so that the job can still complete.
+
+        Arguments:
+            worker -- The worker that ran the task.
+            job    -- The ID of the job.
+            task   -- The task's number within the job.
+
+        Returns 'requeued' if the task was requeued, 'completed' if
+        failing the task completed the job, 'failed' otherwise, and
+        None if the task is no longer in flight on the worker.
+        """
+        job, task = str(job), str(task)
+        if self.redis.get('job:%s:task:%s' % (job, task)) != str(worker):
+            # Cancelled, requeued or reported since; not counted.
+            return None
         p = self.redis.pipeline()
-        p.smove('job:%s:tasks:pending' % job,
-                'job:%s:tasks:queued' % job,
-                task)
-        p.smove('job:%s:tasks:running' % job,
-                'job:%s:tasks:queued' % job,
-                task)
-        p.delete('job:%s:task:%s:is_pending' % (job, task))
-        p.srem('worker:%s:tasks' % worker, '%s,%s' % (job, task))
-        p.delete('job:%s:task:%s' % (job, task), worker)
+        p.hincrby('job:%s:timeouts' % job, task, 1)
+        p.hget('job:%s' % job, 'retries')
+        timeouts, retries = p.execute()
+        if int(timeouts) <= int(retries or 0):
+            log.debug('TASK: Task %s,%s timed out on %s, requeued' % (
+                job, task, worker))
+            self.task_reset(worker, job, task)
+            return 'requeued'
+        log.debug('TASK: Task %s,%s timed out on %s, failed' % (
+            job, task, worker))
+        if self.task_finish(worker, job, task):
+            return 'completed'
+        return 'failed'
+
+    def record_runtime(self, job, seconds, tasks=1):
+        """
+        Add to the observed run time of a job's tasks, which sizes
+        the job's automatic bundles.
+
+        Arguments:
+            job     -- The ID of the job.
+            seconds -- The time taken to run the tasks.
+            tasks   -- The number of tasks that were run.
+        """
+        p = self.redis.pipeline()
+        p.hincrbyfloat('job:%s:runtime' % job, 'seconds', seconds)
+        p.hincrby('job:%s:runtime' % job, 'tasks', tasks)
         p.execute()
 
-    def reset_pending_tasks(self):
-        reset_jobs = set()
-        for job in self.redis.smembers('jobs:queued'):
-            for task in self.redis.smembers('job:%s:tasks:pending' % job):
-                if self.redis.get('job:%s:task:%s:is_pending' % (job, task)) is None:
-                    reset_jobs.add(job)
-                    worker = self.redis.get('job:%s:task:%s' % (job, task))
-                    self.task_reset(worker, job, task)
-        return reset_jobs
+    def record_resources(self, job, resources):
+        """
+        Add the resources used by finished tasks to a job's totals
+        and histograms, which job_status reports.
+
+        Arguments:
+            job       -- The ID of the job.
+            resources -- A dictionary of the resources each task used,
+                         as reported by the worker.
+        """
+        key = 'job:%s:resources' % job
+        p = self.redis.pipeline()
+        for task, used in resources.items():
+            counts, wall, maxrss = resource_counts(used)
+            for field, value in counts.items():
+                if isinstance(value, float):
+                    p.hincrbyfloat(key, field, value)
+                else:
+                    p.hincrby(key, field, value)
+            if wall is not None:
+                p.hincrby('%s:wall' % key, wall, 1)
+            if maxrss is not None:
+                p.hincrby('%s:maxrss' % key, maxrss, 1)
+        p.execute()
+
+    def worker_heartbeat(self, name):
+        """Renew the leases of every task a worker is running."""
+        tasks = self.redis.smembers('worker:%s:tasks' % name)
+        if not tasks:
+            return
+        tasks = list(tasks)
+        p = self.redis.pipeline()
+        for item in tasks:
+            job, task = item.split(',')
+            p.sismember('job:%s:tasks:running' % job, task)
+        running = p.execute()
+
+        expires = time.time() + self.running_lease
+        p = self.redis.pipeline()
+        for item, is_running in zip(tasks, running):
+            if is_running:
+                p.execute_command('ZADD', 'tasks:leases', 'XX', expires, item)
+        p.execute()
 
-    def reset_stalled_tasks(self):
+    def expire_leases(self):
+        """
+        Requeue every task whose lease has run out.
+
+        Returns the set of jobs that had tasks requeued.
+        """
         reset_jobs = set()
-        for job in self.redis.smembers('jobs:queued'):
-            for task in self.redis.smembers('job:%s:tasks:running' % job):
-                worker = self.redis.get('job:%s:task:%s' % (job, task))
-                if self.redis.sismember('workers:available', worker):
-                    self.task_reset(worker, job, task)
-                    reset_jobs.add(job)
+        expired = self.redis.zrangebyscore('tasks:leases', '-inf', time.time())
+        for item in expired:
+            # Only the caller that removes the lease may requeue the task.
+            if not self.redis.zrem('tasks:leases', item):
+                continue
+            job, task = item.split(',')
+            worker = self.redis.get('job:%s:task:%s' % (job, task))
+            log.debug('LEASE: Lease for task %s,%s expired' % (job, task))
+            self.task_reset(worker, job, task)
+            reset_jobs.add(job)
+        self._restore_tokens()
         return reset_jobs
 
+    def _restore_tokens(self):
+        """
+        Put back the wake up tokens of signatures with queued jobs
+        whose ready lists are empty, as happens when a pull mode
+        worker dies between taking a token and returning it. A token
+        that is only briefly out is duplicated, which costs a worker
+        a wasted wake up at most.
+        """
+        sigs = list(self.redis.smembers('signatures'))
+        p = self.redis.pipeline(transaction=False)
+        for sig in sigs:
+            p.exists('signature:%s:owners' % sig)
+            p.llen('signature:%s:ready' % sig)
+        results = p.execute()
+        p = self.redis.pipeline(transaction=False)
+        for sig, queued, ready in zip(sigs, results[::2], results[1::2]):
+            if queued and not ready:
+                log.debug('PULL: Restoring the ready token of %s' % sig)
+                p.rpush('signature:%s:ready' % sig, sig)
+        p.execute()
+
     def job_status(self, job=None):
         if job is None:
             jobs = self.redis.smembers('jobs:queued')
         else:
             jobs = [str(job)]
-        statuses = {}
+        jobs = list(jobs)
+        p = self.redis.pipeline()
         for job in jobs:
-            status = {'owner': self.redis.get('job:%s:owner' % job),
-                      'requested': self.redis.get('job:%s:size' % job)}
+            p.hmget('job:%s' % job, ['owner', 'size', 'priority'])
+            p.hgetall('job:%s:counts' % job)
+            p.hgetall('job:%s:resources' % job)
+            p.hgetall('job:%s:resources:wall' % job)
+            p.hgetall('job:%s:resources:maxrss' % job)
+        results = p.execute()
+
+        statuses = {}
+        for i, job in enumerate(jobs):
+            (owner, size, priority), counts, totals, wall, maxrss = \
+                    results[5 * i:5 * i + 5]
+            status = {'owner': owner,
+                      'requested': size,
+                      'priority': int(priority or 0),
+                      'resources': resource_summary(totals, wall, maxrss)}
             for group in ['queued', 'pending', 'running', 'completed']:
-                key = 'job:%s:tasks:%s' % (job, group)
-                status[group] = self.redis.scard(key)
+                status[group] = int(counts.get(group, 0))
             statuses[job] = status
         return statuses
 
     def pool_status(self):
-        return {'online': self.redis.scard('workers:online'),
-                'available': self.redis.scard('workers:available'),
-                'busy': self.redis.scard('workers:busy')}
+        p = self.redis.pipeline()
+        p.scard('workers:online')
+        p.scard('workers:available')
+        p.scard('workers:busy')
+        p.hgetall('pool:counts')
+        online, available, busy, counts = p.execute()
+        status = {'online': online,
+                  'available': available,
+                  'busy': busy}
+        for group in ['queued', 'pending', 'running', 'completed']:
+            status[group] = int(counts.get(group, 0))
+        return status
 
     def clean(self):
         p = self.redis.pipeline()
@@ -294,16 +1284,15 @@ class Kestrel(object):
         p.execute()
 
     def user_jobs(self, user):
-        jobs = self.redis.smembers('jobs:queued')
-        user_jobs = set()
-        for job in jobs:
-            if self.redis.get('job:%s:owner' % job) == user:
-                user_jobs.add(job)
-        return user_jobs
+        return self.redis.smembers('user:%s:jobs' % user)
 
     def known_worker(self, name):
         return self.redis.sismember('workers:online', name)
 
+    def task_owner(self, job, task):
+        """Return the worker a task is in flight on, or None."""
+        return self.redis.get('job:%s:task:%s' % (job, task))
+
     def online_workers(self):
         return self.redis.smembers('workers:online')
 
@@ -314,18 +1303,195 @@ class Kestrel(object):
         return self.redis.smembers('workers:busy')
 
     def get_jobs(self):
-        jobs = self.redis.smembers('jobs:queued')
-        user_jobs = {}
+        jobs = list(self.redis.smembers('jobs:queued'))
+        p = self.redis.pipeline()
         for job in jobs:
-            user_jobs[job] = self.redis.get('job:%s:owner' % job)
-        return user_jobs
+            p.hget('job:%s' % job, 'owner')
+        return dict(zip(jobs, p.execute()))
+
+    def scan_workers(self, state, cursor=0, count=100):
+        """
+        Return one batch of the workers in a state, to page through
+        a large pool without reading the whole set at once.
+
+        Arguments:
+            state  -- Either 'online', 'available' or 'busy'.
+            cursor -- 0 for the first batch, or the cursor returned
+                      with the previous batch.
+            count  -- The number of workers to aim for in a batch.
+
+        Returns a (cursor, workers) tuple. The cursor is 0 after the
+        last batch.
+        """
+        cursor, workers = self.redis.execute_command(
+                'SSCAN', 'workers:%s' % state, cursor, 'COUNT', count)
+        return int(cursor), sorted(workers)
+
+    def scan_jobs(self, cursor=0, count=100):
+        """
+        Return one batch of the queued jobs along with their owners,
+        in the same way as scan_workers.
+
+        Returns a (cursor, jobs) tuple, where jobs is a list of
+        (job, owner) tuples.
+        """
+        cursor, jobs = self.redis.execute_command(
+                'SSCAN', 'jobs:queued', cursor, 'COUNT', count)
+        jobs = sorted(jobs, key=int)
+        p = self.redis.pipeline()
+        for job in jobs:
+            p.hget('job:%s' % job, 'owner')
+        return int(cursor), list(zip(jobs, p.execute()))
+
+    def count_workers(self, state):
+        return self.redis.scard('workers:%s' % state)
+
+    def count_jobs(self):
+        return self.redis.scard('jobs:queued')
 
     def get_job(self, job):
-        data = {}
+        data = self.redis.hgetall('job:%s' % job)
         data['id'] = job
-        data['owner'] = self.redis.get('job:%s:owner' % job)
-        data['command'] = self.redis.get('job:%s:command' % job)
-        data['cleanup'] = self.redis.get('job:%s:cleanup' % job)
-        data['size'] = self.redis.get('job:%s:size' % job)
-        data['requirements'] = self.redis.smembers('job:%s:requirements' % job)
+        data['requirements'] = signature_requirements(data.get('signature'))
         return data
+
+
+class ScriptedKestrel(Kestrel):
+
+    """
+    A Kestrel backend that performs every task claim, start, finish,
+    reset and timeout, and every worker-offline transition, as a
+    single server side Lua script.
+
+    Each transition costs one round trip and is atomic, so several
+    manager threads can never hand the same task to two workers.
+    The scripts are loaded once when the backend is created.
+
+    The scripts build their key names inside Lua instead of declaring
+    them, so this backend needs a single Redis instance and does not
+    work with Redis Cluster.
+    """
+
+    def __init__(self, redis, pending_lease=15, running_lease=60,
+                 halflife=86400, bundle_target=5):
+        Kestrel.__init__(self, redis, pending_lease, running_lease, halflife,
+                         bundle_target)
+        self.scripts = {}
+        self.load_scripts()
+
+    def load_scripts(self):
+        for name in SCRIPTS:
+            self.scripts[name] = self.redis.execute_command(
+                    'SCRIPT', 'LOAD', SCRIPTS[name])
+
+    def _run(self, name, *args):
+        try:
+            return self.redis.evalsha(self.scripts[name], 0, *args)
+        except NoScriptError:
+            log.debug('SCRIPT: Reloading scripts after Redis restart')
+            self.load_scripts()
+            return self.redis.evalsha(self.scripts[name], 0, *args)
+
+    def worker_available(self, name, slots=None):
+        log.debug('POOL: Worker %s available' % name)
+        now = time.time()
+        result = self._run('worker_available', name,
+                           now + self.pending_lease, now, self.halflife,
+                           self.bundle_target, BUNDLE_LIMIT, slots or '')
+        matches = []
+        for bundle in result:
+            job, tasks = bundle[0], bundle[1:]
+            log.debug('MATCH: Matched worker %s to ' % name + \
+                      'tasks %s,%s' % (job, ','.join(tasks)))
+            matches.append((job, tasks))
+        return matches
+
+    def workers_available(self, workers):
+        log.debug('POOL: %s workers available' % len(workers))
+        now = time.time()
+        args = []
+        for name in sorted(workers):
+            args.extend((name, workers[name] or ''))
+        result = self._run('workers_available',
+                           now + self.pending_lease, now, self.halflife,
+                           self.bundle_target, BUNDLE_LIMIT, *args)
+        matches = []
+        for bundle in result:
+            worker, job, tasks = bundle[0], bundle[1], bundle[2:]
+            log.debug('MATCH: Matched worker %s to ' % worker + \
+                      'tasks %s,%s' % (job, ','.join(tasks)))
+            matches.append((worker, job, tasks))
+        return matches
+
+    def worker_offline(self, name):
+        log.debug('POOL: Worker %s offline' % name)
+        resets = self._run('worker_offline', name)
+        if resets is None:
+            return None
+        reset_tasks = {}
+        for job, task in zip(resets[::2], resets[1::2]):
+            log.debug('RESET: Resetting task %s,%s' % (job, task))
+            if job not in reset_tasks:
+                reset_tasks[job] = set()
+            reset_tasks[job].add(task)
+        return reset_tasks
+
+    def job_matches(self, job):
+        matches = []
+        now = time.time()
+        result = self._run('job_matches', job,
+                           now + self.pending_lease, now, self.halflife,
+                           self.bundle_target, BUNDLE_LIMIT)
+        for bundle in result:
+            worker, tasks = bundle[0], bundle[1:]
+            log.debug('MATCH: Matched worker %s to ' % worker + \
+                      'tasks %s,%s' % (job, ','.join(tasks)))
+            matches.append((worker, tasks))
+        return matches
+
+    def pull_task(self, name, sig):
+        now = time.time()
+        result = self._run('pull_task', name, sig,
+                           now + self.running_lease, now, self.halflife,
+                           self.bundle_target, BUNDLE_LIMIT)
+        if not result:
+            return None
+        job, tasks = result[0], result[1:]
+        log.debug('MATCH: Worker %s pulled ' % name + \
+                  'tasks %s,%s' % (job, ','.join(tasks)))
+        return job, tasks
+
+    def task_start(self, worker, job, task):
+        log.debug('TASK: Task %s,%s started by %s' % (job, task, worker))
+        return bool(self._run('task_start', worker, job, task,
+                              time.time() + self.running_lease))
+
+    def task_hold(self, worker, job, tasks):
+        if not tasks:
+            return []
+        return self._run('task_hold', worker, job,
+                         time.time() + self.pending_lease, *tasks)
+
+    def task_finish(self, worker, job, task):
+        log.debug('TASK: Task %s,%s finished by %s' % (job, task, worker))
+        return bool(self._run('task_finish', worker, job, task))
+
+    def task_reset(self, worker, job, task):
+        log.debug('TASK: Task %s,%s for %s reset.' % (job, task, worker))
+        self._run('task_reset', worker, job, task)
+
+    def task_timeout(self, worker, job, task):
+        outcome = self._run('task_timeout', worker, job, task)
+        if outcome is not None:
+            log.debug('TASK: Task %s,%s timed out on %s, %s' % (
+                job, task, worker, outcome))
+        return outcome
+
+    def worker_heartbeat(self, name):
+        self._run('worker_heartbeat', name, time.time() + self.running_lease)
+
+    def expire_leases(self):
+        resets = self._run('expire_leases', time.time())
+        for job, task in zip(resets[::2], resets[1::2]):
+            log.debug('LEASE: Lease for task %s,%s expired' % (job, task))
+        return set(resets[::2])
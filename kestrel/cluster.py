@@ -0,0 +1,173 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from kestrel.connection import blocking_client
+
+
+log = logging.getLogger(__name__)
+
+
+# Take the leader lease if it is free, or renew it if we hold it.
+LEADER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Give up the leader lease if we hold it.
+RESIGN = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def ring_hash(key):
+    """Return the position of a key on the hash ring."""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class Cluster(object):
+
+    """
+    Membership, leadership and worker partitioning for several
+    manager components sharing one Redis server.
+
+    Every manager renews a membership lease on each heartbeat, and a
+    manager whose lease runs out is dropped by the others. Workers are
+    split between the live managers by consistent hashing of their
+    JIDs, so that only the workers of a manager that joins or leaves
+    change hands. One manager at a time holds the leader lease and
+    runs the sweeps that cover the whole pool.
+
+    Redis keys:
+        managers          -- sorted set of live managers, scored by the
+                             time their membership lease expires
+        managers:leader   -- the manager holding the leader lease,
+                             expiring along with the lease
+        manager:[name]    -- pub/sub channel of messages for a manager
+    """
+
+    def __init__(self, redis, name, lease=15, replicas=64):
+        """
+        Arguments:
+            redis    -- A Redis connection.
+            name     -- The name of this manager instance.
+            lease    -- The number of seconds a membership or leader
+                        lease lasts without being renewed.
+            replicas -- The number of points each manager takes on
+                        the hash ring.
+        """
+        self.redis = redis
+        self.name = name
+        self.lease = lease
+        self.replicas = replicas
+
+        self.members = []
+        self.ring = []
+        self.points = []
+        self.leader = False
+        self.lock = threading.Lock()
+
+    def heartbeat(self):
+        """
+        Renew our membership and try to take or renew the leader
+        lease, dropping managers whose leases have run out.
+
+        Returns True if the set of live managers changed.
+        """
+        now = time.time()
+        p = self.redis.pipeline()
+        p.execute_command('ZADD', 'managers', now + self.lease, self.name)
+        p.zremrangebyscore('managers', '-inf', now)
+        p.zrange('managers', 0, -1)
+        members = sorted(p.execute()[-1])
+
+        leader = bool(self.redis.eval(LEADER, 1, 'managers:leader',
+                                      self.name, int(self.lease * 1000)))
+        if leader != self.leader:
+            log.info('CLUSTER: %s leader' % (
+                'Became' if leader else 'No longer'))
+        self.leader = leader
+
+        with self.lock:
+            if members == self.members:
+                return False
+            log.info('CLUSTER: Managers are now %s' % ', '.join(members))
+            self.members = members
+            self.ring = sorted((ring_hash('%s:%s' % (member, i)), member)
+                               for member in members
+                               for i in range(self.replicas))
+            self.points = [point for point, member in self.ring]
+            return True
+
+    def leave(self):
+        """Give up our membership and any leader lease."""
+        self.redis.zrem('managers', self.name)
+        self.redis.eval(RESIGN, 1, 'managers:leader', self.name)
+        self.leader = False
+
+    def owner(self, worker):
+        """Return the name of the manager whose partition a worker is in."""
+        with self.lock:
+            if not self.ring:
+                return self.name
+            i = bisect.bisect(self.points, ring_hash(worker))
+            return self.ring[i % len(self.ring)][1]
+
+    def owns(self, worker):
+        """Return True if a worker is in our partition."""
+        return self.owner(worker) == self.name
+
+    def publish(self, member, message):
+        """
+        Send a message to another manager.
+
+        Arguments:
+            member  -- The name of the receiving manager.
+            message -- A JSON serializable dictionary.
+
+        Returns True if the manager was listening for messages.
+        """
+        return bool(self.redis.publish('manager:%s' % member,
+                                       json.dumps(message)))
+
+    def listen(self, handler):
+        """
+        Pass every message sent to this manager to a handler, from a
+        thread of its own.
+        """
+        def process():
+            # The subscription holds its connection for good, so it
+            # does not take one from the shared pool.
+            pubsub = blocking_client(self.redis).pubsub()
+            pubsub.subscribe('manager:%s' % self.name)
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+                try:
+                    handler(json.loads(message['data']))
+                except:
+                    log.exception('CLUSTER: Error handling message')
+
+        t = threading.Thread(name='Kestrel Cluster', target=process)
+        t.daemon = True
+        t.start()
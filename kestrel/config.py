@@ -1,4 +1,5 @@
 import os
+import multiprocessing
 import sleekxmpp
 from sleekxmpp.xmlstream import ElementBase, ET, register_stanza_plugin
 
@@ -23,9 +24,124 @@ class WorkerConfig(ElementBase):
     name = 'worker'
     namespace = 'kestrel:config'
     plugin_attrib = name
-    interfaces = set(('manager', 'features'))
+    interfaces = set(('manager', 'features', 'heartbeat', 'slots',
+                      'prefetch', 'pull', 'output_dir', 'output_limit',
+                      'output_backups', 'output_return', 'output_tail',
+                      'output_keep', 'runners', 'runner_tasks',
+                      'runner_growth', 'runner_python', 'runner_entries',
+                      'walltime', 'walltime_grace', 'running_lease',
+                      'usage_halflife', 'bundle_target'))
     sub_interfaces = interfaces
 
+    # Pull mode workers claim tasks themselves, so the lease, usage
+    # and bundle settings must match those of the manager.
+
+    def get_running_lease(self):
+        lease = self._get_sub_text('running_lease')
+        if lease:
+            return int(lease)
+        return 60
+
+    def get_usage_halflife(self):
+        halflife = self._get_sub_text('usage_halflife')
+        if halflife:
+            return int(halflife)
+        return 86400
+
+    def get_bundle_target(self):
+        target = self._get_sub_text('bundle_target')
+        if target:
+            return float(target)
+        return 5
+
+    def get_output_limit(self):
+        limit = self._get_sub_text('output_limit')
+        if limit:
+            return int(limit)
+        return 10485760
+
+    def get_output_backups(self):
+        backups = self._get_sub_text('output_backups')
+        if backups:
+            return int(backups)
+        return 1
+
+    def get_output_return(self):
+        return self._get_sub_text('output_return') or 'tail'
+
+    def get_output_tail(self):
+        tail = self._get_sub_text('output_tail')
+        if tail:
+            return int(tail)
+        return 4096
+
+    def get_output_keep(self):
+        keep = self._get_sub_text('output_keep')
+        return keep.lower() in ('true', 'yes', '1')
+
+    def get_runners(self):
+        runners = self._get_sub_text('runners')
+        if runners:
+            return int(runners)
+        return self['slots']
+
+    def get_runner_tasks(self):
+        tasks = self._get_sub_text('runner_tasks')
+        if tasks:
+            return int(tasks)
+        return 100
+
+    def get_runner_growth(self):
+        growth = self._get_sub_text('runner_growth')
+        if growth:
+            return int(growth)
+        return 262144
+
+    def get_runner_entries(self):
+        entries = []
+        items = self.findall('{%s}runner_entry' % self.namespace)
+        if items is not None:
+            for item in items:
+                entries.append(item.text)
+        return entries
+
+    def get_walltime(self):
+        walltime = self._get_sub_text('walltime')
+        if walltime:
+            return float(walltime)
+        return 0
+
+    def get_walltime_grace(self):
+        grace = self._get_sub_text('walltime_grace')
+        if grace:
+            return float(grace)
+        return 10
+
+    def get_pull(self):
+        pull = self._get_sub_text('pull')
+        return pull.lower() in ('true', 'yes', '1')
+
+    def get_slots(self):
+        slots = self._get_sub_text('slots')
+        if slots:
+            return int(slots)
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    def get_prefetch(self):
+        prefetch = self._get_sub_text('prefetch')
+        if prefetch:
+            return int(prefetch)
+        return 0
+
+    def get_heartbeat(self):
+        heartbeat = self._get_sub_text('heartbeat')
+        if heartbeat:
+            return int(heartbeat)
+        return 20
+
     def get_features(self):
         features = set()
         items = self.findall('{%s}feature' % self.namespace)
@@ -40,9 +156,87 @@ class ManagerConfig(ElementBase):
     name = 'manager'
     namespace = 'kestrel:config'
     plugin_attrib = name
-    interfaces = set(('pool', 'jobs'))
+    interfaces = set(('pool', 'jobs', 'pending_lease', 'running_lease',
+                      'backend', 'journal', 'usage_halflife',
+                      'bundle_target', 'cluster', 'instance',
+                      'cluster_lease', 'handler_threads',
+                      'handler_queue', 'presence_window', 'disco_page',
+                      'disco_cache', 'output_dir', 'output_limit'))
     sub_interfaces = interfaces
 
+    def get_backend(self):
+        return self._get_sub_text('backend') or 'redis'
+
+    def get_pending_lease(self):
+        lease = self._get_sub_text('pending_lease')
+        if lease:
+            return int(lease)
+        return 15
+
+    def get_running_lease(self):
+        lease = self._get_sub_text('running_lease')
+        if lease:
+            return int(lease)
+        return 60
+
+    def get_usage_halflife(self):
+        halflife = self._get_sub_text('usage_halflife')
+        if halflife:
+            return int(halflife)
+        return 86400
+
+    def get_bundle_target(self):
+        target = self._get_sub_text('bundle_target')
+        if target:
+            return float(target)
+        return 5
+
+    def get_cluster(self):
+        cluster = self._get_sub_text('cluster')
+        return cluster.lower() in ('true', 'yes', '1')
+
+    def get_cluster_lease(self):
+        lease = self._get_sub_text('cluster_lease')
+        if lease:
+            return int(lease)
+        return 15
+
+    def get_handler_threads(self):
+        threads = self._get_sub_text('handler_threads')
+        if threads:
+            return int(threads)
+        return 8
+
+    def get_handler_queue(self):
+        size = self._get_sub_text('handler_queue')
+        if size:
+            return int(size)
+        return 1000
+
+    def get_presence_window(self):
+        window = self._get_sub_text('presence_window')
+        if window:
+            return float(window)
+        return 0.005
+
+    def get_disco_page(self):
+        page = self._get_sub_text('disco_page')
+        if page:
+            return int(page)
+        return 100
+
+    def get_disco_cache(self):
+        cache = self._get_sub_text('disco_cache')
+        if cache:
+            return float(cache)
+        return 5
+
+    def get_output_limit(self):
+        limit = self._get_sub_text('output_limit')
+        if limit:
+            return int(limit)
+        return 10485760
+
 
 class ClientConfig(ElementBase):
 
@@ -58,7 +252,8 @@ class RedisConfig(ElementBase):
     name = 'redis'
     namespace = 'kestrel:config'
     plugin_attrib = name
-    interfaces = set(('host', 'port', 'database'))
+    interfaces = set(('host', 'port', 'database', 'scripts', 'socket',
+                      'keepalive', 'max_connections'))
     sub_interfaces = interfaces
 
     def get_port(self):
@@ -67,6 +262,26 @@ class RedisConfig(ElementBase):
             return int(port)
         return 6379
 
+    def get_database(self):
+        database = self._get_sub_text('database')
+        if database:
+            return int(database)
+        return 0
+
+    def get_scripts(self):
+        scripts = self._get_sub_text('scripts')
+        return scripts.lower() in ('true', 'yes', '1')
+
+    def get_keepalive(self):
+        keepalive = self._get_sub_text('keepalive')
+        return keepalive.lower() in ('true', 'yes', '1')
+
+    def get_max_connections(self):
+        max_connections = self._get_sub_text('max_connections')
+        if max_connections:
+            return int(max_connections)
+        return None
+
 register_stanza_plugin(Config, WorkerConfig)
 register_stanza_plugin(Config, ManagerConfig)
 register_stanza_plugin(Config, ClientConfig)
@@ -74,6 +289,7 @@ register_stanza_plugin(WorkerConfig, XMPPConfig)
 register_stanza_plugin(ManagerConfig, XMPPConfig)
 register_stanza_plugin(ClientConfig, XMPPConfig)
 register_stanza_plugin(ManagerConfig, RedisConfig)
+register_stanza_plugin(WorkerConfig, RedisConfig)
 
 
 def load_config(file_name):
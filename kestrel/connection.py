@@ -0,0 +1,79 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import redis
+
+
+def connection_pool(host='localhost', port=6379, db=0, path=None,
+                    keepalive=False, max_connections=None):
+    """
+    Create a Redis connection pool that can be shared by every plugin
+    of a component.
+
+    TCP connections always have Nagle's algorithm disabled, since the
+    Redis client sets TCP_NODELAY itself.
+
+    Arguments:
+        host            -- The Redis server's host name.
+        port            -- The Redis server's TCP port.
+        db              -- The Redis database number.
+        path            -- The path to a unix domain socket. When given,
+                           host, port and keepalive are ignored.
+        keepalive       -- Enable TCP keepalive probes.
+        max_connections -- Limit the number of open connections. Callers
+                           wait for a free connection once it is reached.
+                           Blocking commands and subscriptions should use
+                           blocking_client() instead, so that they do not
+                           hold connections from this limit.
+    """
+    if path:
+        kwargs = {'connection_class': redis.UnixDomainSocketConnection,
+                  'path': path,
+                  'db': db}
+    else:
+        kwargs = {'host': host,
+                  'port': port,
+                  'db': db,
+                  'socket_keepalive': keepalive}
+    if max_connections:
+        return redis.BlockingConnectionPool(max_connections=max_connections,
+                                            **kwargs)
+    return redis.ConnectionPool(**kwargs)
+
+
+def connect(config):
+    """
+    Return a Redis client for a plugin, using the shared connection
+    pool in the plugin's config when one is given.
+
+    Arguments:
+        config -- A plugin config dictionary, with either a 'pool'
+                  entry or 'host', 'port' and 'db' entries.
+    """
+    if config.get('pool', None) is not None:
+        return redis.Redis(connection_pool=config['pool'])
+    return redis.Redis(host=config.get('host', 'localhost'),
+                       port=config.get('port', 6379),
+                       db=config.get('db', 0))
+
+
+def blocking_client(client):
+    """
+    Return a Redis client for blocking commands, such as BLPOP, and
+    subscriptions, which hold their connection for as long as they
+    wait. It connects to the same server as the given client, with a
+    connection pool of its own, so waiting consumers never use up the
+    connections of a shared pool.
+
+    Arguments:
+        client -- The Redis client to copy the connection settings of.
+    """
+    pool = client.connection_pool
+    return redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=pool.connection_class,
+            **pool.connection_kwargs))
@@ -0,0 +1,132 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import logging
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+log = logging.getLogger(__name__)
+
+
+class HandlerPool(object):
+
+    """
+    Run event handlers on a fixed number of threads.
+
+    Every call is made with a key, such as a worker's JID, and calls
+    with the same key always run on the same thread, in the order they
+    were submitted. Calls with different keys may run in parallel.
+
+    Each thread's queue is bounded. Submitting to a full queue blocks
+    until the thread catches up, which slows down whoever is raising
+    events instead of letting the backlog grow without limit. Calls
+    submitted by the handlers themselves are always queued without
+    waiting, since a pool thread blocked on a full queue could be the
+    one that has to drain it.
+    """
+
+    def __init__(self, threads=8, size=1000, name='Kestrel Handler'):
+        """
+        Arguments:
+            threads -- The number of handler threads.
+            size    -- The number of calls each thread may have
+                       waiting before submitting more blocks.
+            name    -- The prefix of the threads' names.
+        """
+        self.size = size
+        self.stopped = False
+        self.queues = []
+        self.threads = []
+        self.space = []
+        for i in range(max(threads, 1)):
+            # The queues themselves are unbounded so that handlers
+            # can always submit; outside callers wait for space.
+            q = queue.Queue()
+            t = threading.Thread(name='%s %s' % (name, i),
+                                 target=self._process,
+                                 args=(i,))
+            t.daemon = True
+            self.queues.append(q)
+            self.threads.append(t)
+            self.space.append(threading.Condition())
+        self.pool_threads = set(self.threads)
+        for t in self.threads:
+            t.start()
+
+    def submit(self, key, func, *args):
+        """
+        Run a function on the thread serving a key.
+
+        Arguments:
+            key  -- A string identifying what the call is about.
+            func -- The function to call.
+            args -- Arguments to pass to the function.
+        """
+        if self.stopped:
+            log.debug('POOL: Dropped %s, the pool is stopped' % (
+                func.__name__))
+            return
+        i = zlib.crc32(key.encode('utf-8')) % len(self.queues)
+        q = self.queues[i]
+        if threading.current_thread() in self.pool_threads:
+            q.put((func, args))
+            return
+        with self.space[i]:
+            if q.qsize() >= self.size:
+                log.debug('POOL: Handler queue %s full, waiting' % i)
+            while q.qsize() >= self.size and not self.stopped:
+                self.space[i].wait(1)
+            q.put((func, args))
+
+    def wrap(self, func, key):
+        """
+        Return an event handler that runs a function in the pool.
+
+        Arguments:
+            func -- The event handler to wrap.
+            key  -- A function returning the key of an event's data.
+        """
+        def handler(data):
+            self.submit(str(key(data)), func, data)
+        return handler
+
+    def depth(self):
+        """Return the number of calls waiting to run."""
+        return sum(q.qsize() for q in self.queues)
+
+    def stop(self):
+        """Let the threads exit once their queues are drained."""
+        if self.stopped:
+            return
+        self.stopped = True
+        for q, space in zip(self.queues, self.space):
+            q.put(None)
+            with space:
+                space.notify_all()
+
+    def _process(self, i):
+        q, space = self.queues[i], self.space[i]
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            with space:
+                space.notify()
+            self._call(*item)
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except:
+            log.exception('POOL: Error in handler %s' % func.__name__)
@@ -12,6 +12,8 @@ import random
 import sleekxmpp
 from sleekxmpp.xmlstream import JID
 
+from kestrel.connection import connection_pool
+
 
 class Manager(sleekxmpp.ComponentXMPP):
 
@@ -20,34 +22,59 @@ class Manager(sleekxmpp.ComponentXMPP):
 
         self.config = config
 
-        self.redis_config = {
-                'host': self.config['redis']['host'],
-                'port': self.config['redis']['port'],
-                'db': self.config['redis']['database']}
-
         self.register_plugin('xep_0030')
+        self.register_plugin('xep_0059')
         self.register_plugin('xep_0092')
         self.register_plugin('xep_0004',
                              module='kestrel.plugins.xep_0004')
         self.register_plugin('xep_0050', {'threaded': False})
         self.register_plugin('xep_0199',
                              {'keepalive': False})
-        self.register_plugin('redis_queue',
-                             self.redis_config,
-                             module='kestrel.plugins.redis_queue')
-        self.register_plugin('redis_id',
-                             self.redis_config,
-                             module='kestrel.plugins.redis_id')
-        self.register_plugin('redis_adhoc',
-                             self.redis_config,
-                             module='kestrel.plugins.redis_adhoc')
-        self.register_plugin('redis_roster',
-                             self.redis_config,
-                             module='kestrel.plugins.redis_roster')
+        if self.config['backend'] == 'redis':
+            # A single connection pool is shared by every Redis
+            # plugin instead of each opening its own connections.
+            self.redis_pool = connection_pool(
+                    host=self.config['redis']['host'] or 'localhost',
+                    port=self.config['redis']['port'],
+                    db=self.config['redis']['database'],
+                    path=self.config['redis']['socket'] or None,
+                    keepalive=self.config['redis']['keepalive'],
+                    max_connections=self.config['redis']['max_connections'])
+            self.redis_config = {'pool': self.redis_pool}
+
+            self.register_plugin('redis_queue',
+                                 self.redis_config,
+                                 module='kestrel.plugins.redis_queue')
+            self.register_plugin('redis_id',
+                                 self.redis_config,
+                                 module='kestrel.plugins.redis_id')
+            self.register_plugin('redis_adhoc',
+                                 self.redis_config,
+                                 module='kestrel.plugins.redis_adhoc')
+            self.register_plugin('redis_roster',
+                                 self.redis_config,
+                                 module='kestrel.plugins.redis_roster')
         self.register_plugin(
                 'kestrel_manager',
                 {'pool_jid': JID(self.config['pool']),
-                 'job_jid': JID(self.config['jobs'])},
+                 'job_jid': JID(self.config['jobs']),
+                 'backend': self.config['backend'],
+                 'journal': self.config['journal'] or None,
+                 'scripted': self.config['redis']['scripts'],
+                 'pending_lease': self.config['pending_lease'],
+                 'running_lease': self.config['running_lease'],
+                 'usage_halflife': self.config['usage_halflife'],
+                 'bundle_target': self.config['bundle_target'],
+                 'cluster': self.config['cluster'],
+                 'instance': self.config['instance'] or None,
+                 'cluster_lease': self.config['cluster_lease'],
+                 'handler_threads': self.config['handler_threads'],
+                 'handler_queue': self.config['handler_queue'],
+                 'presence_window': self.config['presence_window'],
+                 'disco_page': self.config['disco_page'],
+                 'disco_cache': self.config['disco_cache'],
+                 'output_dir': self.config['output_dir'] or None,
+                 'output_limit': self.config['output_limit']},
                 module='kestrel.plugins.kestrel_manager')
 
         self.add_event_handler("session_start", self.start)
@@ -0,0 +1,878 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import heapq
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+
+from kestrel.backend import canonical, signature, signature_requirements, \
+                            job_rank, bundle_size, resource_counts, \
+                            resource_summary
+
+
+log = logging.getLogger(__name__)
+
+
+def _plain(value):
+    """Convert a method argument into a JSON friendly value."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (set, frozenset, list, tuple)):
+        return sorted([_plain(item) for item in value])
+    if isinstance(value, dict):
+        return dict((str(key), _plain(item)) for key, item in value.items())
+    return str(value)
+
+
+def journaled(func):
+    """
+    Decorate a MemoryKestrel method that changes state so that the
+    call is recorded in the journal before it is applied.
+    """
+    def wrapper(self, *args, **kwargs):
+        args = [_plain(arg) for arg in args]
+        kwargs = dict((name, _plain(arg)) for name, arg in kwargs.items())
+        with self.lock:
+            if not self.replaying:
+                self.now = time.time()
+                self._journal(func.__name__, args, kwargs)
+            return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def locked(func):
+    """Decorate a MemoryKestrel method that only reads state."""
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class MemoryKestrel(object):
+
+    """
+    An in-process Kestrel backend with the same public interface as
+    kestrel.backend.Kestrel, using native Python sets and dicts
+    instead of a Redis server.
+
+    Every call that changes state may be appended to a journal file.
+    On start up the latest snapshot and the journal are replayed to
+    recover the previous state, and then compacted into a new
+    snapshot. All choices made while matching are deterministic so
+    that a replay always reaches the same state.
+
+    Jobs are chosen, and tasks bundled, in the same way as in
+    kestrel.backend.Kestrel.
+    """
+
+    def __init__(self, path=None, pending_lease=15, running_lease=60,
+                 halflife=86400, compact_every=100000, bundle_target=5):
+        self.path = path
+        self.pending_lease = pending_lease
+        self.running_lease = running_lease
+        self.halflife = halflife
+        self.bundle_target = bundle_target
+        self.compact_every = compact_every
+
+        self.lock = threading.RLock()
+        self.replaying = False
+        self.journal = None
+        self.journal_size = 0
+        self.now = None
+
+        self.state = self._empty_state()
+        if self.path:
+            self._recover()
+
+    def _empty_state(self):
+        return {'next_id': 0,
+                'online': set(),
+                'available': set(),
+                'busy': set(),
+                'capabilities': set(),
+                # worker -> {'caps': set, 'signatures': set, 'tasks': set,
+                #            'slots': int, 'bundles': {bundle: tasks},
+                #            'task_bundles': {task: bundle}}
+                'workers': {},
+                # capability -> {'workers': set, 'signatures': set}
+                'caps': {},
+                # signature -> {'jobs': set, 'workers': set}
+                'signatures': {},
+                # job -> owner, command, cleanup, size, priority, bundle,
+                #        walltime, retries and signature
+                'jobs': {},
+                # job -> [seconds, tasks] of observed run times
+                'runtime': {},
+                # job -> {'totals': dict, 'wall': dict, 'maxrss': dict}
+                #        of the resources used by finished tasks
+                'resources': {},
+                # job -> task -> number of times it ran out of time
+                'timeouts': {},
+                # job -> next, requeued, pending, running, done, owners
+                'tasks': {},
+                'counts': {},
+                'pool': self._empty_counts(),
+                'queued': set(),
+                'completed': set(),
+                'users': {},
+                # "job,task" -> lease expiry time
+                'leases': {},
+                'lease_heap': [],
+                # owner -> decayed usage
+                'usage': {},
+                'usage_epoch': None,
+                # signature -> owner -> heap of (job_rank, job)
+                'run_queues': {},
+                # signature -> heap of (usage, owner) for the owners
+                # with a run queue, of which only the entries matching
+                # the owner's current usage count
+                'owner_heaps': {},
+                # owner -> signatures the owner has a run queue in
+                'owner_queues': {},
+                # jobs with queued tasks that are in a run queue
+                'runnable': set()}
+
+    def _empty_counts(self):
+        return {'queued': 0, 'pending': 0, 'running': 0, 'completed': 0}
+
+    # ------------------------------------------------------------------
+    # Journal and snapshots
+
+    def _journal(self, name, args, kwargs=None):
+        if self.journal is None:
+            return
+        entry = {'t': self.now, 'm': name, 'a': args}
+        if kwargs:
+            entry['k'] = kwargs
+        self.journal.write(json.dumps(entry))
+        self.journal.write('\n')
+        self.journal.flush()
+        self.journal_size += 1
+        if self.journal_size >= self.compact_every:
+            self.compact()
+
+    def _recover(self):
+        snapshot = self.path + '.snapshot'
+        if os.path.exists(snapshot):
+            with open(snapshot, 'rb') as data:
+                self.state = pickle.load(data)
+        if os.path.exists(self.path):
+            log.info('MEMORY: Replaying journal %s' % self.path)
+            self.replaying = True
+            try:
+                with open(self.path, 'r') as journal:
+                    for line in journal:
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            log.error('MEMORY: Ignoring truncated entry')
+                            break
+                        self.now = entry['t']
+                        getattr(self, entry['m'])(*entry['a'],
+                                                  **entry.get('k', {}))
+            finally:
+                self.replaying = False
+                self.now = None
+        self.compact()
+
+    def compact(self):
+        """
+        Write the current state as a snapshot and start a new,
+        empty journal.
+        """
+        with self.lock:
+            if not self.path:
+                return
+            snapshot = self.path + '.snapshot'
+            with open(snapshot + '.tmp', 'wb') as data:
+                pickle.dump(self.state, data, pickle.HIGHEST_PROTOCOL)
+            os.rename(snapshot + '.tmp', snapshot)
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.path, 'w')
+            self.journal_size = 0
+
+    # ------------------------------------------------------------------
+    # Helpers
+
+    def _count(self, job, **deltas):
+        counts = self.state['counts'].setdefault(job, self._empty_counts())
+        for field, delta in deltas.items():
+            counts[field] += delta
+            self.state['pool'][field] += delta
+
+    def _lease(self, item, length):
+        expires = self.now + length
+        self.state['leases'][item] = expires
+        heapq.heappush(self.state['lease_heap'], (expires, item))
+
+    def _enqueue(self, job):
+        if job in self.state['runnable']:
+            return
+        data = self.state['jobs'][job]
+        sig, owner = data['signature'], data['owner']
+        queues = self.state['run_queues'].setdefault(sig, {})
+        if owner not in queues:
+            queues[owner] = []
+            self.state['owner_queues'].setdefault(owner, set()).add(sig)
+            heapq.heappush(self.state['owner_heaps'].setdefault(sig, []),
+                           (self.state['usage'].get(owner, 0), owner))
+        heapq.heappush(queues[owner],
+                       (job_rank(job, data.get('priority')), job))
+        self.state['runnable'].add(job)
+
+    def _dequeue(self, job):
+        # The heap entry is dropped once it reaches the head.
+        self.state['runnable'].discard(job)
+
+    def _queue_head(self, sig, owner):
+        queue = self.state['run_queues'][sig][owner]
+        while queue and queue[0][1] not in self.state['runnable']:
+            heapq.heappop(queue)
+        if not queue:
+            del self.state['run_queues'][sig][owner]
+            self.state['owner_queues'][owner].discard(sig)
+            if not self.state['owner_queues'][owner]:
+                del self.state['owner_queues'][owner]
+            return None
+        return queue[0]
+
+    def _owner_head(self, sig):
+        """
+        Return the (usage, owner, head) tuple of the owner with the
+        least usage among those with queued jobs in a signature, where
+        head is the owner's first (job_rank, job) entry, or None.
+        """
+        heap = self.state['owner_heaps'].get(sig)
+        queues = self.state['run_queues'].get(sig, {})
+        if heap and len(heap) > 2 * len(queues) + 16:
+            # Drop the entries left behind by earlier charges.
+            heap = [(self.state['usage'].get(owner, 0), owner)
+                    for owner in queues]
+            heapq.heapify(heap)
+            self.state['owner_heaps'][sig] = heap
+        while heap:
+            usage, owner = heap[0]
+            if owner in queues and \
+               self.state['usage'].get(owner, 0) == usage:
+                head = self._queue_head(sig, owner)
+                if head is not None:
+                    return usage, owner, head
+            heapq.heappop(heap)
+        return None
+
+    def _index_owners(self):
+        """Rebuild the owner heaps of every signature from the run queues."""
+        self.state['owner_heaps'] = {}
+        self.state['owner_queues'] = {}
+        for sig, queues in self.state['run_queues'].items():
+            heap = [(self.state['usage'].get(owner, 0), owner)
+                    for owner in queues]
+            heapq.heapify(heap)
+            self.state['owner_heaps'][sig] = heap
+            for owner in queues:
+                self.state['owner_queues'].setdefault(owner, set()).add(sig)
+
+    def _next_job(self, name):
+        best = None
+        for sig in self.state['workers'][name]['signatures']:
+            head = self._owner_head(sig)
+            if head is None:
+                continue
+            usage, owner, (rank, job) = head
+            if best is None or (usage, owner, rank) < best[0]:
+                best = ((usage, owner, rank), job)
+        if best is None:
+            return None
+        return best[1]
+
+    def _charge(self, owner):
+        if self.state['usage_epoch'] is None:
+            self.state['usage_epoch'] = self.now
+        exponent = (self.now - self.state['usage_epoch']) / float(self.halflife)
+        if exponent > 32:
+            log.debug('USAGE: Rescaling owner usage')
+            for user in self.state['usage']:
+                self.state['usage'][user] *= 2 ** -exponent
+            self.state['usage_epoch'] = self.now
+            self._index_owners()
+            exponent = 0
+        usage = self.state['usage'].get(owner, 0) + 2 ** exponent
+        self.state['usage'][owner] = usage
+        for sig in self.state['owner_queues'].get(owner, ()):
+            heapq.heappush(self.state['owner_heaps'][sig], (usage, owner))
+
+    def _claim_bundle(self, job, worker):
+        data = self.state['jobs'][job]
+        seconds, observed = self.state['runtime'].get(job, (0, 0))
+        size = bundle_size(data.get('bundle'), seconds, observed,
+                           self.bundle_target)
+        tasks = []
+        bundle = None
+        while len(tasks) < size:
+            task = self._claim_task(job, worker, bundle)
+            if task is None:
+                break
+            if bundle is None:
+                bundle = '%s,%s' % (job, task)
+            tasks.append(task)
+        return tasks
+
+    def _claim_task(self, job, worker, bundle=None):
+        tasks = self.state['tasks'].get(job)
+        if tasks is None:
+            return None
+        if tasks['requeued']:
+            task = heapq.heappop(tasks['requeued'])
+        elif tasks['next'] < tasks['size']:
+            task = tasks['next']
+            tasks['next'] += 1
+        else:
+            return None
+        task = str(task)
+        item = '%s,%s' % (job, task)
+        tasks['pending'].add(task)
+        tasks['owners'][task] = worker
+        bundle = bundle or item
+        bundles = self.state['workers'][worker]['bundles']
+        bundles[bundle] = bundles.get(bundle, 0) + 1
+        self.state['workers'][worker]['task_bundles'][item] = bundle
+        self.state['workers'][worker]['tasks'].add(item)
+        self._lease(item, self.pending_lease)
+        self._count(job, queued=-1, pending=1)
+        self._charge(self.state['jobs'][job]['owner'])
+        if not self.state['counts'][job]['queued']:
+            self._dequeue(job)
+        return task
+
+    def _release(self, worker, item):
+        worker = self.state['workers'][worker]
+        worker['tasks'].discard(item)
+        bundle = worker['task_bundles'].pop(item, None)
+        if bundle is None:
+            return
+        worker['bundles'][bundle] -= 1
+        if worker['bundles'][bundle] <= 0:
+            del worker['bundles'][bundle]
+
+    def _requeue(self, worker, job, task):
+        tasks = self.state['tasks'].get(job)
+        item = '%s,%s' % (job, task)
+        self.state['leases'].pop(item, None)
+        if worker in self.state['workers']:
+            self._release(worker, item)
+        if tasks is None:
+            return
+        tasks['owners'].pop(task, None)
+        if task in tasks['pending']:
+            tasks['pending'].discard(task)
+            self._count(job, pending=-1, queued=1)
+        elif task in tasks['running']:
+            tasks['running'].discard(task)
+            self._count(job, running=-1, queued=1)
+        else:
+            return
+        heapq.heappush(tasks['requeued'], int(task))
+        if job in self.state['queued']:
+            self._enqueue(job)
+
+    def _owns(self, worker, job, task):
+        """
+        Return True if a task is in flight on a worker, and not
+        cancelled, requeued or reported since it was given out.
+        """
+        tasks = self.state['tasks'].get(job)
+        return tasks is not None and tasks['owners'].get(task) == worker
+
+    # ------------------------------------------------------------------
+    # Backend interface
+
+    @journaled
+    def job_id(self):
+        self.state['next_id'] += 1
+        return str(self.state['next_id'])
+
+    @journaled
+    def register_worker(self, name, capabilities):
+        log.debug('POOL: Register %s' % name)
+        capabilities = set(canonical(capabilities))
+        worker = self.state['workers'].setdefault(
+                name, {'caps': set(), 'signatures': set(), 'tasks': set(),
+                       'slots': 1, 'bundles': {}, 'task_bundles': {}})
+        worker['caps'].update(capabilities)
+        self.state['capabilities'].update(capabilities)
+        for cap in capabilities:
+            self.state['caps'].setdefault(
+                    cap, {'workers': set(), 'signatures': set()})
+            self.state['caps'][cap]['workers'].add(name)
+        for sig in self.state['signatures']:
+            if signature_requirements(sig).issubset(worker['caps']):
+                worker['signatures'].add(sig)
+                self.state['signatures'][sig]['workers'].add(name)
+        self.state['online'].add(name)
+
+    def _index_signature(self, sig):
+        if sig in self.state['signatures']:
+            return
+        reqs = signature_requirements(sig)
+        entry = {'jobs': set(), 'workers': set()}
+        self.state['signatures'][sig] = entry
+        for req in reqs:
+            self.state['caps'].setdefault(
+                    req, {'workers': set(), 'signatures': set()})
+            self.state['caps'][req]['signatures'].add(sig)
+        for name in self.state['online']:
+            if reqs.issubset(self.state['workers'][name]['caps']):
+                entry['workers'].add(name)
+                self.state['workers'][name]['signatures'].add(sig)
+
+    @locked
+    def worker_jobs(self, name):
+        jobs = set()
+        worker = self.state['workers'].get(name)
+        if worker:
+            for sig in worker['signatures']:
+                jobs.update(self.state['signatures'][sig]['jobs'])
+        return jobs
+
+    @locked
+    def worker_capabilities(self, name):
+        worker = self.state['workers'].get(name)
+        return set(worker['caps']) if worker else set()
+
+    def _free_slots(self, name):
+        worker = self.state['workers'][name]
+        return worker.get('slots', 1) - len(worker['bundles'])
+
+    @journaled
+    def worker_available(self, name, slots=None):
+        log.debug('POOL: Worker %s available' % name)
+        matches = []
+        if name not in self.state['online']:
+            return matches
+        self.state['busy'].discard(name)
+        self.state['available'].add(name)
+        if slots:
+            self.state['workers'][name]['slots'] = int(slots)
+        free = self._free_slots(name)
+        while len(matches) < free:
+            job = self._next_job(name)
+            if job is None:
+                break
+            tasks = self._claim_bundle(job, name)
+            if not tasks:
+                self._dequeue(job)
+                continue
+            log.debug('MATCH: Matched worker %s to ' % name + \
+                      'tasks %s,%s' % (job, ','.join(tasks)))
+            matches.append((job, tasks))
+        return matches
+
+    @journaled
+    def workers_available(self, workers):
+        log.debug('POOL: %s workers available' % len(workers))
+        names = [name for name in sorted(workers)
+                 if name in self.state['online']]
+        for name in names:
+            self.state['busy'].discard(name)
+            self.state['available'].add(name)
+            if workers[name]:
+                self.state['workers'][name]['slots'] = int(workers[name])
+
+        free = dict((name, self._free_slots(name)) for name in names)
+        waiting = [name for name in names if free[name] > 0]
+        matches = []
+        while waiting:
+            for name in list(waiting):
+                tasks = None
+                job = self._next_job(name)
+                while job is not None:
+                    tasks = self._claim_bundle(job, name)
+                    if tasks:
+                        break
+                    self._dequeue(job)
+                    job = self._next_job(name)
+                if not tasks:
+                    waiting.remove(name)
+                    continue
+                log.debug('MATCH: Matched worker %s to ' % name + \
+                          'tasks %s,%s' % (job, ','.join(tasks)))
+                matches.append((name, job, tasks))
+                free[name] -= 1
+                if free[name] <= 0:
+                    waiting.remove(name)
+        return matches
+
+    @journaled
+    def worker_busy(self, name):
+        log.debug('POOL: Worker %s busy' % name)
+        if name in self.state['online']:
+            self.state['available'].discard(name)
+            self.state['busy'].add(name)
+
+    @journaled
+    def worker_offline(self, name):
+        log.debug('POOL: Worker %s offline' % name)
+        if name not in self.state['online']:
+            return None
+        self.state['online'].discard(name)
+        self.state['available'].discard(name)
+        self.state['busy'].discard(name)
+
+        worker = self.state['workers'][name]
+        for cap in worker['caps']:
+            self.state['caps'][cap]['workers'].discard(name)
+        for sig in worker['signatures']:
+            self.state['signatures'][sig]['workers'].discard(name)
+
+        reset_tasks = {}
+        for item in sorted(worker['tasks']):
+            job, task = item.split(',')
+            reset_tasks.setdefault(job, set()).add(task)
+            log.debug('RESET: Resetting task %s,%s' % (job, task))
+            self._requeue(name, job, task)
+        del self.state['workers'][name]
+        return reset_tasks
+
+    @journaled
+    def submit_job(self, job, owner, command, cleanup, size, requirements,
+                   priority=0, bundle=1, walltime=0, retries=0):
+        log.debug('JOB: Job %s submitted by %s' % (job, owner))
+        sig = signature(requirements)
+        self.state['jobs'][job] = {'owner': owner,
+                                   'command': command,
+                                   'cleanup': cleanup,
+                                   'size': str(size),
+                                   'priority': str(int(priority or 0)),
+                                   'bundle': str(int(bundle)),
+                                   'walltime': str(float(walltime or 0)),
+                                   'retries': str(int(retries or 0)),
+                                   'signature': sig}
+        self.state['tasks'][job] = {'size': int(size),
+                                    'next': 0,
+                                    'requeued': [],
+                                    'pending': set(),
+                                    'running': set(),
+                                    'done': set(),
+                                    'owners': {}}
+        self._index_signature(sig)
+        self.state['signatures'][sig]['jobs'].add(job)
+        self.state['users'].setdefault(owner, set()).add(job)
+        self.state['queued'].add(job)
+        self._count(job, queued=int(size))
+        if int(size):
+            self._enqueue(job)
+        return job, self._job_matches(job)
+
+    @journaled
+    def cancel_job(self, job, canceller):
+        data = self.state['jobs'].get(job)
+        if data is None or data['owner'] != canceller:
+            return None
+        log.debug('JOB: Job %s cancelled by %s' % (job, canceller))
+        self.state['queued'].discard(job)
+        self._dequeue(job)
+        self.state['signatures'][data['signature']]['jobs'].discard(job)
+        self.state['users'].get(canceller, set()).discard(job)
+        counts = self.state['counts'].get(job, self._empty_counts())
+        self._count(job, queued=-counts['queued'])
+
+        cancellations = {}
+        tasks = self.state['tasks'][job]
+        for task in sorted(tasks['pending'].union(tasks['running'])):
+            worker = tasks['owners'].pop(task, None)
+            if worker:
+                cancellations.setdefault(worker, set()).add(task)
+
+            # Take the task off its worker so that the slot can be
+            # filled straight away. The task stays claimed.
+            item = '%s,%s' % (job, task)
+            self.state['leases'].pop(item, None)
+            if task in tasks['pending']:
+                tasks['pending'].discard(task)
+                self._count(job, pending=-1)
+            else:
+                tasks['running'].discard(task)
+                self._count(job, running=-1)
+            if worker in self.state['workers']:
+                self._release(worker, item)
+        return cancellations
+
+    @journaled
+    def job_matches(self, job):
+        return self._job_matches(job)
+
+    def _job_matches(self, job):
+        data = self.state['jobs'].get(job)
+        if data is None or job not in self.state['queued']:
+            return []
+        workers = self.state['signatures'][data['signature']]['workers']
+        matches = []
+        for worker in sorted(workers.intersection(self.state['available'])):
+            for slot in range(self._free_slots(worker)):
+                tasks = self._claim_bundle(job, worker)
+                if not tasks:
+                    self._dequeue(job)
+                    return matches
+                log.debug('MATCH: Matched worker %s to ' % worker + \
+                          'tasks %s,%s' % (job, ','.join(tasks)))
+                matches.append((worker, tasks))
+        return matches
+
+    @journaled
+    def task_start(self, worker, job, task):
+        log.debug('TASK: Task %s,%s started by %s' % (job, task, worker))
+        tasks = self.state['tasks'].get(job)
+        if tasks is None or task not in tasks['pending'] or \
+           not self._owns(worker, job, task):
+            return False
+        tasks['pending'].discard(task)
+        tasks['running'].add(task)
+        self._lease('%s,%s' % (job, task), self.running_lease)
+        self._count(job, pending=-1, running=1)
+        return True
+
+    @journaled
+    def task_hold(self, worker, job, tasks):
+        held = []
+        job_tasks = self.state['tasks'].get(job)
+        for task in tasks:
+            if job_tasks is not None and task in job_tasks['pending'] and \
+               self._owns(worker, job, task):
+                self._lease('%s,%s' % (job, task), self.pending_lease)
+                held.append(task)
+        return held
+
+    @journaled
+    def task_finish(self, worker, job, task):
+        log.debug('TASK: Task %s,%s finished by %s' % (job, task, worker))
+        if not self._owns(worker, job, task):
+            return False
+        return self._finish(worker, job, task)
+
+    def _finish(self, worker, job, task):
+        item = '%s,%s' % (job, task)
+        tasks = self.state['tasks'].get(job)
+        self.state['leases'].pop(item, None)
+        if worker in self.state['workers']:
+            self._release(worker, item)
+        if tasks is None:
+            return False
+        tasks['owners'].pop(task, None)
+        if task in tasks['pending']:
+            tasks['pending'].discard(task)
+            self._count(job, pending=-1)
+        elif task in tasks['running']:
+            tasks['running'].discard(task)
+            self._count(job, running=-1)
+        if task in tasks['done']:
+            return False
+        tasks['done'].add(task)
+        self._count(job, completed=1)
+
+        if self.state['counts'][job]['completed'] != tasks['size']:
+            return False
+        if job not in self.state['queued']:
+            return False
+        data = self.state['jobs'][job]
+        self.state['signatures'][data['signature']]['jobs'].discard(job)
+        self.state['users'].get(data['owner'], set()).discard(job)
+        self.state['queued'].discard(job)
+        self._dequeue(job)
+        self.state['completed'].add(job)
+        # Completed task ids are only needed while the job runs.
+        tasks['done'] = set()
+        return True
+
+    @journaled
+    def task_reset(self, worker, job, task):
+        log.debug('TASK: Task %s,%s for %s reset.' % (job, task, worker))
+        owner = self.state['tasks'].get(job, {'owners': {}})['owners'].get(task)
+        if owner and owner != worker:
+            return
+        self._requeue(worker, job, task)
+
+    @journaled
+    def task_timeout(self, worker, job, task):
+        if not self._owns(worker, job, task):
+            return None
+        timeouts = self.state['timeouts'].setdefault(job, {})
+        timeouts[task] = timeouts.get(task, 0) + 1
+        retries = int(self.state['jobs'].get(job, {}).get('retries', 0))
+        if timeouts[task] <= retries:
+            log.debug('TASK: Task %s,%s timed out on %s, requeued' % (
+                job, task, worker))
+            self._requeue(worker, job, task)
+            return 'requeued'
+        log.debug('TASK: Task %s,%s timed out on %s, failed' % (
+            job, task, worker))
+        if self._finish(worker, job, task):
+            return 'completed'
+        return 'failed'
+
+    @journaled
+    def record_runtime(self, job, seconds, tasks=1):
+        runtime = self.state['runtime'].setdefault(job, [0, 0])
+        runtime[0] += seconds
+        runtime[1] += tasks
+
+    @journaled
+    def record_resources(self, job, resources):
+        recorded = self.state['resources'].setdefault(
+                job, {'totals': {}, 'wall': {}, 'maxrss': {}})
+        for task, used in sorted(resources.items()):
+            counts, wall, maxrss = resource_counts(used)
+            for field, value in counts.items():
+                recorded['totals'][field] = \
+                        recorded['totals'].get(field, 0) + value
+            for histogram, bound in (('wall', wall), ('maxrss', maxrss)):
+                if bound is not None:
+                    recorded[histogram][bound] = \
+                            recorded[histogram].get(bound, 0) + 1
+
+    @journaled
+    def worker_heartbeat(self, name):
+        worker = self.state['workers'].get(name)
+        if worker is None:
+            return
+        for item in worker['tasks']:
+            job, task = item.split(',')
+            tasks = self.state['tasks'].get(job)
+            if tasks and task in tasks['running']:
+                self._lease(item, self.running_lease)
+
+    @journaled
+    def expire_leases(self):
+        reset_jobs = set()
+        now = self.now
+        heap = self.state['lease_heap']
+        while heap and heap[0][0] <= now:
+            expires, item = heapq.heappop(heap)
+            if self.state['leases'].get(item) != expires:
+                # The lease was renewed or released since.
+                continue
+            job, task = item.split(',')
+            log.debug('LEASE: Lease for task %s,%s expired' % (job, task))
+            tasks = self.state['tasks'].get(job, {'owners': {}})
+            self._requeue(tasks['owners'].get(task), job, task)
+            reset_jobs.add(job)
+        return reset_jobs
+
+    @locked
+    def job_status(self, job=None):
+        if job is None:
+            jobs = self.state['queued']
+        else:
+            jobs = [str(job)]
+        statuses = {}
+        for job in jobs:
+            data = self.state['jobs'].get(job, {})
+            recorded = self.state['resources'].get(
+                    job, {'totals': {}, 'wall': {}, 'maxrss': {}})
+            status = {'owner': data.get('owner'),
+                      'requested': data.get('size'),
+                      'priority': int(data.get('priority', 0)),
+                      'resources': resource_summary(recorded['totals'],
+                                                    recorded['wall'],
+                                                    recorded['maxrss'])}
+            status.update(self.state['counts'].get(job, self._empty_counts()))
+            statuses[job] = status
+        return statuses
+
+    @locked
+    def pool_status(self):
+        status = {'online': len(self.state['online']),
+                  'available': len(self.state['available']),
+                  'busy': len(self.state['busy'])}
+        status.update(self.state['pool'])
+        return status
+
+    @journaled
+    def clean(self):
+        self.state['available'].intersection_update(self.state['online'])
+        self.state['busy'].intersection_update(self.state['online'])
+
+    @locked
+    def user_jobs(self, user):
+        return set(self.state['users'].get(user, set()))
+
+    @locked
+    def known_worker(self, name):
+        return str(name) in self.state['online']
+
+    @locked
+    def task_owner(self, job, task):
+        tasks = self.state['tasks'].get(str(job))
+        if tasks is None:
+            return None
+        return tasks['owners'].get(str(task))
+
+    @locked
+    def online_workers(self):
+        return set(self.state['online'])
+
+    @locked
+    def available_workers(self):
+        return set(self.state['available'])
+
+    @locked
+    def busy_workers(self):
+        return set(self.state['busy'])
+
+    @locked
+    def get_jobs(self):
+        jobs = {}
+        for job in self.state['queued']:
+            jobs[job] = self.state['jobs'][job]['owner']
+        return jobs
+
+    @locked
+    def scan_workers(self, state, cursor=0, count=100):
+        workers = sorted(self.state[state])
+        return self._scan(workers, cursor, count)
+
+    @locked
+    def scan_jobs(self, cursor=0, count=100):
+        jobs = sorted(self.state['queued'], key=int)
+        cursor, jobs = self._scan(jobs, cursor, count)
+        return cursor, [(job, self.state['jobs'][job]['owner'])
+                        for job in jobs]
+
+    def _scan(self, members, cursor, count):
+        """Emulate a Redis scan over a sorted list, by position."""
+        cursor = int(cursor)
+        batch = members[cursor:cursor + count]
+        cursor += count
+        if cursor >= len(members):
+            cursor = 0
+        return cursor, batch
+
+    @locked
+    def count_workers(self, state):
+        return len(self.state[state])
+
+    @locked
+    def count_jobs(self):
+        return len(self.state['queued'])
+
+    @locked
+    def get_job(self, job):
+        data = dict(self.state['jobs'].get(str(job), {}))
+        data['id'] = job
+        data['requirements'] = signature_requirements(data.get('signature'))
+        return data
@@ -0,0 +1,54 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import math
+import threading
+
+
+def bucket(value):
+    """
+    Return the upper bound of the power of two histogram bucket
+    holding a value, or 0 for values that are not positive.
+    """
+    if value <= 0:
+        return 0
+    mantissa, exponent = math.frexp(value)
+    if mantissa == 0.5:
+        exponent -= 1
+    return math.ldexp(1, exponent)
+
+
+class Timer(object):
+
+    """
+    Running summary of how long a recurring operation takes.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """Add the duration of one operation."""
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def mean(self):
+        """Return the average duration, or 0 if nothing was recorded."""
+        with self.lock:
+            if not self.count:
+                return 0.0
+            return self.total / self.count
+
+    def __str__(self):
+        return '%.1f ms average, %.1f ms max over %s' % (
+                self.mean() * 1000, self.max * 1000, self.count)
@@ -0,0 +1,338 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import logging
+import time
+
+from kestrel.backend import canonical, signature, signature_requirements, \
+                            job_rank
+
+
+log = logging.getLogger(__name__)
+
+
+SCHEMA_VERSION = 4
+
+
+def schema_version(redis):
+    """Return the version of the key layout stored in Redis."""
+    return int(redis.get('kestrel:schema') or 1)
+
+
+def migrate(redis, pending_lease=15, running_lease=60):
+    """
+    Bring the Kestrel data stored in Redis up to date with the
+    key layout used by kestrel.backend.
+
+    Version 1 stored each job field under its own string key.
+    Version 2 stores each job as a single hash, indexes queued jobs
+    by owner, and tracks task state with bitmaps.
+    Version 3 adds the per owner run queues used for fair share and
+    priority scheduling.
+    Version 4 records which worker slot bundle each in flight task
+    belongs to, and replaces the is_pending keys with task leases.
+
+    Arguments:
+        redis         -- A Redis connection.
+        pending_lease -- The lease of pending tasks, in seconds.
+        running_lease -- The lease of running tasks, in seconds.
+    """
+    version = schema_version(redis)
+    if version < 2:
+        convert_job_records(redis)
+        convert_task_sets(redis)
+    build_signature_index(redis)
+    build_counters(redis)
+    build_run_queues(redis)
+    build_bundles(redis)
+    build_leases(redis, pending_lease, running_lease)
+    redis.set('kestrel:schema', SCHEMA_VERSION)
+    log.info('MIGRATE: Data is at schema version %s' % SCHEMA_VERSION)
+
+
+def convert_job_records(redis):
+    """
+    Convert the version 1 job:[id]:owner, command, cleanup, size
+    and requirements keys into a single job:[id] hash, and build
+    the user:[owner]:jobs index.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    fields = ['owner', 'command', 'cleanup', 'size']
+    queued = redis.smembers('jobs:queued')
+    jobs = list(redis.sunion(['jobs:queued', 'jobs:completed']))
+    log.info('MIGRATE: Converting %s job records' % len(jobs))
+
+    p = redis.pipeline()
+    for job in jobs:
+        for field in fields:
+            p.get('job:%s:%s' % (job, field))
+        p.smembers('job:%s:requirements' % job)
+    results = p.execute()
+
+    p = redis.pipeline()
+    for i, job in enumerate(jobs):
+        values = results[5 * i:5 * i + 5]
+        data = dict(zip(fields, values[:4]))
+        data['signature'] = signature(values[4])
+        data = dict((k, v) for k, v in data.items() if v is not None)
+        p.hmset('job:%s' % job, data)
+        if job in queued and data.get('owner'):
+            p.sadd('user:%s:jobs' % data['owner'], job)
+        for field in fields + ['requirements', 'signature']:
+            p.delete('job:%s:%s' % (job, field))
+    p.execute()
+
+
+def build_signature_index(redis):
+    """
+    Build the requirement signature index from existing job:* and
+    worker:* keys.
+
+    The old per-pair worker:*:jobs and job:*:workers sets are
+    removed once the index has been built.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    log.info('MIGRATE: Building requirement signature index')
+
+    p = redis.pipeline()
+    for key in redis.scan_iter('signature:*'):
+        p.delete(key)
+    for key in redis.scan_iter('capability:*'):
+        p.delete(key)
+    p.delete('signatures')
+    p.execute()
+
+    jobs = list(redis.smembers('jobs:queued'))
+    p = redis.pipeline()
+    for job in jobs:
+        p.hget('job:%s' % job, 'signature')
+    job_sigs = p.execute()
+
+    sigs = set()
+    p = redis.pipeline()
+    for job, sig in zip(jobs, job_sigs):
+        sig = sig or ''
+        sigs.add(sig)
+        p.sadd('signature:%s:jobs' % sig, job)
+        p.sadd('signatures', sig)
+        for req in signature_requirements(sig):
+            p.sadd('capability:%s:signatures' % req, sig)
+    p.execute()
+    log.info('MIGRATE: Indexed %s jobs under %s signatures' % (
+        len(jobs), len(sigs)))
+
+    workers = redis.smembers('workers:online')
+    p = redis.pipeline()
+    for worker in workers:
+        caps = set(canonical(redis.smembers('worker:%s' % worker)))
+        p.delete('worker:%s:signatures' % worker)
+        p.delete('worker:%s:jobs' % worker)
+        for cap in caps:
+            p.sadd('capability:%s:workers' % cap, worker)
+        for sig in sigs:
+            if signature_requirements(sig).issubset(caps):
+                p.sadd('worker:%s:signatures' % worker, sig)
+                p.sadd('signature:%s:workers' % sig, worker)
+    p.execute()
+    log.info('MIGRATE: Indexed %s online workers' % len(workers))
+
+    p = redis.pipeline()
+    for key in redis.scan_iter('job:*:workers'):
+        p.delete(key)
+    p.execute()
+
+
+def convert_task_sets(redis):
+    """
+    Replace the per job queued and completed task sets with the
+    claimed and completed bitmaps.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    jobs = redis.sunion(['jobs:queued', 'jobs:completed'])
+    for job in jobs:
+        if not redis.exists('job:%s:tasks:queued' % job) and \
+           not redis.exists('job:%s:tasks:completed' % job):
+            continue
+        log.info('MIGRATE: Converting tasks of job %s to bitmaps' % job)
+        claimed = redis.sunion(['job:%s:tasks:pending' % job,
+                                'job:%s:tasks:running' % job,
+                                'job:%s:tasks:completed' % job])
+        completed = redis.smembers('job:%s:tasks:completed' % job)
+
+        p = redis.pipeline()
+        p.delete('job:%s:bits:claimed' % job)
+        p.delete('job:%s:bits:completed' % job)
+        for i, task in enumerate(claimed):
+            p.setbit('job:%s:bits:claimed' % job, task, 1)
+            if i % 10000 == 0:
+                p.execute()
+        for i, task in enumerate(completed):
+            p.setbit('job:%s:bits:completed' % job, task, 1)
+            if i % 10000 == 0:
+                p.execute()
+        p.delete('job:%s:tasks:queued' % job)
+        p.delete('job:%s:tasks:completed' % job)
+        p.execute()
+
+
+def build_counters(redis):
+    """
+    Rebuild the per job and pool wide task state counters from the
+    task bitmaps and sets.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    queued = redis.smembers('jobs:queued')
+    jobs = list(redis.sunion(['jobs:queued', 'jobs:completed']))
+    log.info('MIGRATE: Rebuilding task counters for %s jobs' % len(jobs))
+
+    p = redis.pipeline()
+    for job in jobs:
+        p.hget('job:%s' % job, 'size')
+        p.bitcount('job:%s:bits:claimed' % job)
+        p.scard('job:%s:tasks:pending' % job)
+        p.scard('job:%s:tasks:running' % job)
+        p.bitcount('job:%s:bits:completed' % job)
+    results = p.execute()
+
+    totals = {'queued': 0, 'pending': 0, 'running': 0, 'completed': 0}
+    p = redis.pipeline()
+    for i, job in enumerate(jobs):
+        size, claimed, pending, running, completed = results[5 * i:5 * i + 5]
+        counts = {'queued': 0,
+                  'pending': pending,
+                  'running': running,
+                  'completed': completed}
+        if job in queued:
+            counts['queued'] = int(size or 0) - claimed
+        p.delete('job:%s:counts' % job)
+        p.hmset('job:%s:counts' % job, counts)
+        for field in counts:
+            totals[field] += counts[field]
+    p.delete('pool:counts')
+    p.hmset('pool:counts', totals)
+    p.execute()
+
+
+def build_run_queues(redis):
+    """
+    Rebuild the per owner run queues from the queued jobs that still
+    have queued tasks, along with the ready lists of pull mode workers.
+    Recorded owner usage is kept.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    p = redis.pipeline()
+    for key in redis.scan_iter('user:*:signatures'):
+        p.delete(key)
+    for key in redis.scan_iter('signature:*:owner*'):
+        p.delete(key)
+    for key in redis.scan_iter('signature:*:ready'):
+        p.delete(key)
+    p.execute()
+
+    jobs = list(redis.smembers('jobs:queued'))
+    p = redis.pipeline()
+    for job in jobs:
+        p.hmget('job:%s' % job, ['owner', 'signature', 'priority'])
+        p.hget('job:%s:counts' % job, 'queued')
+    results = p.execute()
+    usage = dict(redis.zrange('owners:usage', 0, -1, withscores=True))
+
+    runnable = 0
+    ready = set()
+    p = redis.pipeline()
+    for i, job in enumerate(jobs):
+        (owner, sig, priority), queued = results[2 * i:2 * i + 2]
+        if owner is None or not int(queued or 0):
+            continue
+        runnable += 1
+        sig = sig or ''
+        p.execute_command('ZADD', 'signature:%s:owner:%s:jobs' % (sig, owner),
+                          job_rank(job, priority), job)
+        p.execute_command('ZADD', 'signature:%s:owners' % sig,
+                          usage.get(owner, 0), owner)
+        p.sadd('user:%s:signatures' % owner, sig)
+        ready.add(sig)
+    for sig in ready:
+        p.rpush('signature:%s:ready' % sig, sig)
+    p.execute()
+    log.info('MIGRATE: Queued %s jobs with runnable tasks' % runnable)
+
+
+def build_bundles(redis):
+    """
+    Give every in flight task that is not part of a bundle a worker
+    slot bundle of its own.
+
+    Arguments:
+        redis -- A Redis connection.
+    """
+    workers = list(redis.smembers('workers:online'))
+    p = redis.pipeline()
+    for worker in workers:
+        p.smembers('worker:%s:tasks' % worker)
+        p.hgetall('worker:%s:task_bundles' % worker)
+    results = p.execute()
+
+    bundled = 0
+    p = redis.pipeline()
+    for i, worker in enumerate(workers):
+        tasks, bundles = results[2 * i:2 * i + 2]
+        for item in tasks:
+            if item in bundles:
+                continue
+            bundled += 1
+            p.hset('worker:%s:task_bundles' % worker, item, item)
+            p.hincrby('worker:%s:bundles' % worker, item, 1)
+    p.execute()
+    log.info('MIGRATE: Gave %s in flight tasks their own bundle' % bundled)
+
+
+def build_leases(redis, pending_lease=15, running_lease=60):
+    """
+    Give every in flight task without a lease a new one, as if it
+    had just been sent or started, and remove the version 1
+    is_pending keys the leases replace. Tasks left without a lease
+    would never be requeued if their worker went away.
+
+    Arguments:
+        redis         -- A Redis connection.
+        pending_lease -- The lease of pending tasks, in seconds.
+        running_lease -- The lease of running tasks, in seconds.
+    """
+    jobs = list(redis.sunion(['jobs:queued', 'jobs:completed']))
+    p = redis.pipeline()
+    for job in jobs:
+        p.smembers('job:%s:tasks:pending' % job)
+        p.smembers('job:%s:tasks:running' % job)
+    results = p.execute()
+
+    now = time.time()
+    leased = 0
+    p = redis.pipeline()
+    for i, job in enumerate(jobs):
+        pending, running = results[2 * i:2 * i + 2]
+        for tasks, lease in ((pending, pending_lease),
+                             (running, running_lease)):
+            for task in tasks:
+                leased += 1
+                p.execute_command('ZADD', 'tasks:leases', 'NX',
+                                  now + lease, '%s,%s' % (job, task))
+    for key in redis.scan_iter('job:*:task:*:is_pending'):
+        p.delete(key)
+    p.execute()
+    log.info('MIGRATE: Leased %s in flight tasks' % leased)
@@ -68,6 +68,10 @@ class kestrel_client(base_plugin):
         form.addField(var='command', value=job['command'])
         form.addField(var='cleanup', value=job.get('cleanup', ''))
         form.addField(var='queue', value=job.get('queue', '1'))
+        form.addField(var='priority', value=job.get('priority', '0'))
+        form.addField(var='bundle', value=job.get('bundle', '1'))
+        form.addField(var='walltime', value=job.get('walltime', '0'))
+        form.addField(var='retries', value=job.get('retries', '0'))
         form.addField(var='requirements', ftype='text-multi',
                       value="\n".join(reqs))
 
@@ -7,10 +7,11 @@
 """
 
 
+import collections
 import logging
 import os
 import signal
-import subprocess
+import tempfile
 import threading
 import time
 
@@ -18,6 +19,13 @@ import time
 import sleekxmpp
 from sleekxmpp.exceptions import XMPPError
 from sleekxmpp.plugins.base import base_plugin
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import StanzaPath
+
+from kestrel import runner
+from kestrel.spool import Spool, compress
+from kestrel.stanza import DISPATCH_FEATURE, BUNDLE_FEATURE, CANCEL_FEATURE
+from kestrel import supervisor
 
 
 log = logging.getLogger(__name__)
@@ -30,14 +38,76 @@ class kestrel_executor(base_plugin):
 
         self.whitelist = self.config.get('whitelist', [])
         self.max_tasks = self.config.get('max_tasks', 1)
+        self.prefetch = self.config.get('prefetch', 0)
+        self.pull = self.config.get('pull', False)
+
+        # Task output is streamed into spool files instead of being
+        # held in memory. The end of each stream ('tail'), or all of
+        # it in pieces ('full'), may be returned to the manager.
+        self.output_dir = self.config.get('output_dir', None) or \
+                          os.path.join(tempfile.gettempdir(), 'kestrel')
+        self.output_limit = self.config.get('output_limit', 10485760)
+        self.output_backups = self.config.get('output_backups', 1)
+        self.output_return = self.config.get('output_return', 'tail')
+        self.output_tail = self.config.get('output_tail', 4096)
+        self.output_chunk = self.config.get('output_chunk', 32768)
+        self.output_keep = self.config.get('output_keep', False)
+
+        # Jobs naming a Python entry point run in warm interpreters.
+        self.runners = self.config.get('runners', self.max_tasks or 1)
+        self.runner_tasks = self.config.get('runner_tasks', 100)
+        self.runner_growth = self.config.get('runner_growth', 262144)
+        self.runner_python = self.config.get('runner_python', None)
+        self.runner_entries = self.config.get('runner_entries', [])
+
+        # Commands running past the walltime given by their job, or
+        # past our own, are sent SIGTERM and, after the grace period,
+        # their process group is killed.
+        self.walltime = self.config.get('walltime', 0)
+        self.walltime_grace = self.config.get('walltime_grace', 10)
 
+        # Running tasks, and the prefetched tasks waiting for a slot.
         self.tasks = {}
+        self.waiting = collections.deque()
+        # The job and task IDs of each running or prefetched entry.
+        self.members = {}
         self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        # Functions waiting for cancelled task processes to exit,
+        # keyed by process.
+        self.exit_waiters = {}
+
+        # Commands are started without waiting for them; the supervisor
+        # reports their exits, so no thread is held per running task.
+        self.supervisor = supervisor.shared()
+        self.runner_pool = runner.RunnerPool(self.supervisor,
+                                             idle=self.runners,
+                                             tasks=self.runner_tasks,
+                                             growth=self.runner_growth,
+                                             python=self.runner_python,
+                                             limit=self.output_limit,
+                                             backups=self.output_backups)
+        self.runner_pool.warm(self.runner_entries)
 
         self.xmpp.add_event_handler('session_start', self.start)
+        self.xmpp.register_handler(
+                Callback('Kestrel Task',
+                         StanzaPath('iq@type=set/kestrel_task'),
+                         self._handle_task))
+        self.xmpp.register_handler(
+                Callback('Kestrel Bundle',
+                         StanzaPath('iq@type=set/kestrel_bundle'),
+                         self._handle_bundle))
+        self.xmpp.register_handler(
+                Callback('Kestrel Cancel',
+                         StanzaPath('iq@type=set/kestrel_cancel'),
+                         self._handle_cancel))
 
     def post_init(self):
         base_plugin.post_init(self)
+        self.xmpp['xep_0030'].add_feature(DISPATCH_FEATURE)
+        self.xmpp['xep_0030'].add_feature(BUNDLE_FEATURE)
+        self.xmpp['xep_0030'].add_feature(CANCEL_FEATURE)
 
     def start(self, event):
         self.xmpp['xep_0050'].add_command(self.xmpp.boundjid,
@@ -45,37 +115,490 @@ class kestrel_executor(base_plugin):
                                           'Run Kestrel Task',
                                           self._handle_task_command)
 
-    def _handle_task_command(self, iq, session):
+    def _reserve(self, name):
+        """
+        Reserve a task slot, raising a resource-constraint error
+        when every slot is already in use.
+        """
+        with self.lock:
+            if self.max_tasks and len(self.tasks) + 1 > self.max_tasks:
+                raise XMPPError(
+                        condition='resource-constraint',
+                        text='Maximum number of tasks already running.',
+                        etype='wait')
 
-        def handle_cleanup(form, session):
-            cleanup = form['values'].get('cleanup', None)
-            if cleanup:
-                self._execute(session['id'], cleanup, cleanup=True)
-            with self.lock:
-                if session['id'] in self.tasks:
-                    del self.tasks[session['id']]
-            self.xmpp.send_presence(pstatus='Ready for Task')
+            self.tasks[name] = True
+            full = len(self.tasks) == self.max_tasks
 
-        def handle_command(form, session):
-            with self.lock:
-                if self.max_tasks and len(self.tasks) + 1 > self.max_tasks:
+        if full:
+            self.send_status()
+
+    def _start(self, name, target, args, job=None, tasks=()):
+        """
+        Start running tasks in a free slot, or hold them in the prefetch
+        queue until a slot frees up. A resource-constraint error is
+        raised when the prefetch queue is full as well.
+
+        Arguments:
+            name   -- The name of the slot entry.
+            target -- The function starting the tasks. It must return
+                      without waiting for them to finish.
+            args   -- The arguments passed to target.
+            job    -- The ID of the job the tasks belong to.
+            tasks  -- The IDs of the tasks run by target.
+        """
+        with self.lock:
+            if self.max_tasks and len(self.tasks) >= self.max_tasks:
+                if len(self.waiting) >= self.prefetch:
                     raise XMPPError(
                             condition='resource-constraint',
-                            text='Maximum number of tasks already running.',
+                            text='Maximum number of tasks already queued.',
                             etype='wait')
+                log.debug('TASK: Prefetched task %s' % name)
+                self.waiting.append((name, target, args))
+                self.members[name] = (job, set(tasks))
+                full = len(self.waiting) == self.prefetch
+                target = None
+            else:
+                self.tasks[name] = True
+                self.members[name] = (job, set(tasks))
+                full = len(self.tasks) == self.max_tasks and not self.prefetch
+
+        if target is not None:
+            target(*args)
+        if full:
+            self.send_status()
+
+    def _release(self, name):
+        """Free a task's slot, starting the next prefetched task in it."""
+        target = None
+        with self.lock:
+            if name in self.tasks:
+                del self.tasks[name]
+            self.members.pop(name, None)
+            self.slot_freed.notify_all()
+            if self.waiting and len(self.tasks) < self.max_tasks:
+                name, target, args = self.waiting.popleft()
+                self.tasks[name] = True
+        if target is not None:
+            log.debug('TASK: Starting prefetched task %s' % name)
+            target(*args)
+
+    def _has_room(self):
+        if not self.max_tasks:
+            return True
+        return len(self.tasks) + len(self.waiting) < \
+               self.max_tasks + self.prefetch
+
+    def wait_for_slot(self, timeout=None):
+        """
+        Block until a task could be accepted, either into a free slot
+        or into the prefetch queue.
+
+        Arguments:
+            timeout -- The number of seconds to wait.
+
+        Returns False if the wait timed out.
+        """
+        with self.slot_freed:
+            if not self._has_room():
+                self.slot_freed.wait(timeout)
+            return self._has_room()
+
+    def run_bundle(self, job, tasks, cleanup, callback, walltime=None):
+        """
+        Run a bundle of tasks that did not arrive in a stanza, such as
+        one claimed straight from the backend in pull mode.
+
+        Arguments:
+            job      -- The ID of the job the tasks belong to.
+            tasks    -- A list of (task, command) tuples.
+            cleanup  -- A command to execute after each task command.
+            callback -- Called once every task has run with a list
+                        of (task, status) tuples and a dictionary of
+                        the resources each task that ran used.
+            walltime -- The number of seconds each task command may
+                        run, or None for no limit but our own.
+        """
+        name = '%s,%s' % (job, tasks[0][0])
+
+        def finished(statuses, spools, resources):
+            self._release(name)
+            for spool in spools.values():
+                self._done_output(spool)
+            callback(statuses, resources)
+            self.send_status()
+
+        self._start(name, self._execute_bundle,
+                    (name, job, tasks, cleanup, finished, walltime),
+                    job, [task for task, command in tasks])
+
+    def send_status(self):
+        """
+        Broadcast our presence along with the number of free task
+        slots and prefetch queue places. A worker without either
+        shows itself as busy.
+        """
+        presence = self.xmpp.Presence()
+        presence['status'] = 'Ready for Task'
+        if self.max_tasks:
+            with self.lock:
+                free = max(self.max_tasks + self.prefetch - \
+                           len(self.tasks) - len(self.waiting), 0)
+            presence['kestrel_slots']['free'] = free
+            presence['kestrel_slots']['total'] = self.max_tasks
+            if self.prefetch:
+                presence['kestrel_slots']['prefetch'] = self.prefetch
+            if self.pull:
+                presence['kestrel_slots']['mode'] = 'pull'
+            if not free:
+                presence['type'] = 'dnd'
+                presence['status'] = 'Executing tasks.'
+        presence.send()
+
+    def _handle_task(self, iq):
+        """
+        Accept a task sent as a single kestrel:tasks stanza. The
+        command and then the cleanup are started, and the Iq is
+        answered once both have finished, with a status of timeout if
+        the command ran past its walltime. While every slot is in use
+        the task may wait in the prefetch queue.
+        """
+        if self.whitelist:
+            if iq['from'].bare not in self.whitelist:
+                raise XMPPError('not-authorized', etype='cancel')
+
+        job, task_id = iq['kestrel_task']['job'], iq['kestrel_task']['id']
+        name = '%s,%s' % (job, task_id)
+        self._start(name, self._run_task, (iq, name), job, [task_id])
+
+    def _run_task(self, iq, name):
+        task = iq['kestrel_task']
+        job, task_id = task['job'], task['id']
+
+        def finished(statuses, spools, resources):
+            with self.lock:
+                cancelled = name not in self.tasks
+            self._release(name)
+            status = statuses[0][1]
+            if status == 'cancelled' and cancelled:
+                # Stopped by a cancel request, not a failure to start.
+                for spool in spools.values():
+                    self._done_output(spool)
+                reply = iq.reply()
+                reply['kestrel_task']['job'] = job
+                reply['kestrel_task']['id'] = task_id
+                reply['kestrel_task']['status'] = 'cancelled'
+                reply.send()
+                self.send_status()
+                return
+            if status not in ('complete', 'timeout'):
+                for spool in spools.values():
+                    self._done_output(spool)
+                iq.exception(XMPPError('internal-server-error',
+                                       etype='cancel'))
+                self.send_status()
+                return
+
+            reply = iq.reply()
+            reply['kestrel_task']['job'] = job
+            reply['kestrel_task']['id'] = task_id
+            reply['kestrel_task']['status'] = status
+            reply['kestrel_task']['resources'] = resources[task_id]
+            self._return_output(iq['from'], job, task_id, spools[task_id],
+                                reply['kestrel_task'])
+            reply.send()
+            self.send_status()
+
+        self._execute_bundle(name, job, [(task_id, task['command'])],
+                             task['cleanup'], finished, task['walltime'])
+
+    def _handle_bundle(self, iq):
+        """
+        Accept a bundle of tasks sent as a single kestrel:tasks stanza.
+        The bundle takes one task slot, or one place in the prefetch
+        queue, and its tasks run one after the other.
+        """
+        if self.whitelist:
+            if iq['from'].bare not in self.whitelist:
+                raise XMPPError('not-authorized', etype='cancel')
+
+        tasks = iq['kestrel_bundle']['tasks']
+        if not tasks:
+            raise XMPPError('bad-request', etype='modify')
+
+        job = iq['kestrel_bundle']['job']
+        name = '%s,%s' % (job, tasks[0]['id'])
+        self._start(name, self._run_bundle, (iq, name),
+                    job, [task['id'] for task in tasks])
+
+    def _run_bundle(self, iq, name):
+        bundle = iq['kestrel_bundle']
+        job, cleanup = bundle['job'], bundle['cleanup']
+        tasks = [(task['id'], task['command']) for task in bundle['tasks']]
+
+        def finished(statuses, spools, resources):
+            self._release(name)
+            reply = iq.reply()
+            reply['kestrel_bundle']['job'] = job
+            for task_id, status in statuses:
+                task = reply['kestrel_bundle'].add_task(task_id, status=status)
+                if task_id in resources:
+                    task['resources'] = resources[task_id]
+                if task_id in spools:
+                    self._return_output(iq['from'], job, task_id,
+                                        spools[task_id], task)
+
+            reply.send()
+            self.send_status()
+
+        self._execute_bundle(name, job, tasks, cleanup, finished,
+                             bundle['walltime'])
 
-                self.tasks[session['id']] = True
+    def _execute_bundle(self, name, job, tasks, cleanup, callback,
+                        walltime=None):
+        """
+        Run the tasks of a bundle one after the other, each followed
+        by the cleanup command. Returns at once; each command is
+        started when the one before it is done.
 
-                if len(self.tasks) == self.max_tasks:
-                    self.xmpp.send_presence(ptype='dnd',
-                                            pstatus='Executing tasks.')
+        Once a task fails to start or the bundle is cancelled, the
+        remaining tasks are handed back without running them. A task
+        stopped for running past the walltime is reported as timeout,
+        and the bundle carries on with the next task.
+
+        Arguments:
+            name     -- The name of the bundle's slot entry.
+            job      -- The ID of the job the tasks belong to.
+            tasks    -- A list of (task, command) tuples.
+            cleanup  -- A command to execute after each task command.
+            callback -- Called once the bundle is done with a list of
+                        (task, status) tuples, a dictionary of the
+                        output spool of each task that was started, and
+                        a dictionary of the resources used by each
+                        task that ran.
+            walltime -- The number of seconds each command may run.
+        """
+        walltime = self._walltime(walltime)
+        statuses = []
+        spools = {}
+        resources = {}
+        remaining = collections.deque(tasks)
+
+        def next_task(running=True):
+            running = running and name in self.tasks
+            if not running or not remaining:
+                statuses.extend((task_id, 'cancelled')
+                                for task_id, command in remaining)
+                callback(statuses, spools, resources)
+                return
+
+            task_id, command = remaining.popleft()
+            spools[task_id] = self._spool(job, task_id)
+
+            def command_done(started, process):
+                if not started or name not in self.tasks:
+                    statuses.append((task_id, 'cancelled'))
+                    next_task(False)
+                    return
+                resources[task_id] = self._resources(process)
+                if process.timed_out:
+                    log.info('TASK: Task %s,%s ran out of time' % (
+                        job, task_id))
+                if cleanup:
+                    self._execute(name, cleanup, cleanup_done,
+                                  cleanup=True, spool=spools[task_id],
+                                  walltime=walltime)
+                else:
+                    cleanup_done(True, None)
+
+            def cleanup_done(started, process):
+                if process is not None:
+                    resources[task_id]['cleanup'] = \
+                            self._resources(process)['wall']
+                if resources[task_id].get('timeout'):
+                    statuses.append((task_id, 'timeout'))
+                else:
+                    statuses.append((task_id, 'complete'))
+                next_task()
+
+            self._execute(name, command, command_done, spool=spools[task_id],
+                          walltime=walltime)
+
+        next_task()
+
+    def _spool(self, job, task):
+        """Create the spool that a task's output is written to."""
+        return Spool(os.path.join(self.output_dir, '%s.%s' % (job, task)),
+                     self.output_limit, self.output_backups)
+
+    def _return_output(self, to, job, task, spool, stanza):
+        """
+        Return a task's output to the manager as configured, either
+        as the end of each stream attached to the task's outcome, or
+        as a series of output stanzas sent ahead of the outcome.
+
+        Arguments:
+            to     -- The JID the task came from.
+            job    -- The ID of the job the task belongs to.
+            task   -- The task's number within the job.
+            spool  -- The task's output spool.
+            stanza -- The Task stanza reporting the outcome.
+        """
+        try:
+            for stream in spool.streams:
+                output = spool.files[stream]
+                if self.output_return == 'tail':
+                    data = output.tail(self.output_tail)
+                    if data:
+                        stanza.add_output(stream, compress(data),
+                                          output.dropped)
+                elif self.output_return == 'full':
+                    self._send_output(to, job, task, stream, output)
+        except:
+            log.exception('TASK: Could not return output of %s,%s' % (
+                job, task))
+        self._done_output(spool)
+
+    def _send_output(self, to, job, task, stream, output):
+        chunks = output.chunks(self.output_chunk)
+        chunk = next(chunks, None)
+        seq = 0
+        while chunk is not None:
+            following = next(chunks, None)
+            iq = self.xmpp.Iq()
+            iq['type'] = 'set'
+            iq['to'] = to
+            iq['kestrel_output']['job'] = job
+            iq['kestrel_output']['id'] = task
+            iq['kestrel_output']['stream'] = stream
+            iq['kestrel_output']['seq'] = str(seq)
+            iq['kestrel_output']['data'] = compress(chunk)
+            if following is None:
+                iq['kestrel_output']['final'] = 'true'
+                if output.dropped:
+                    iq['kestrel_output']['dropped'] = str(output.dropped)
+            iq.send(block=False)
+            chunk = following
+            seq += 1
+
+    def _done_output(self, spool):
+        """Remove a task's spool unless spools are to be kept."""
+        if self.output_keep:
+            spool.close()
+        else:
+            spool.remove()
+
+    def _handle_cancel(self, iq):
+        """
+        Stop the given tasks of a job, whether running or waiting in
+        the prefetch queue, and report the tasks that were stopped
+        once their processes have exited. The stanzas that brought
+        the tasks are answered as usual, with the tasks reported as
+        cancelled.
+        """
+        if self.whitelist:
+            if iq['from'].bare not in self.whitelist:
+                raise XMPPError('not-authorized', etype='cancel')
+
+        job = iq['kestrel_cancel']['job']
+        ids = set(task['id'] for task in iq['kestrel_cancel']['tasks'])
+
+        running = []
+        dropped = []
+        stopped = set()
+        with self.lock:
+            for name, (member_job, tasks) in self.members.items():
+                if member_job != job or not tasks & ids:
+                    continue
+                stopped.update(tasks & ids)
+                if name in self.tasks:
+                    running.append(name)
+            for entry in list(self.waiting):
+                if entry[0] in self.members and \
+                   self.members[entry[0]][0] == job and \
+                   self.members[entry[0]][1] & ids:
+                    self.waiting.remove(entry)
+                    dropped.append(entry)
+
+        processes = []
+        for name in running:
+            process = self._cancel(name)
+            if process is not None:
+                processes.append(process)
+        # Dropped tasks are not in a slot, so they answer at once
+        # without running anything.
+        for name, target, args in dropped:
+            log.info('TASK: Dropping prefetched task %s' % name)
+            target(*args)
+
+        def stopped_all():
+            reply = iq.reply()
+            reply['kestrel_cancel']['job'] = job
+            for task_id in sorted(stopped, key=int):
+                reply['kestrel_cancel'].add_task(task_id, status='cancelled')
+            reply.send()
+            self.send_status()
+
+        self._when_exited(processes, stopped_all)
+
+    def _when_exited(self, processes, func):
+        """
+        Call a function once every given task process has exited,
+        which may be straight away.
+
+        Arguments:
+            processes -- The Process or RunnerTask objects to wait for.
+            func      -- The function to call, without arguments.
+        """
+        left = set()
+        with self.lock:
+            for process in processes:
+                # Both kinds of process are given an end time before
+                # their completion callback runs.
+                if process.ended is None:
+                    left.add(process)
+                    self.exit_waiters.setdefault(process, []).append(
+                            (left, func))
+        if not left:
+            func()
+
+    def _exited(self, process):
+        """Call the functions that waited for a task process to exit."""
+        ready = []
+        with self.lock:
+            for left, func in self.exit_waiters.pop(process, []):
+                left.discard(process)
+                if not left:
+                    ready.append(func)
+        for func in ready:
+            func()
+
+    def _handle_task_command(self, iq, session):
+
+        def handle_cleanup(form, session):
+            cleanup = form['values'].get('cleanup', None)
+            if cleanup:
+                self._execute_wait(session['id'], cleanup, cleanup=True,
+                                   spool=session['spool'],
+                                   walltime=self._walltime())
+            self._release(session['id'])
+            self._done_output(session['spool'])
+            self.send_status()
+
+        def handle_command(form, session):
+            self._reserve(session['id'])
 
             command = form['values']['command']
-            command_started = self._execute(session['id'], command)
+            session['spool'] = Spool(
+                    os.path.join(self.output_dir, session['id']),
+                    self.output_limit, self.output_backups)
+            command_started = self._execute_wait(session['id'], command,
+                                                 spool=session['spool'],
+                                                 walltime=self._walltime())
             if not command_started or session['id'] not in self.tasks:
-                with self.lock:
-                    if session['id'] in self.tasks:
-                        del self.tasks[session['id']]
+                self._release(session['id'])
+                self._done_output(session['spool'])
                 raise XMPPError('internal-server-error', etype='cancel')
 
             form = self.xmpp['xep_0004'].makeForm(ftype='form')
@@ -102,36 +625,111 @@ class kestrel_executor(base_plugin):
 
         return session
 
-    def _execute(self, name, command, cleanup=False):
-        """Wrapper function to open a subprocess."""
+    def _execute(self, name, command, callback, cleanup=False, spool=None,
+                 walltime=None):
+        """
+        Start a command in a process group of its own, streaming its
+        output into a spool as it runs. Output is discarded when no
+        spool is given. Task commands naming a Python entry point are
+        run in a warm interpreter instead. A command running for more
+        than walltime seconds is stopped.
+
+        Returns at once. The callback is later given True once the
+        command has exited, or False if it could not be started or
+        was cancelled while it was being started, along with the
+        finished process, if any.
+        """
+        kind = 'Cleanup' if cleanup else 'Task'
+        registered = threading.Event()
+        outcome = {'started': True}
+
+        def done(process):
+            registered.wait()
+            log.info("TASK: %s finished: %s (%s)" % (kind, name, command))
+            try:
+                callback(outcome['started'], process)
+            finally:
+                self._exited(process)
+
+        entry = None if cleanup else runner.parse(command)
         try:
-            task_process = subprocess.Popen(['sh', '-c', "%s" % command],
-                                            shell=False,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            preexec_fn=os.setsid)
-            if not cleanup:
-                with self.lock:
-                    self.tasks[name] = task_process
-                log.info("TASK: Task started: %s (%s)" % (name, command))
-                task_process.wait()
-                log.info("TASK: Task finished: %s (%s)" % (name, command))
+            if entry is not None:
+                task_process = self.runner_pool.run(
+                        entry[0], entry[1], spool, done,
+                        walltime=walltime, grace=self.walltime_grace)
             else:
-                log.info("TASK: Cleanup started: %s (%s)" % (name, command))
-                task_process.wait()
-                log.info("TASK: Cleanup finished: %s (%s)" % (name, command))
-
-            return True
+                task_process = self.supervisor.spawn(
+                        command, spool, done,
+                        walltime=walltime, grace=self.walltime_grace)
         except:
-            error_type = "cleanup" if cleanup else "task"
-            log.info("TASK: Error starting %s: (%s)" % (error_type, command))
-            return False
+            log.info("TASK: Error starting %s: (%s)" % (kind.lower(), command))
+            callback(False, None)
+            return
+
+        if not cleanup:
+            with self.lock:
+                outcome['started'] = name in self.tasks
+                if outcome['started']:
+                    self.tasks[name] = task_process
+            if not outcome['started']:
+                # Cancelled while the process was being started.
+                self.supervisor.kill(task_process)
+        log.info("TASK: %s started: %s (%s)" % (kind, name, command))
+        registered.set()
+
+    def _execute_wait(self, name, command, cleanup=False, spool=None,
+                      walltime=None):
+        """Run a command with _execute, waiting until it is done."""
+        done = threading.Event()
+        outcome = []
+
+        def finished(started, process):
+            outcome.append(started)
+            done.set()
+
+        self._execute(name, command, finished, cleanup, spool, walltime)
+        done.wait()
+        return outcome[0]
+
+    def _walltime(self, requested=None):
+        """
+        Return the number of seconds a command may run, the shorter
+        of the walltime a job asked for and our own, or None for
+        no limit.
+
+        Arguments:
+            requested -- The job's walltime, as given in the stanza.
+        """
+        limits = [float(limit) for limit in (requested, self.walltime)
+                  if limit and float(limit) > 0]
+        if not limits:
+            return None
+        return min(limits)
+
+    def _resources(self, process):
+        """
+        Return the wall time, CPU time, peak memory and exit status
+        of a finished command, and whether it ran out of time.
+        """
+        resources = {'wall': max((process.ended or time.time()) -
+                                 process.started, 0.0),
+                     'exit': process.returncode}
+        if process.rusage is not None:
+            resources['utime'] = float(process.rusage.ru_utime)
+            resources['stime'] = float(process.rusage.ru_stime)
+            resources['maxrss'] = int(process.rusage.ru_maxrss)
+        if process.timed_out:
+            resources['timeout'] = True
+        return resources
 
     def _cancel(self, name):
-        """Wrapper function to kill a subprocess."""
+        """
+        Kill the process group of a running task, returning the task's
+        process, or None if it had not been started yet.
+        """
         if name not in self.tasks:
             log.info("TASK: Tried cancelling task %s, but task not found." % str(name))
-            return True
+            return None
         task_process = self.tasks[name]
         log.info("TASK: Cancelling task %s" % str(name))
         try:
@@ -141,4 +739,7 @@ class kestrel_executor(base_plugin):
         with self.lock:
             if name in self.tasks:
                 del self.tasks[name]
-        return True
+            self.slot_freed.notify_all()
+        if task_process is True:
+            return None
+        return task_process
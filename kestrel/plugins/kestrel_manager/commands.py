@@ -50,6 +50,8 @@ class cmd_poolstatus(AdhocCommand):
 
     def command_init(self):
         self.kestrel = self.config['backend']
+        self.handlers = self.config.get('handlers', None)
+        self.metrics = self.config.get('metrics', {})
 
     def start(self, form, session):
         status = self.kestrel.pool_status()
@@ -67,6 +69,24 @@ class cmd_poolstatus(AdhocCommand):
                       label='Busy Workers',
                       ftype='text-single',
                       value=str(status['busy']))
+        form.addField(var='queued_tasks',
+                      label='Queued Tasks',
+                      ftype='text-single',
+                      value=str(status['queued']))
+        form.addField(var='running_tasks',
+                      label='Running Tasks',
+                      ftype='text-single',
+                      value=str(status['running']))
+        if self.handlers is not None:
+            form.addField(var='queued_events',
+                          label='Queued Events',
+                          ftype='text-single',
+                          value=str(self.handlers.depth()))
+        if 'cancel_latency' in self.metrics:
+            form.addField(var='cancel_latency',
+                          label='Cancel Latency',
+                          ftype='text-single',
+                          value=str(self.metrics['cancel_latency']))
 
         session['payload'] = form
         session['next'] = None
@@ -139,6 +159,29 @@ class cmd_submitjob(AdhocCommand):
                       var='requirements',
                       label='Requirements',
                       desc='One requirement per line')
+        form.addField(ftype='text-single',
+                      var='priority',
+                      label='Priority',
+                      desc='Higher priority jobs of the same owner run first',
+                      value='0')
+        form.addField(ftype='text-single',
+                      var='bundle',
+                      label='Bundle Size',
+                      desc='Tasks sent to a worker at once, or auto to ' + \
+                           'size bundles from observed task run times',
+                      value='1')
+        form.addField(ftype='text-single',
+                      var='walltime',
+                      label='Walltime',
+                      desc='Seconds a task may run before it is ' + \
+                           'stopped, or 0 for no limit',
+                      value='0')
+        form.addField(ftype='text-single',
+                      var='retries',
+                      label='Timeout Retries',
+                      desc='Times a task that ran out of time is ' + \
+                           'requeued before it is failed',
+                      value='0')
 
         session['payload'] = form
         session['next'] = self.complete
@@ -149,12 +192,19 @@ class cmd_submitjob(AdhocCommand):
     def complete(self, form, session):
         id = self.kestrel.job_id()
         reqs = set([r.upper() for r in form['values']['requirements'].split("\n")])
+        bundle = form['values'].get('bundle', None) or '1'
+        if bundle.strip().lower() == 'auto':
+            bundle = 0
         job = {'id': id,
                'owner': session['from'].bare,
                'command': form['values']['command'],
                'cleanup': form['values'].get('cleanup', ''),
                'size': form['values']['queue'],
-               'requirements': reqs}
+               'requirements': reqs,
+               'priority': form['values'].get('priority', None) or 0,
+               'bundle': int(bundle),
+               'walltime': float(form['values'].get('walltime', None) or 0),
+               'retries': int(form['values'].get('retries', None) or 0)}
 
         self.xmpp.event('kestrel_job_submit', job)
 
@@ -187,15 +237,36 @@ class cmd_jobstatus(AdhocCommand):
         form.addReported(var='job_id', label='Job ID')
         form.addReported(var='owner', label='Owner')
         form.addReported(var='requested', label='Requested')
+        form.addReported(var='priority', label='Priority')
         form.addReported(var='queued', label='Queued')
         form.addReported(var='pending', label='Pending')
         form.addReported(var='running', label='Running')
         form.addReported(var='completed', label='Completed')
+        form.addReported(var='failed', label='Failed')
+        form.addReported(var='timeouts', label='Timed Out')
+        form.addReported(var='wall', label='Mean Wall Time')
+        form.addReported(var='cpu', label='Mean CPU Time')
+        form.addReported(var='maxrss', label='Mean Peak Memory')
+        form.addReported(var='wall_histogram', label='Wall Times')
+        form.addReported(var='maxrss_histogram', label='Peak Memory')
 
         statuses = self.kestrel.job_status()
         for job in statuses:
-            statuses[job]['job_id'] = job
-            form.addItem(statuses[job])
+            status = statuses[job]
+            resources = status.pop('resources')
+            status['job_id'] = job
+            status['failed'] = resources['failed']
+            status['timeouts'] = resources['timeouts']
+            status['wall'] = '%.3f s' % resources['wall']
+            status['cpu'] = '%.3f s' % (resources['utime'] +
+                                        resources['stime'])
+            status['maxrss'] = '%d KB' % resources['maxrss']
+            status['wall_histogram'] = ' '.join(
+                    '<=%gs:%s' % item for item in resources['wall_histogram'])
+            status['maxrss_histogram'] = ' '.join(
+                    '<=%gKB:%s' % item
+                    for item in resources['maxrss_histogram'])
+            form.addItem(status)
 
         session['payload'] = form
         session['next'] = None
@@ -7,52 +7,202 @@
 """
 
 
+import json
 import logging
+import os
+import socket
 import threading
+import time
 
 import sleekxmpp
+from sleekxmpp.exceptions import XMPPError
 from sleekxmpp.plugins import base
 from sleekxmpp.xmlstream.handler import Callback
 from sleekxmpp.xmlstream.matcher import MatchXPath, StanzaPath
 from sleekxmpp.xmlstream.stanzabase import ElementBase, ET, JID
+from sleekxmpp.xmlstream.stanzabase import register_stanza_plugin
 from sleekxmpp.stanza.iq import Iq
+from sleekxmpp.plugins.xep_0030 import DiscoItems
+from sleekxmpp.plugins.xep_0059 import Set
 
-from kestrel.backend import Kestrel
+from kestrel.backend import Kestrel, ScriptedKestrel, task_seconds
+from kestrel.cluster import Cluster
+from kestrel.handlers import HandlerPool
+from kestrel.memory import MemoryKestrel
+from kestrel.metrics import Timer
+from kestrel.spool import decompress
+from kestrel.stanza import DISPATCH_FEATURE, BUNDLE_FEATURE, CANCEL_FEATURE
 
 
 log = logging.getLogger(__name__)
 
 
+# The number of times an event may be forwarded between managers
+# before it is handled wherever it is, as happens while managers
+# disagree about the partitions during a membership change.
+FORWARD_HOPS = 2
+
+
 class kestrel_manager(base.base_plugin):
 
     def plugin_init(self):
         self.description = "Kestrel Manager"
 
-        backend = self.xmpp['redis_queue']
-        self.kestrel = Kestrel(backend.redis)
+        options = {'pending_lease': self.config.get('pending_lease', 15),
+                   'running_lease': self.config.get('running_lease', 60),
+                   'halflife': self.config.get('usage_halflife', 86400),
+                   'bundle_target': self.config.get('bundle_target', 5)}
+        if self.config.get('backend', 'redis') == 'memory':
+            self.kestrel = MemoryKestrel(self.config.get('journal', None),
+                                         **options)
+        elif self.config.get('scripted', False):
+            backend = self.xmpp['redis_queue']
+            self.kestrel = ScriptedKestrel(backend.redis, **options)
+        else:
+            backend = self.xmpp['redis_queue']
+            self.kestrel = Kestrel(backend.redis, **options)
         self.pool_jid = self.config.get('pool_jid', self.xmpp.boundjid)
         self.job_jid= self.config.get('job_jid', self.xmpp.boundjid)
 
+        # Jobs that have queued tasks waiting to be matched with
+        # available workers. Requests for the same job are coalesced
+        # until the dispatch thread picks them up.
+        self._dispatch_jobs = set()
+        self._dispatch_cond = threading.Condition()
+        self.stopping = False
+
+        # Workers that became available, with their announced slots,
+        # waiting to be matched together. A presence storm is collected
+        # for a short window and then matched in a single pass.
+        self._available = {}
+        self._available_cond = threading.Condition()
+        self._matching = set()
+        self._went_busy = set()
+        self.presence_window = self.config.get('presence_window', 0.005)
+
+        # Workers known to accept single stanza task dispatch, either
+        # of single tasks ('stanza') or of whole bundles ('bundle').
+        # All other workers are sent tasks with the run_task command.
+        self.protocols = {}
+        # Workers known to accept cancel stanzas.
+        self.cancellable = set()
+
+        # The time from a job being cancelled to its workers reporting
+        # that the processes of its tasks have exited.
+        self.metrics = {'cancel_latency': Timer()}
+
+        # Presence and kestrel events are handled by a fixed set of
+        # threads. Events about the same worker, or the same job, are
+        # handled in the order they arrived.
+        self.handlers = HandlerPool(self.config.get('handler_threads', 8),
+                                    self.config.get('handler_queue', 1000))
+
+        # Pages of the disco item lists of workers and jobs, keyed by
+        # node and XEP-0059 request, along with the time they were
+        # read. A node's pages are dropped whenever its membership changes.
+        register_stanza_plugin(DiscoItems, Set)
+        self.disco_page = self.config.get('disco_page', 100)
+        self.disco_cache = self.config.get('disco_cache', 5)
+        self._pages = {}
+        self._pages_lock = threading.Lock()
+
+        # Where the task output returned by workers is written, if
+        # anywhere, and how much of each stream is kept.
+        self.output_dir = self.config.get('output_dir', None)
+        self.output_limit = self.config.get('output_limit', 10485760)
+        # The next piece expected of each output stream being sent,
+        # keyed by job, task and stream.
+        self.output_seqs = {}
+        self.output_lock = threading.Lock()
+
+        # Callbacks for the replies to task stanzas we have sent,
+        # keyed by stanza ID, along with the worker they went to.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        # Tasks of bundles sent one task at a time that are waiting
+        # for the tasks ahead of them, keyed by worker and job. They
+        # stay pending, and their leases are renewed, until sent.
+        self.pending_lease = options['pending_lease']
+        self.held = {}
+        self.held_lock = threading.Lock()
+
+        # Several managers may share one Redis server, each handling
+        # the workers of its own partition of the pool.
+        self.cluster = None
+        self.dispatch_jid = self.pool_jid
+        # The number of times each event received from another
+        # manager has been forwarded, keyed by the event and its data.
+        self.hops = {}
+        self.hops_lock = threading.Lock()
+        if self.config.get('cluster', False) and \
+           'redis_queue' in self.xmpp.plugin:
+            name = self.config.get('instance', None) or \
+                   '%s-%s' % (socket.gethostname(), os.getpid())
+            self.cluster = Cluster(self.xmpp['redis_queue'].redis, name,
+                                   self.config.get('cluster_lease', 15))
+            self.dispatch_jid = JID('%s/%s' % (self.pool_jid.bare, name))
+
+        if 'redis_queue' in self.xmpp.plugin:
+            # Jobs completed by workers that claim their own tasks.
+            self.xmpp['redis_queue'].add_queue_handler(
+                    'jobs:finished',
+                    lambda job: self.xmpp.event('kestrel_job_complete', job))
+
         self.xmpp.register_handler(
                 Callback('Worker Cleanup Ping',
                          StanzaPath('iq@type=error/ping'),
                          self._handle_ping_error))
+        self.xmpp.register_handler(
+                Callback('Worker Heartbeat',
+                         StanzaPath('iq@type=get/ping'),
+                         self._handle_heartbeat))
+        self.xmpp.register_handler(
+                Callback('Task Output',
+                         StanzaPath('iq@type=set/kestrel_output'),
+                         self.handlers.wrap(
+                             self._handle_output,
+                             lambda iq: iq['from'].full)))
+        for path in ('iq@type=result/disco_info',
+                     'iq@type=result/kestrel_task',
+                     'iq@type=result/kestrel_bundle',
+                     'iq@type=result/kestrel_cancel',
+                     'iq@type=error'):
+            self.xmpp.register_handler(
+                    Callback('Task Result %s' % path,
+                             StanzaPath(path),
+                             self.handlers.wrap(
+                                 self._handle_task_result,
+                                 lambda iq: iq['from'].full)))
 
+        # Each handled event is paired with a function returning the
+        # worker or job it is about.
+        worker = lambda data: data[0]
+        job = lambda data: data['id']
+        same = lambda data: data
         events = [
-            ('session_start', self.clean_pool, False),
-            ('got_online', self._handle_online, False),
-            ('changed_status', self._handle_changed_status, True),
-            ('kestrel_register_worker', self._handle_register_worker, False),
-            ('kestrel_worker_available', self._handle_worker_available, False),
-            ('kestrel_worker_busy', self._handle_worker_busy, False),
-            ('kestrel_worker_offline', self._handle_worker_offline, False),
-            ('kestrel_job_submit', self._handle_submit_job, False),
-            ('kestrel_job_cancel', self._handle_cancel_job, False),
-            ('kestrel_job_complete', self._handle_complete_job, False)]
-
-        for event in events:
-            self.xmpp.add_event_handler(event[0], event[1],
-                                        threaded=event[2])
+            ('session_start', self.clean_pool, None),
+            ('got_online', self._handle_online, None),
+            ('changed_status', self._handle_changed_status,
+                lambda presence: presence['from'].jid),
+            ('kestrel_register_worker', self._handle_register_worker, worker),
+            ('kestrel_worker_available', self._handle_worker_available,
+                worker),
+            ('kestrel_worker_busy', self._handle_worker_busy, same),
+            ('kestrel_worker_offline', self._handle_worker_offline, same),
+            ('kestrel_worker_heartbeat', self._handle_worker_heartbeat, same),
+            ('kestrel_job_submit', self._handle_submit_job, job),
+            ('kestrel_job_cancel', self._handle_cancel_job,
+                lambda data: data[1]),
+            ('kestrel_cancel_tasks', self._handle_cancel_tasks, worker),
+            ('kestrel_job_complete', self._handle_complete_job, same),
+            ('kestrel_dispatch', self._handle_dispatch, worker),
+            ('kestrel_discover_worker', self._handle_discover_worker, same)]
+
+        for name, handler, key in events:
+            if key is not None:
+                handler = self.handlers.wrap(handler, key)
+            self.xmpp.add_event_handler(name, handler)
 
         commands = [('cmd_poolstatus', self.pool_jid),
                     ('cmd_joinpool', self.pool_jid),
@@ -63,7 +213,9 @@ class kestrel_manager(base.base_plugin):
             self.xmpp.register_plugin(
                     cmd[0],
                     {'jid': cmd[1],
-                     'backend': self.kestrel},
+                     'backend': self.kestrel,
+                     'handlers': self.handlers,
+                     'metrics': self.metrics},
                     module='kestrel.plugins.kestrel_manager')
 
     def post_init(self):
@@ -73,9 +225,36 @@ class kestrel_manager(base.base_plugin):
         job_jid = self.job_jid.full
         jid = self.xmpp.boundjid.full
 
+        dispatcher = threading.Thread(name='Kestrel Dispatch',
+                                      target=self._process_dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        matcher = threading.Thread(name='Kestrel Presence',
+                                   target=self._process_available)
+        matcher.daemon = True
+        matcher.start()
+
+        # Requeued tasks are dispatched as soon as they are reset, so
+        # the periodic sweep only needs to catch expired leases.
         self.xmpp.schedule('Clean Tasks', 15,
                            self.clean_tasks,
                            repeat=True)
+        self.xmpp.add_event_handler('disconnected', self._disconnected)
+        self.xmpp.add_event_handler('killed', self._shutdown)
+        self.xmpp.schedule('Hold Tasks',
+                           max(self.pending_lease / 3.0, 1),
+                           self.hold_tasks,
+                           repeat=True)
+
+        if self.cluster is not None:
+            self.cluster.heartbeat()
+            self.cluster.listen(self._handle_cluster_message)
+            self.xmpp.schedule('Cluster Heartbeat',
+                               max(self.cluster.lease / 3.0, 1),
+                               self._cluster_heartbeat,
+                               repeat=True)
+            self.xmpp.add_event_handler('disconnected', self._leave_cluster)
 
         items = [(pool_jid, None, 'Worker Pool', jid),
                  (pool_jid, 'online', 'Online Workers', pool_jid),
@@ -129,27 +308,251 @@ class kestrel_manager(base.base_plugin):
                     node=node[1],
                     handlers=node[2])
 
-        self.xmpp['xep_0050'].prep_handlers(
-                [self._dispatch_task_next,
-                 self._dispatch_task_command,
-                 self._dispatch_task_error],
-                prefix='dispatch_task:')
+        if 'redis_adhoc' in self.xmpp.plugin:
+            self.xmpp['xep_0050'].prep_handlers(
+                    [self._dispatch_task_next,
+                     self._dispatch_task_command,
+                     self._dispatch_task_done,
+                     self._dispatch_task_error],
+                    prefix='dispatch_task:')
 
     def clean_tasks(self):
-        log.debug("Clean pending and stalled tasks.")
-        stalled_jobs = self.kestrel.reset_stalled_tasks()
-        pending_jobs = self.kestrel.reset_pending_tasks()
-        jobs = stalled_jobs.union(pending_jobs)
-        for job in jobs:
-            self._dispatch_job(job)
+        if self.cluster is not None and not self.cluster.leader:
+            return
+        log.debug("Clean tasks with expired leases.")
+        jobs = self.kestrel.expire_leases()
+        if jobs:
+            self.dispatch(*jobs)
+
+    def hold_tasks(self):
+        """
+        Renew the pending leases of the bundled tasks waiting to be
+        sent, forgetting those that were cancelled or expired since.
+        """
+        with self.held_lock:
+            held = [(key, list(tasks)) for key, tasks in self.held.items()]
+        for (worker, job), tasks in held:
+            kept = set(self.kestrel.task_hold(worker, job, tasks))
+            dropped = [task for task in tasks if task not in kept]
+            if dropped:
+                self._release_held(worker, job, dropped)
+
+    def _hold(self, worker, job, tasks):
+        with self.held_lock:
+            self.held.setdefault((worker, job), set()).update(tasks)
+
+    def _release_held(self, worker, job, tasks):
+        with self.held_lock:
+            held = self.held.get((worker, job))
+            if held is None:
+                return
+            held.difference_update(tasks)
+            if not held:
+                del self.held[(worker, job)]
+
+    def dispatch(self, *jobs):
+        """
+        Request that the queued tasks of the given jobs be matched
+        with available workers.
+
+        The jobs are handed to the dispatch thread, which wakes up
+        immediately. Repeated requests for a job that is still waiting
+        to be dispatched are merged into one.
+
+        Arguments:
+            jobs -- The IDs of the jobs to dispatch.
+        """
+        with self._dispatch_cond:
+            self._dispatch_jobs.update(jobs)
+            self._dispatch_cond.notify()
+
+    def _process_dispatch(self):
+        while not self.stopping and not self.xmpp.stop.isSet():
+            with self._dispatch_cond:
+                if not self._dispatch_jobs:
+                    # Wake up now and then to notice a shutdown that
+                    # did not notify us.
+                    self._dispatch_cond.wait(1)
+                if not self._dispatch_jobs:
+                    continue
+                jobs = self._dispatch_jobs
+                self._dispatch_jobs = set()
+            for job in sorted(jobs, key=int):
+                try:
+                    self._dispatch_job(job)
+                except:
+                    log.exception('DISPATCH: Error dispatching job %s' % job)
+
+    def _process_available(self):
+        while not self.stopping and not self.xmpp.stop.isSet():
+            with self._available_cond:
+                if not self._available:
+                    self._available_cond.wait(1)
+                if not self._available:
+                    continue
+            time.sleep(self.presence_window)
+            # The batch is matched outside the lock so that presence
+            # handlers never wait on the backend. Workers that go busy
+            # meanwhile are noted and handled once the match is done.
+            with self._available_cond:
+                workers = self._available
+                self._available = {}
+                self._matching = set(workers)
+                self._went_busy = set()
+            try:
+                matches = self.kestrel.workers_available(workers)
+            except:
+                log.exception('POOL: Error matching available workers')
+                matches = []
+            finally:
+                with self._available_cond:
+                    went_busy = self._went_busy
+                    self._matching = set()
+                    self._went_busy = set()
+                self._invalidate_pages('available', 'busy')
+            if went_busy:
+                matches = self._recheck_busy(went_busy, matches)
+            jobs = {}
+            for worker, job, tasks in matches:
+                try:
+                    if job not in jobs:
+                        jobs[job] = self.kestrel.get_job(job)
+                    self._dispatch_bundle(worker, jobs[job], tasks)
+                except:
+                    log.exception('DISPATCH: Error dispatching to %s' % worker)
+
+    def _drop_available(self, worker):
+        """Forget a worker's availability that has not been matched yet."""
+        with self._available_cond:
+            self._available.pop(worker, None)
+            if worker in self._matching:
+                self._went_busy.add(worker)
+
+    def _recheck_busy(self, workers, matches):
+        """
+        Undo the matches of workers that went busy or offline while
+        their availability was being matched, since the match may
+        have overwritten their new state.
+
+        The backend only marks online workers busy, so workers that
+        went offline keep the offline state and their tasks are reset
+        like those of any other offline worker.
+
+        Returns the matches that may still be sent.
+        """
+        kept = []
+        reset_jobs = set()
+        for worker, job, tasks in matches:
+            if worker not in workers:
+                kept.append((worker, job, tasks))
+                continue
+            log.debug('POOL: %s went busy while being matched' % worker)
+            for task in tasks:
+                self.kestrel.task_reset(worker, job, task)
+            reset_jobs.add(job)
+        for worker in workers:
+            self.kestrel.worker_busy(worker)
+        self._invalidate_pages('available', 'busy')
+        if reset_jobs:
+            self.dispatch(*reset_jobs)
+        return kept
 
     def clean_pool(self, event):
         log.debug("Clean the worker pool.")
         self.kestrel.clean()
+        self._invalidate_pages()
+        for worker in self.kestrel.online_workers():
+            if self.cluster is not None and not self.cluster.owns(worker):
+                continue
+            self.xmpp['xep_0199'].send_ping(worker,
+                                            ifrom=self.pool_jid,
+                                            block=False)
+            self._discover_protocol(worker)
+
+    def _cluster_heartbeat(self):
+        if not self.cluster.heartbeat():
+            return
+        # Take over the workers moved into our partition, and forget
+        # about those that left it.
+        for worker in list(self.protocols):
+            if not self.cluster.owns(worker):
+                self.protocols.pop(worker, None)
+                self.cancellable.discard(worker)
+        available = self.kestrel.available_workers()
         for worker in self.kestrel.online_workers():
+            if worker in self.protocols or not self.cluster.owns(worker):
+                continue
+            log.debug('CLUSTER: Adopting worker %s' % worker)
             self.xmpp['xep_0199'].send_ping(worker,
                                             ifrom=self.pool_jid,
                                             block=False)
+            self._discover_protocol(worker, worker in available)
+
+    def _leave_cluster(self, event=None):
+        self.cluster.leave()
+
+    def _disconnected(self, event=None):
+        # A dropped stream is reconnected, so only a disconnect
+        # without one ends the manager.
+        if not getattr(self.xmpp, 'auto_reconnect', False):
+            self._shutdown()
+
+    def _shutdown(self, event=None):
+        """
+        Stop the handler threads once the manager is shutting down,
+        and wake the dispatch and presence threads so they can exit.
+        """
+        log.debug('POOL: Stopping the handler threads')
+        self.stopping = True
+        self.handlers.stop()
+        with self._dispatch_cond:
+            self._dispatch_cond.notify_all()
+        with self._available_cond:
+            self._available_cond.notify_all()
+
+    def _forward(self, event, worker, data):
+        """
+        Hand an event about a worker to the manager whose partition
+        the worker is in.
+
+        Arguments:
+            event  -- The name of the event.
+            worker -- The JID of the worker the event is about.
+            data   -- The event data, which must be JSON serializable.
+
+        Returns True if another manager will handle the event.
+        """
+        if self.cluster is None:
+            return False
+        key = json.dumps([event, data], sort_keys=True)
+        with self.hops_lock:
+            hops = self.hops.pop(key, 0)
+        owner = self.cluster.owner(worker)
+        if owner == self.cluster.name:
+            return False
+        if hops >= FORWARD_HOPS:
+            log.debug('CLUSTER: Handling %s for %s after %s hops' % (
+                event, worker, hops))
+            return False
+        message = {'event': event, 'data': data, 'hops': hops + 1}
+        if not self.cluster.publish(owner, message):
+            # The owner is gone or not listening, and the event would
+            # be lost.
+            log.debug('CLUSTER: %s is not listening, handling %s' % (
+                owner, event))
+            return False
+        return True
+
+    def _handle_cluster_message(self, message):
+        if 'stanza' in message:
+            iq = self.xmpp.Iq(xml=ET.fromstring(message['stanza']))
+            self._handle_task_result(iq)
+        elif 'event' in message:
+            key = json.dumps([message['event'], message['data']],
+                             sort_keys=True)
+            with self.hops_lock:
+                self.hops[key] = message.get('hops', 1)
+            self.xmpp.event(message['event'], message['data'])
 
     def _handle_online(self, presence):
         self.xmpp.send_presence(pto=presence['from'],
@@ -163,10 +566,17 @@ class kestrel_manager(base.base_plugin):
             return
         elif presence['type'] == 'unavailable':
             self.xmpp.event('kestrel_worker_offline', jid)
+        elif presence['kestrel_slots']['mode'] == 'pull':
+            # Pull mode workers claim their own tasks, so they are
+            # never offered any.
+            self.xmpp.event('kestrel_worker_busy', jid)
         elif presence['type'] in ['dnd', 'xa', 'away']:
             self.xmpp.event('kestrel_worker_busy', jid)
         elif presence['type'] in ['available', 'chat']:
-            self.xmpp.event('kestrel_worker_available', jid)
+            # Prefetched tasks hold a slot until they are started.
+            slots = presence['kestrel_slots']['total'] + \
+                    presence['kestrel_slots']['prefetch']
+            self.xmpp.event('kestrel_worker_available', (jid, slots or None))
 
     def _handle_subscribed(self, presence):
         self.xmpp.send_presence(pto=presence['from'],
@@ -174,7 +584,14 @@ class kestrel_manager(base.base_plugin):
                                 ptype='probe')
 
     def _handle_ping_error(self, iq):
-        self.kestrel.worker_offline(iq['from'].full)
+        # A worker that cannot be pinged is gone, and is handled like
+        # one that sent unavailable presence.
+        self.xmpp.event('kestrel_worker_offline', iq['from'].full)
+
+    def _handle_heartbeat(self, iq):
+        if iq['to'].full != self.pool_jid.full:
+            return
+        self.xmpp.event('kestrel_worker_heartbeat', iq['from'].full)
 
     def _disco_info(self, jid, node, data):
         info = self.xmpp['xep_0030'].stanza.DiscoInfo()
@@ -195,39 +612,137 @@ class kestrel_manager(base.base_plugin):
         return items
 
     def _disco_queued_jobs(self, jid, node, data):
-        items = self.xmpp['xep_0030'].stanza.DiscoItems()
-        jobs = self.kestrel.get_jobs()
-        for job in jobs:
-            owner = jobs[job]
-            items.add_item(jid=self.job_jid.full,
-                           node=job,
-                           name='Job %s: %s' % (job, owner))
-        return items
+        def render(jobs):
+            return [(self.job_jid.full, job, 'Job %s: %s' % (job, owner))
+                    for job, owner in jobs]
+        return self._disco_page(node, data,
+                                self.kestrel.scan_jobs,
+                                self.kestrel.count_jobs,
+                                render)
 
     def _disco_running_jobs(self, jid, node, data):
         items = self.xmpp['xep_0030'].stanza.DiscoItems()
         return items
 
     def _disco_online_workers(self, jid, node, data):
-        items = self.xmpp['xep_0030'].stanza.DiscoItems()
-        workers = self.kestrel.online_workers()
-        for worker in workers:
-            items.add_item(jid=worker, name="Kestrel Worker")
-        return items
+        return self._disco_workers('online', node, data)
 
     def _disco_available_workers(self, jid, node, data):
-        items = self.xmpp['xep_0030'].stanza.DiscoItems()
-        workers = self.kestrel.available_workers()
-        for worker in workers:
-            items.add_item(jid=worker, name="Kestrel Worker")
-        return items
+        return self._disco_workers('available', node, data)
 
     def _disco_busy_workers(self, jid, node, data):
-        items = self.xmpp['xep_0030'].stanza.DiscoItems()
-        workers = self.kestrel.busy_workers()
-        for worker in workers:
-            items.add_item(jid=worker, name="Kestrel Worker")
-        return items
+        return self._disco_workers('busy', node, data)
+
+    def _disco_workers(self, state, node, data):
+        def scan(cursor, count):
+            return self.kestrel.scan_workers(state, cursor, count)
+
+        def total():
+            return self.kestrel.count_workers(state)
+
+        def render(workers):
+            return [(worker, None, 'Kestrel Worker') for worker in workers]
+
+        return self._disco_page(node, data, scan, total, render)
+
+    def _disco_page(self, node, data, scan, total, render):
+        """
+        Answer a disco items request with one page of a large list,
+        following the XEP-0059 result set request it carries.
+
+        A position in the list is the backend's scan cursor and the
+        number of items already taken from the batch at that cursor.
+        The position after a page is given as the page's last item,
+        which the requester passes back as the after value to get the
+        next page. Backward paging is not supported, and a before
+        value restarts from the first page.
+
+        Arguments:
+            node   -- The disco node requested.
+            data   -- The disco items request.
+            scan   -- A function taking a cursor and a batch size and
+                      returning a (cursor, members) tuple.
+            total  -- A function returning the number of members.
+            render -- A function turning a list of members into a list
+                      of (jid, node, name) item tuples.
+        """
+        size = self.disco_page
+        after = ''
+        if isinstance(data, Iq):
+            rsm = data['disco_items']['rsm']
+            if rsm['max']:
+                size = max(min(int(rsm['max']), self.disco_page), 1)
+            after = rsm['after'] or ''
+
+        key = (node, after, size)
+        with self._pages_lock:
+            page = self._pages.get(key)
+            if page is not None and time.time() - page[0] > self.disco_cache:
+                page = None
+        if page is None:
+            page = (time.time(),) + self._read_page(after, size, scan,
+                                                    total, render)
+            with self._pages_lock:
+                now = time.time()
+                self._pages = dict((k, v) for k, v in self._pages.items()
+                                   if now - v[0] <= self.disco_cache)
+                self._pages[key] = page
+
+        read, items, first, last, count = page
+        stanza = self.xmpp['xep_0030'].stanza.DiscoItems()
+        for item in items:
+            stanza.add_item(jid=item[0], node=item[1], name=item[2])
+        stanza['rsm']['count'] = str(count)
+        if items:
+            stanza['rsm']['first'] = first
+            stanza['rsm']['last'] = last
+        return stanza
+
+    def _read_page(self, after, size, scan, total, render):
+        """
+        Read a page of members from the backend, starting at a
+        position given by a previous page.
+
+        Returns a tuple of the rendered items, the positions before
+        and after the page, and the total number of members.
+        """
+        members = []
+        cursor, skip = 0, 0
+        if after == 'end':
+            cursor = None
+        elif after:
+            try:
+                cursor, skip = [int(part) for part in after.split(':')]
+            except ValueError:
+                cursor, skip = 0, 0
+        first = 'end' if cursor is None else '%s:%s' % (cursor, skip)
+
+        last = 'end'
+        while cursor is not None and len(members) < size:
+            next_cursor, batch = scan(cursor, size)
+            taken = batch[skip:skip + size - len(members)]
+            members.extend(taken)
+            if skip + len(taken) < len(batch):
+                last = '%s:%s' % (cursor, skip + len(taken))
+                break
+            skip = 0
+            cursor = next_cursor or None
+            if cursor is not None:
+                last = '%s:0' % cursor
+        return render(members), first, last, total()
+
+    def _invalidate_pages(self, *nodes):
+        """
+        Drop the cached disco pages of the nodes whose membership
+        changed, or every page when no node is given.
+        """
+        with self._pages_lock:
+            if not nodes:
+                self._pages = {}
+                return
+            self._pages = dict((key, page)
+                               for key, page in self._pages.items()
+                               if key[0] not in nodes)
 
     def _handle_submit_job(self, job):
         job, matches = self.kestrel.submit_job(
@@ -236,53 +751,224 @@ class kestrel_manager(base.base_plugin):
                 job['command'],
                 job['cleanup'],
                 job['size'],
-                job['requirements'])
-        self._dispatch_job(job)
+                job['requirements'],
+                job.get('priority', 0),
+                job.get('bundle', 1),
+                job.get('walltime', 0),
+                job.get('retries', 0))
+        self._invalidate_pages('queued')
+        if matches:
+            job = self.kestrel.get_job(job)
+            for worker, tasks in matches:
+                self._dispatch_bundle(worker, job, tasks)
 
     def _handle_cancel_job(self, data):
         user, job = data
+        started = time.time()
         cancellations = self.kestrel.cancel_job(job, user)
+        self._invalidate_pages('queued')
+        if not cancellations:
+            return
+        for worker in sorted(cancellations):
+            tasks = sorted(cancellations[worker], key=int)
+            self.xmpp.event('kestrel_cancel_tasks',
+                            (worker, job, tasks, started))
+
+    def _handle_cancel_tasks(self, data):
+        """
+        Ask a worker to stop every task of a cancelled job that it
+        runs, with a single stanza. The worker's slots were already
+        freed in the backend, and are offered to other jobs once the
+        worker reports that the tasks were stopped.
+        """
+        worker, job, tasks, started = data
+        if self._forward('kestrel_cancel_tasks', worker, data):
+            return
+        if worker not in self.cancellable:
+            log.debug('CANCEL: %s can not cancel tasks %s,%s' % (
+                worker, job, ','.join(tasks)))
+            return
+
+        def handle_result(iq):
+            if iq['type'] == 'error':
+                log.debug('CANCEL: %s could not cancel tasks of %s' % (
+                    worker, job))
+                return
+            self.metrics['cancel_latency'].record(time.time() - started)
+            self.xmpp.event('kestrel_worker_available', (worker, None))
+
+        log.debug('CANCEL: Cancelling tasks %s,%s on %s' % (
+            job, ','.join(tasks), worker))
+        iq = self.xmpp.Iq()
+        iq['type'] = 'set'
+        iq['to'] = worker
+        iq['kestrel_cancel']['job'] = job
+        for task in tasks:
+            iq['kestrel_cancel'].add_task(task)
+        self._send(worker, iq, handle_result)
 
     def _handle_register_worker(self, data):
         worker, caps = data
         self.kestrel.register_worker(worker, caps)
+        self._invalidate_pages('online', 'available', 'busy')
+        self._handle_discover_worker(worker)
 
-    def _handle_worker_available(self, worker):
-        task = self.kestrel.worker_available(worker)
-        if not task:
-            log.debug('NO MATCHES')
+    def _handle_discover_worker(self, worker):
+        if self._forward('kestrel_discover_worker', worker, worker):
             return
-        log.debug('MATCH: %s %s, %s' % (worker, task[0], task[1]))
-        job = self.kestrel.get_job(task[0])
-        self._dispatch_task(worker, job, task[1])
+        self._discover_protocol(worker)
+
+    def _discover_protocol(self, worker, available=False):
+        """
+        Find out which dispatch protocol a worker understands.
+
+        Arguments:
+            worker    -- The worker's JID.
+            available -- Fill the worker's free slots once the
+                         protocol is known.
+        """
+        def handle_info(iq):
+            features = []
+            if iq['type'] == 'result':
+                features = iq['disco_info']['features']
+            if BUNDLE_FEATURE in features:
+                log.debug('WORKER: %s accepts bundle stanzas' % worker)
+                self.protocols[worker] = 'bundle'
+            elif DISPATCH_FEATURE in features:
+                log.debug('WORKER: %s accepts task stanzas' % worker)
+                self.protocols[worker] = 'stanza'
+            else:
+                self.protocols[worker] = 'adhoc'
+            if CANCEL_FEATURE in features:
+                self.cancellable.add(worker)
+            else:
+                self.cancellable.discard(worker)
+            if available:
+                self.xmpp.event('kestrel_worker_available', (worker, None))
+
+        iq = self.xmpp.Iq()
+        iq['type'] = 'get'
+        iq['to'] = worker
+        iq.enable('disco_info')
+        self._send(worker, iq, handle_info)
+
+    def _handle_worker_available(self, data):
+        worker, slots = data
+        if self._forward('kestrel_worker_available', worker, data):
+            return
+        with self._available_cond:
+            # Keep the slots of an earlier announcement if this one
+            # does not give any.
+            self._available[worker] = slots or \
+                                      self._available.get(worker, None)
+            self._available_cond.notify()
 
     def _handle_worker_busy(self, worker):
+        if self._forward('kestrel_worker_busy', worker, worker):
+            return
         log.debug('WORKER: %s busy' % worker)
+        self._drop_available(worker)
         self.kestrel.worker_busy(worker)
+        self._invalidate_pages('available', 'busy')
 
     def _handle_worker_offline(self, worker):
+        if self._forward('kestrel_worker_offline', worker, worker):
+            return
         log.debug('WORKER: %s offline' % worker)
+        self._drop_available(worker)
+        self.protocols.pop(worker, None)
+        self.cancellable.discard(worker)
+        with self.pending_lock:
+            for id in [id for id in self.pending
+                       if self.pending[id][0] == worker]:
+                del self.pending[id]
         resets = self.kestrel.worker_offline(worker)
+        self._invalidate_pages('online', 'available', 'busy')
         if resets:
             log.debug('RESETS: %s' % str(resets))
-            for job in resets:
-                for task in resets[job]:
-                    self.kestrel.task_reset(worker, job, task)
+            self.dispatch(*resets)
+
+    def _handle_worker_heartbeat(self, worker):
+        self.kestrel.worker_heartbeat(worker)
 
     def _handle_complete_job(self, job):
+        self._invalidate_pages('queued')
         job = self.kestrel.get_job(job)
         self.xmpp.send_message(mto=job['owner'],
                                mfrom=self.job_jid,
                                mbody='Job %s has completed.' % job['id'])
         log.debug('JOB: Job %s has completed' % job['id'])
 
-    def _dispatch_task(self, worker, job, task):
-        self.kestrel.task_start(worker, job['id'], task)
+    def _dispatch_bundle(self, worker, job, tasks):
+        """
+        Send a bundle of tasks to a worker. Workers that accept bundle
+        stanzas receive the whole bundle at once; other workers are
+        sent its tasks one after the other, since the bundle only
+        holds a single one of their slots.
+
+        Arguments:
+            worker -- The worker's JID.
+            job    -- The job's data, as returned by get_job.
+            tasks  -- The list of tasks in the bundle.
+        """
+        if self._forward('kestrel_dispatch', worker,
+                         (worker, job['id'], tasks)):
+            return
+        if len(tasks) > 1 and self.protocols.get(worker) == 'bundle':
+            self._send_bundle(worker, job, tasks)
+            return
+        # Waiting tasks stay pending until they are sent, with their
+        # leases renewed by hold_tasks while the tasks ahead of them run.
+        self._hold(worker, job['id'], tasks[1:])
+        self._dispatch_task(worker, job, tasks[0], tasks[1:])
+
+    def _handle_dispatch(self, data):
+        worker, job, tasks = data
+        self._dispatch_bundle(worker, self.kestrel.get_job(job), tasks)
+
+    def _send(self, worker, iq, callback):
+        """
+        Send a stanza to a worker, passing the worker's reply to
+        a callback. The reply is forwarded to us if it reaches another
+        manager of the cluster.
+        """
+        with self.pending_lock:
+            self.pending[iq['id']] = (worker, callback)
+        iq['from'] = self.dispatch_jid
+        iq.send(block=False)
+
+    def _handle_task_result(self, iq):
+        with self.pending_lock:
+            pending = self.pending.pop(iq['id'], None)
+        if pending is not None:
+            pending[1](iq)
+            return
+        instance = iq['to'].resource
+        if self.cluster is not None and instance and \
+           instance != self.cluster.name and \
+           instance in self.cluster.members:
+            self.cluster.publish(instance, {'stanza': str(iq)})
+
+    def _dispatch_task(self, worker, job, task, remaining=()):
+        self._release_held(worker, job['id'], [task])
+        if not self.kestrel.task_start(worker, job['id'], task):
+            # The task was cancelled or its lease expired while it
+            # waited behind the rest of its bundle.
+            log.debug('TASK: Task %s,%s no longer held by %s' % (
+                job['id'], task, worker))
+            if remaining:
+                self._dispatch_task(worker, job, remaining[0], remaining[1:])
+            return
+        if self.protocols.get(worker, 'adhoc') in ('stanza', 'bundle'):
+            self._send_task(worker, job, task, remaining)
+            return
         session = {
             'worker': worker,
             'job_id': job['id'],
             'job': job,
             'task': task,
+            'bundle': list(remaining),
+            'started': time.time(),
             'next': self._dispatch_task_next,
             'error': self._dispatch_task_error
         }
@@ -291,6 +977,242 @@ class kestrel_manager(base.base_plugin):
                                             session,
                                             ifrom=self.pool_jid.full)
 
+    def _send_task(self, worker, job, task, remaining=()):
+        """
+        Send a task to a worker as a single kestrel:tasks stanza. The
+        worker's reply reports the outcome once the task and its
+        cleanup have finished, and the next task of the bundle, if
+        any, is sent after it.
+        """
+        job_id = job['id']
+        started = time.time()
+
+        def handle_result(iq):
+            if iq['type'] == 'error':
+                self._task_error(iq, worker, job_id, task, remaining)
+                return
+            resources = {task: iq['kestrel_task']['resources']}
+            if iq['kestrel_task']['status'] == 'cancelled':
+                # The job was cancelled, which already took the task
+                # off the worker, so there is nothing to reset.
+                log.debug('TASK: Task %s,%s cancelled on %s' % (
+                    job_id, task, worker))
+            elif iq['kestrel_task']['status'] == 'timeout':
+                self._timeout_tasks(worker, job, [task], resources)
+            else:
+                self._finish_tasks(worker, job, [task], started, resources)
+            for output in iq['kestrel_task']['outputs']:
+                self._store_output(job_id, task, output)
+            if remaining:
+                self._dispatch_task(worker, job, remaining[0], remaining[1:])
+
+        iq = self.xmpp.Iq()
+        iq['type'] = 'set'
+        iq['to'] = worker
+        iq['kestrel_task']['job'] = job_id
+        iq['kestrel_task']['id'] = task
+        iq['kestrel_task']['command'] = '%s %s' % (job['command'], task)
+        iq['kestrel_task']['cleanup'] = job['cleanup']
+        if self._walltime(job):
+            iq['kestrel_task']['walltime'] = self._walltime(job)
+        self._send(worker, iq, handle_result)
+
+    def _send_bundle(self, worker, job, tasks):
+        """
+        Send a bundle of tasks to a worker as a single kestrel:tasks
+        stanza. The worker's reply reports the outcome of every task
+        once the last one has finished. Tasks that ran out of time are
+        handled as the job's retries allow, and other tasks that did
+        not complete are requeued.
+        """
+        job_id = job['id']
+        started = time.time()
+
+        def handle_result(iq):
+            if iq['type'] == 'error':
+                self._task_error(iq, worker, job_id, tasks[0], tasks[1:])
+                return
+            complete = set()
+            timeouts = set()
+            resources = {}
+            for task in iq['kestrel_bundle']['tasks']:
+                if task['status'] == 'complete':
+                    complete.add(task['id'])
+                    resources[task['id']] = task['resources']
+                elif task['status'] == 'timeout':
+                    timeouts.add(task['id'])
+                    resources[task['id']] = task['resources']
+                for output in task['outputs']:
+                    self._store_output(job_id, task['id'], output)
+            self._finish_tasks(worker, job,
+                               [task for task in tasks if task in complete],
+                               started, resources)
+            self._timeout_tasks(worker, job,
+                                [task for task in tasks if task in timeouts],
+                                resources)
+            resets = [task for task in tasks
+                      if task not in complete and task not in timeouts]
+            for task in resets:
+                self.kestrel.task_reset(worker, job_id, task)
+            if resets:
+                self.dispatch(job_id)
+
+        tasks = [task for task in tasks
+                 if self.kestrel.task_start(worker, job_id, task)]
+        if not tasks:
+            return
+        iq = self.xmpp.Iq()
+        iq['type'] = 'set'
+        iq['to'] = worker
+        iq['kestrel_bundle']['job'] = job_id
+        iq['kestrel_bundle']['cleanup'] = job['cleanup']
+        if self._walltime(job):
+            iq['kestrel_bundle']['walltime'] = self._walltime(job)
+        for task in tasks:
+            iq['kestrel_bundle'].add_task(
+                    task, command='%s %s' % (job['command'], task))
+        self._send(worker, iq, handle_result)
+
+    def _handle_output(self, iq):
+        output = iq['kestrel_output']
+        job, task, stream = output['job'], output['id'], output['stream']
+        worker = iq['from'].full
+        if self.kestrel.task_owner(job, task) != worker:
+            log.debug('TASK: Output of %s,%s from %s, which does not ' % (
+                job, task, worker) + 'hold the task')
+            iq.exception(XMPPError('not-authorized', etype='cancel'))
+            return
+        try:
+            seq = int(output['seq'] or 0)
+        except ValueError:
+            seq = None
+        key = (job, task, stream)
+        with self.output_lock:
+            # A first piece starts the stream over, as when the task
+            # is run again after being requeued.
+            expected = 0 if seq == 0 else self.output_seqs.get(key, 0)
+            if seq == expected:
+                if output['final'] == 'true':
+                    self.output_seqs.pop(key, None)
+                else:
+                    self.output_seqs[key] = seq + 1
+        if seq != expected:
+            log.debug('TASK: Output %s of %s,%s %s out of order, ' % (
+                seq, job, task, stream) + 'expected %s' % expected)
+            iq.exception(XMPPError('unexpected-request', etype='modify'))
+            return
+        self._store_output(job, task, output, seq)
+        iq.reply().send()
+
+    def _forget_output(self, job, tasks):
+        """Drop the stream positions of tasks that have been reported."""
+        tasks = set(str(task) for task in tasks)
+        with self.output_lock:
+            for key in [key for key in self.output_seqs
+                        if key[0] == str(job) and key[1] in tasks]:
+                del self.output_seqs[key]
+
+    def _store_output(self, job, task, output, seq=None):
+        """
+        Write task output returned by a worker to the output directory,
+        as [output_dir]/[job]/[task].[stream].
+
+        Arguments:
+            job    -- The ID of the job the task belongs to.
+            task   -- The task's number within the job.
+            output -- The Output stanza.
+            seq    -- The position of the piece within the stream, or
+                      None if the output is the end of the stream.
+        """
+        stream = output['stream']
+        if stream not in ('stdout', 'stderr'):
+            return
+        if not self.output_dir:
+            log.debug('TASK: Output of %s,%s %s not stored' % (
+                job, task, stream))
+            return
+        try:
+            data = decompress(output['data'])
+            path = os.path.join(self.output_dir, str(int(job)))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            path = os.path.join(path, '%s.%s' % (int(task), stream))
+            if seq:
+                # Later pieces are appended until the limit is reached.
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                data = data[:max(self.output_limit - size, 0)]
+                mode = 'ab'
+            else:
+                data = data[:self.output_limit]
+                mode = 'wb'
+            with open(path, mode) as f:
+                f.write(data)
+        except:
+            log.exception('TASK: Could not store output of %s,%s' % (
+                job, task))
+
+    def _finish_tasks(self, worker, job, tasks, started, resources=None):
+        """
+        Mark tasks finished by a worker as completed, record the
+        resources they used, and record how long they took for jobs
+        with automatically sized bundles.
+
+        Arguments:
+            worker    -- The worker's JID.
+            job       -- The job's data, as returned by get_job.
+            tasks     -- The list of finished tasks.
+            started   -- The time the tasks were sent to the worker.
+            resources -- A dictionary of the resources each task used,
+                         as reported by the worker.
+        """
+        self._forget_output(job['id'], tasks)
+        for task in tasks:
+            if self.kestrel.task_finish(worker, job['id'], task):
+                self.xmpp.event('kestrel_job_complete', job['id'])
+        measured = dict((task, resources[task]) for task in tasks
+                        if resources and resources.get(task))
+        if measured:
+            self.kestrel.record_resources(job['id'], measured)
+        if tasks and job.get('bundle') == '0':
+            self.kestrel.record_runtime(job['id'],
+                                        task_seconds(tasks, measured,
+                                                     started),
+                                        len(tasks))
+
+    def _timeout_tasks(self, worker, job, tasks, resources=None):
+        """
+        Record the resources used by tasks that a worker stopped for
+        running past the job's walltime, and requeue or fail each
+        of them as the job's retries allow.
+
+        Arguments:
+            worker    -- The worker's JID.
+            job       -- The job's data, as returned by get_job.
+            tasks     -- The list of tasks that ran out of time.
+            resources -- A dictionary of the resources each task used,
+                         as reported by the worker.
+        """
+        self._forget_output(job['id'], tasks)
+        measured = dict((task, resources[task]) for task in tasks
+                        if resources and resources.get(task))
+        if measured:
+            self.kestrel.record_resources(job['id'], measured)
+        requeued = False
+        for task in tasks:
+            outcome = self.kestrel.task_timeout(worker, job['id'], task)
+            if outcome == 'completed':
+                self.xmpp.event('kestrel_job_complete', job['id'])
+            requeued = requeued or outcome == 'requeued'
+        if requeued:
+            self.dispatch(job['id'])
+
+    def _walltime(self, job):
+        """Return a job's walltime for a task stanza, or None."""
+        walltime = float(job.get('walltime') or 0)
+        if walltime > 0:
+            return '%g' % walltime
+        return None
+
     def _dispatch_task_next(self, iq, session):
         job = session['job']
         task = session['task']
@@ -308,10 +1230,7 @@ class kestrel_manager(base.base_plugin):
         job = session['job']
         task = session['task']
 
-        if self.kestrel.task_finish(session['worker'],
-                                    session['job_id'],
-                                    session['task']):
-            self.xmpp.event('kestrel_job_complete', job['id'])
+        self._finish_tasks(session['worker'], job, [task], session['started'])
 
         form = self.xmpp['xep_0004'].makeForm()
         form['type'] = 'submit'
@@ -319,20 +1238,39 @@ class kestrel_manager(base.base_plugin):
 
         session['payload'] = form
         session['next'] = None
+        if session['bundle']:
+            # The worker's slot is free again once the cleanup is done.
+            session['next'] = self._dispatch_task_done
 
         self.xmpp['xep_0050'].complete_command(session)
 
+    def _dispatch_task_done(self, iq, session):
+        remaining = session['bundle']
+        self._dispatch_task(session['worker'], session['job'],
+                            remaining[0], remaining[1:])
+
     def _dispatch_task_error(self, iq, session):
-        self.kestrel.task_reset(session['worker'],
-                                session['job'],
-                                session['task'])
-        self._dispatch_job(session['job'])
+        self._task_error(iq,
+                         session['worker'],
+                         session['job_id'],
+                         session['task'],
+                         session.get('bundle', ()))
+
+    def _task_error(self, iq, worker, job, task, remaining=()):
+        if iq['error']['condition'] == 'resource-constraint':
+            # The worker is full even if its presence has not caught
+            # up yet; keep it out of the redispatch.
+            self.kestrel.worker_busy(worker)
+        # The rest of the bundle is never sent once a task fails.
+        self._release_held(worker, job, remaining)
+        self._forget_output(job, [task])
+        for task in [task] + list(remaining):
+            self.kestrel.task_reset(worker, job, task)
+        self.dispatch(job)
 
     def _dispatch_job(self, job):
         matches = self.kestrel.job_matches(job)
         log.debug("MATCHES: %s %s" % (job, matches))
         job = self.kestrel.get_job(job)
-        if matches:
-            for task in matches:
-                worker = matches[task]
-                self._dispatch_task(worker, job, task)
+        for worker, tasks in matches:
+            self._dispatch_bundle(worker, job, tasks)
@@ -0,0 +1,118 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import logging
+import threading
+import time
+
+import sleekxmpp
+from sleekxmpp.plugins.base import base_plugin
+
+from kestrel.backend import ScriptedKestrel, task_seconds
+from kestrel.connection import blocking_client, connect
+
+
+log = logging.getLogger(__name__)
+
+
+class kestrel_pull(base_plugin):
+
+    """
+    Claim tasks straight from the manager's Redis server instead of
+    waiting for the manager to send them.
+
+    Whenever the executor can take another task, the worker blocks
+    on the ready lists of the signatures it meets, claims a bundle of
+    tasks once woken, and runs it. Task state is kept in the same keys
+    used by kestrel.backend.Kestrel, so job status, cancellation and
+    lease expiry work as they do for other workers. Completed jobs are
+    handed back to the manager to announce to their owners.
+
+    The worker must still join the pool, so that the manager records
+    the signatures it meets and renews its leases on each heartbeat.
+    """
+
+    def plugin_init(self):
+        self.description = "Claim Kestrel tasks from Redis"
+
+        self.redis = connect(self.config)
+        self.blocking = blocking_client(self.redis)
+        self.kestrel = ScriptedKestrel(
+                self.redis,
+                running_lease=self.config.get('running_lease', 60),
+                halflife=self.config.get('usage_halflife', 86400),
+                bundle_target=self.config.get('bundle_target', 5))
+        self.timeout = self.config.get('timeout', 5)
+        self.thread = None
+
+        self.xmpp.add_event_handler('session_start', self.start)
+
+    def start(self, event):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(name='Kestrel Pull',
+                                       target=self._pull)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _pull(self):
+        executor = self.xmpp['kestrel_executor']
+        while not self.xmpp.stop.isSet():
+            if not executor.wait_for_slot(self.timeout):
+                continue
+            name = self.xmpp.boundjid.full
+            queues = self.kestrel.pull_queues(name)
+            if not queues:
+                # We have not joined the pool yet.
+                time.sleep(self.timeout)
+                continue
+            try:
+                popped = self.blocking.blpop(queues, self.timeout)
+                if popped is None:
+                    continue
+                sig = popped[0][len('signature:'):-len(':ready')]
+                match = self.kestrel.pull_task(name, sig)
+                if match is not None:
+                    self._run(name, *match)
+            except:
+                log.exception('PULL: Error claiming tasks')
+                time.sleep(self.timeout)
+
+    def _run(self, name, job, tasks):
+        data = self.kestrel.get_job(job)
+        started = time.time()
+
+        def finished(statuses, resources):
+            complete = [task for task, status in statuses
+                        if status == 'complete']
+            for task in complete:
+                self.kestrel.pull_finish(name, job, task)
+            for task, status in statuses:
+                if status == 'timeout':
+                    self.kestrel.pull_timeout(name, job, task)
+                elif status != 'complete':
+                    self.kestrel.task_reset(name, job, task)
+            if resources:
+                self.kestrel.record_resources(job, resources)
+            if complete and data.get('bundle') == '0':
+                self.kestrel.record_runtime(job,
+                                            task_seconds(complete, resources,
+                                                         started),
+                                            len(complete))
+
+        commands = [(task, '%s %s' % (data['command'], task))
+                    for task in tasks]
+        log.debug('PULL: Running tasks %s,%s' % (job, ','.join(tasks)))
+        try:
+            self.xmpp['kestrel_executor'].run_bundle(
+                    job, commands, data['cleanup'], finished,
+                    float(data.get('walltime') or 0) or None)
+        except:
+            log.exception('PULL: Could not start tasks %s' % job)
+            for task in tasks:
+                self.kestrel.task_reset(name, job, task)
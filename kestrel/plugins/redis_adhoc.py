@@ -6,7 +6,6 @@
     See the file LICENSE for copying permission.
 """
 
-import redis
 import logging
 import pickle
 import types
@@ -15,6 +14,8 @@ import sleekxmpp
 from sleekxmpp.xmlstream import JID, ElementBase, ET
 from sleekxmpp.plugins.base import base_plugin
 
+from kestrel.connection import connect
+
 
 log = logging.getLogger(__name__)
 
@@ -41,9 +42,7 @@ class redis_adhoc(base_plugin):
         the roster backend.
         """
         self.description = 'Redis AdHoc'
-        self.redis = redis.Redis(host=self.config.get('host', 'localhost'),
-                                 port=self.config.get('port', 6379),
-                                 db=self.config.get('db', 0))
+        self.redis = connect(self.config)
         self.funcs = {}
 
     def post_init(self):
@@ -6,11 +6,11 @@
     See the file LICENSE for copying permission.
 """
 
-import redis
-
 import sleekxmpp
 from sleekxmpp.plugins.base import base_plugin
 
+from kestrel.connection import connect
+
 
 class redis_id(base_plugin):
 
@@ -34,9 +34,7 @@ class redis_id(base_plugin):
         """
         """
         self.description = 'Redis ID'
-        self.redis = redis.Redis(host=self.config.get('host', 'localhost'),
-                                 port=self.config.get('port', 6379),
-                                 db=self.config.get('db', 0))
+        self.redis = connect(self.config)
 
     def post_init(self):
         """"""
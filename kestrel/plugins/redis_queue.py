@@ -6,14 +6,14 @@
     See the file LICENSE for copying permission.
 """
 
-import redis
 import logging
 import threading
 
-
 import sleekxmpp
 from sleekxmpp.plugins.base import base_plugin
 
+from kestrel.connection import blocking_client, connect
+
 
 log = logging.getLogger(__name__)
 
@@ -23,10 +23,11 @@ class redis_queue(base_plugin):
     def plugin_init(self):
         self.description = "Redis queue backend for Kestrel"
 
-        self.redis = redis.Redis(host=self.config.get('host', 'localhost'),
-                                 port=self.config.get('port', 6379),
-                                 db=self.config.get('db', 0))
+        self.redis = connect(self.config)
+        # Each queue handler waits in BLPOP on a connection of its own.
+        self.blocking = blocking_client(self.redis)
         self._handlers = {}
+        self._started = False
 
     def post_init(self):
         base_plugin.post_init(self)
@@ -35,17 +36,26 @@ class redis_queue(base_plugin):
     def add_queue_handler(self, queue, handler):
         def process():
             while not self.xmpp.stop.isSet():
-                _, data = self.redis.blpop(queue)
-                handler(data)
+                _, data = self.blocking.blpop(queue)
+                try:
+                    handler(data)
+                except:
+                    log.exception("Error handling item from %s" % queue)
         self._handlers[queue] = process
+        if self._started:
+            self._start(queue)
 
     def process(self):
+        self._started = True
         for queue in self._handlers:
-            log.debug("Starting handler for %s" % queue)
-            t = threading.Thread(name=queue,
-                                 target=self._handlers[queue])
-            t.daemon = True
-            t.start()
+            self._start(queue)
+
+    def _start(self, queue):
+        log.debug("Starting handler for %s" % queue)
+        t = threading.Thread(name=queue,
+                             target=self._handlers[queue])
+        t.daemon = True
+        t.start()
 
     def queue(self, name, value):
         self.redis.rpush(name, value)
@@ -6,12 +6,13 @@
     See the file LICENSE for copying permission.
 """
 
-import redis
 import logging
 
 import sleekxmpp
 from sleekxmpp.plugins.base import base_plugin
 
+from kestrel.connection import connect
+
 
 log = logging.getLogger(__name__)
 
@@ -43,9 +44,7 @@ class redis_roster(base_plugin):
         """
         self.description = 'Redis Roster'
 
-        self.redis = redis.Redis(host=self.config.get('host', 'localhost'),
-                                 port=self.config.get('port', 6379),
-                                 db=self.config.get('db', 0))
+        self.redis = connect(self.config)
         self.fields = set(('name', 'groups', 'from', 'to', 'whitelisted',
                            'pending_out', 'pending_in'))
         self.boolean_fields = set(('from', 'to', 'whitelisted',
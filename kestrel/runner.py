@@ -0,0 +1,453 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+
+    Warm Python interpreters for jobs whose command names a Python
+    entry point instead of a shell command:
+
+        python:package.module:function
+
+    As with shell commands, the task's number is appended to the
+    command by the manager, and every word after the entry point is
+    passed to the function as a string argument. The function's return
+    value is the task's exit status, with None counting as success.
+
+    The worker keeps interpreters that have already imported an entry
+    point's module and feeds them one task at a time, so a task costs
+    a function call instead of a shell, an interpreter and its imports.
+    An interpreter is replaced after a number of tasks, or once its
+    memory use has grown by too much since it started. A task that
+    runs past its time limit is stopped along with its interpreter.
+
+    Output that a task writes through sys.stdout and sys.stderr goes to
+    its spool. Output written straight to the file descriptors, such as
+    by child processes of the task, is discarded or logged by the worker.
+"""
+
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from kestrel.supervisor import KILL_GRACE
+
+
+log = logging.getLogger(__name__)
+
+
+# The prefix of commands naming a Python entry point.
+PREFIX = 'python:'
+
+
+def parse(command):
+    """
+    Split a command naming a Python entry point into the entry point
+    and the arguments for it, or return None for a shell command.
+    """
+    if not command.startswith(PREFIX):
+        return None
+    words = command[len(PREFIX):].split()
+    if not words or words[0].count(':') != 1:
+        return None
+    return words[0], words[1:]
+
+
+def load(entry):
+    """Import the function named by a module:function entry point."""
+    module, function = entry.split(':')
+    target = __import__(module, fromlist=['__name__'])
+    for attr in function.split('.'):
+        target = getattr(target, attr)
+    return target
+
+
+# The resources a task used, shaped like the rusage of a process.
+Rusage = collections.namedtuple('Rusage', 'ru_utime ru_stime ru_maxrss')
+
+
+def usage():
+    """
+    Return the user and system CPU seconds used by this process so
+    far, and its peak resident memory in kilobytes.
+    """
+    try:
+        import resource
+    except ImportError:
+        return Rusage(0.0, 0.0, 0)
+    used = resource.getrusage(resource.RUSAGE_SELF)
+    peak = used.ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    return Rusage(used.ru_utime, used.ru_stime, peak)
+
+
+class Runner(object):
+
+    """
+    A warm interpreter running the tasks of one entry point, one at
+    a time.
+
+    Requests are sent to the interpreter's input as lines of JSON,
+    and it answers each on its output the same way once the task is
+    done. Its error output is logged.
+    """
+
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.uses = 0
+        self.baseline = None
+        self.task = None
+        self.buffer = b''
+        self.process = pool.supervisor.spawn(
+                [pool.python, '-m', 'kestrel.runner', entry],
+                self, self._exited, stdin=True, env=pool.env)
+        log.debug('RUNNER: Started interpreter %s for %s' % (
+            self.process.pid, entry))
+
+    def start(self, task, args):
+        spool = task.spool
+        request = {'args': args,
+                   'spool': spool.path if spool is not None else None,
+                   'limit': self.pool.limit,
+                   'backups': self.pool.backups}
+        # The answer may come before the write returns.
+        self.task = task
+        try:
+            self.process.popen.stdin.write(
+                    (json.dumps(request) + '\n').encode('utf-8'))
+            self.process.popen.stdin.flush()
+        except (IOError, OSError):
+            with self.pool.lock:
+                if self.task is task:
+                    self.task = None
+                    raise
+
+    def retire(self):
+        """Let the interpreter exit once it is done with its task."""
+        try:
+            self.process.popen.stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def write(self, stream, data):
+        if stream == 'stderr':
+            log.info('RUNNER: %s: %s' % (
+                self.entry, data.decode('utf-8', 'replace').rstrip()))
+            return
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.pool._message(self, json.loads(line.decode('utf-8')))
+
+    def _exited(self, process):
+        self.pool._exited(self)
+
+
+class RunnerTask(object):
+
+    """
+    A task run by a warm interpreter, standing in for the Process
+    of a task run as a shell command.
+
+    Attributes:
+        pid        -- The process ID of the interpreter while it runs
+                      the task, or None.
+        started    -- The time the task was started.
+        ended      -- The time the task finished.
+        returncode -- The task's exit status, or minus the signal
+                      that killed the interpreter running it.
+        rusage     -- The CPU time the task used and the interpreter's
+                      peak memory, as a Rusage.
+        spool      -- The Spool the task's output is written to.
+        timed_out  -- True if the task was stopped for running past
+                      its time limit.
+    """
+
+    def __init__(self, runner, spool, callback):
+        self.runner = runner
+        self.spool = spool
+        self.callback = callback
+        self.started = time.time()
+        self.ended = None
+        self.returncode = None
+        self.rusage = None
+        self.timed_out = False
+
+    @property
+    def pid(self):
+        if self.runner.task is self:
+            return self.runner.process.pid
+        return None
+
+
+class RunnerPool(object):
+
+    """
+    The warm interpreters of a worker, shared by every entry point.
+
+    An interpreter is started whenever a task finds none idle for its
+    entry point, and goes back to the pool once the task is done. The
+    least recently used idle interpreters are stopped once there are
+    more than the pool may keep. Interpreters for the entry points a
+    worker expects may be started ahead of time with warm().
+    """
+
+    def __init__(self, supervisor, idle=1, tasks=100, growth=262144,
+                 python=None, limit=10485760, backups=1):
+        """
+        Arguments:
+            supervisor -- The Supervisor starting the interpreters.
+            idle       -- The number of idle interpreters to keep.
+            tasks      -- The number of tasks an interpreter runs
+                          before it is replaced, or 0 for no limit.
+            growth     -- The number of kilobytes an interpreter's
+                          memory use may grow by before it is replaced,
+                          or 0 for no limit.
+            python     -- The Python executable, by default our own.
+            limit      -- The size in bytes at which output files
+                          are rotated.
+            backups    -- The number of rotated output files to keep.
+        """
+        self.supervisor = supervisor
+        self.idle_limit = idle
+        self.tasks = tasks
+        self.growth = growth
+        self.python = python or sys.executable
+        self.limit = limit
+        self.backups = backups
+        self.idle = []
+        self.lock = threading.Lock()
+
+        # Make sure the interpreters find the same kestrel package.
+        path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join(
+                [path] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+
+    def run(self, entry, args, spool, callback, walltime=None,
+            grace=KILL_GRACE):
+        """
+        Run a task in a warm interpreter.
+
+        Arguments:
+            entry    -- The module:function entry point.
+            args     -- The arguments to pass to the function.
+            spool    -- The Spool to write the task's output to.
+            callback -- Called with the RunnerTask once it is done.
+            walltime -- The number of seconds the task may run before
+                        its interpreter is stopped, or None.
+            grace    -- The number of seconds the interpreter has to
+                        exit after SIGTERM before it is killed.
+
+        Returns the RunnerTask.
+        """
+        runner = None
+        with self.lock:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i].entry == entry:
+                    runner = self.idle.pop(i)
+                    break
+        if runner is None:
+            runner = Runner(self, entry)
+        task = RunnerTask(runner, spool, callback)
+        if walltime:
+            self.supervisor.limit(runner.process, walltime, grace)
+        try:
+            runner.start(task, args)
+        except:
+            # The interpreter could not be sent the task, so it is not
+            # given another one.
+            with self.lock:
+                if runner.task is task:
+                    runner.task = None
+            self.supervisor.unlimit(runner.process)
+            runner.retire()
+            raise
+        return task
+
+    def warm(self, entries):
+        """
+        Start the idle interpreters the pool may keep, shared out
+        between the given entry points, so that their first tasks
+        do not wait for an interpreter to start.
+
+        Arguments:
+            entries -- The module:function entry points to start
+                       interpreters for.
+        """
+        if not entries:
+            return
+        runners = []
+        for i in range(self.idle_limit):
+            entry = entries[i % len(entries)]
+            try:
+                runners.append(Runner(self, entry))
+            except (IOError, OSError):
+                log.exception('RUNNER: Could not start interpreter ' + \
+                              'for %s' % entry)
+                break
+        retire = []
+        with self.lock:
+            self.idle.extend(runners)
+            while len(self.idle) > self.idle_limit:
+                retire.append(self.idle.pop(0))
+        for old in retire:
+            old.retire()
+
+    def stop(self):
+        """Stop every idle interpreter."""
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for runner in idle:
+            runner.retire()
+
+    def _message(self, runner, message):
+        if 'ready' in message:
+            runner.baseline = message['rss']
+            return
+
+        task = runner.task
+        runner.task = None
+        runner.uses += 1
+        self.supervisor.unlimit(runner.process)
+        task.ended = time.time()
+        task.returncode = message['status']
+        task.rusage = Rusage(message['utime'], message['stime'],
+                             message['rss'])
+        if task.spool is not None:
+            for stream, dropped in message['dropped'].items():
+                task.spool.files[stream].dropped = dropped
+
+        grown = message['rss'] - (runner.baseline or message['rss'])
+        retire = []
+        if runner.process.timed_out:
+            # Answered just as it was stopped; it is on its way out.
+            retire.append(runner)
+        elif self.tasks and runner.uses >= self.tasks:
+            log.debug('RUNNER: Replacing %s after %s tasks' % (
+                runner.process.pid, runner.uses))
+            retire.append(runner)
+        elif self.growth and grown > self.growth:
+            log.debug('RUNNER: Replacing %s after growing by %s KB' % (
+                runner.process.pid, grown))
+            retire.append(runner)
+        else:
+            with self.lock:
+                self.idle.append(runner)
+                while len(self.idle) > self.idle_limit:
+                    retire.append(self.idle.pop(0))
+        for old in retire:
+            old.retire()
+        self.supervisor.call(task.callback, task)
+
+    def _exited(self, runner):
+        with self.lock:
+            if runner in self.idle:
+                self.idle.remove(runner)
+            task = runner.task
+            runner.task = None
+        if task is not None:
+            log.info('RUNNER: Interpreter %s exited during a task' % (
+                runner.process.pid))
+            task.ended = time.time()
+            task.returncode = runner.process.returncode
+            task.timed_out = runner.process.timed_out
+            self.supervisor.call(task.callback, task)
+
+
+class SpoolStream(object):
+
+    """A text stream writing into one stream of a task's spool."""
+
+    def __init__(self, output):
+        self.output = output
+        self.encoding = 'utf-8'
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        self.output.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def main(argv=None):
+    """
+    Serve the tasks of an entry point, reading requests from our
+    input until it is closed.
+    """
+    from kestrel.spool import Spool
+
+    if argv is None:
+        argv = sys.argv
+    target = load(argv[1])
+
+    # Requests are answered on our original output, which is then
+    # pointed elsewhere so that stray output can not garble answers.
+    control = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    def answer(message):
+        control.write(json.dumps(message) + '\n')
+        control.flush()
+
+    answer({'ready': True, 'rss': usage().ru_maxrss})
+    stdout, stderr = sys.stdout, sys.stderr
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        before = usage()
+        spool = None
+        if request['spool']:
+            spool = Spool(request['spool'], request['limit'],
+                          request['backups'])
+            sys.stdout = SpoolStream(spool.files['stdout'])
+            sys.stderr = SpoolStream(spool.files['stderr'])
+        try:
+            result = target(*request['args'])
+            status = result if isinstance(result, int) else 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write('%s\n' % e.code)
+                status = 1
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        dropped = {}
+        if spool is not None:
+            for stream in spool.streams:
+                dropped[stream] = spool.files[stream].dropped
+            spool.close()
+        after = usage()
+        answer({'status': status,
+                'utime': after.ru_utime - before.ru_utime,
+                'stime': after.ru_stime - before.ru_stime,
+                'rss': after.ru_maxrss,
+                'dropped': dropped})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,634 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+# Lua scripts used by kestrel.backend.ScriptedKestrel. Each script
+# performs one complete task or worker transition inside Redis so
+# that it costs a single round trip and cannot interleave with a
+# transition started by another manager thread.
+#
+# The key layout matches the one documented in kestrel.backend.Kestrel.
+#
+# The scripts are called with no declared keys (numkeys 0) and build
+# every key name inside Lua from their arguments and from the contents
+# of other keys. They therefore need a single Redis instance, and can
+# not run against Redis Cluster, which only routes declared keys.
+
+
+# Shared helper prepended to every script that moves tasks.
+#
+# Adjust a task state counter of a job and of the whole pool.
+COUNT = """
+local function count(job, field, delta)
+    if delta ~= 0 then
+        redis.call('HINCRBY', 'job:' .. job .. ':counts', field, delta)
+        redis.call('HINCRBY', 'pool:counts', field, delta)
+    end
+end
+"""
+
+
+# Shared helpers prepended to every script that changes which jobs
+# have queued tasks.
+#
+# Add a job to, or remove it from, its owner's run queue, and return
+# the job an available worker should take its next task from.
+RUNQUEUE = """
+local function enqueue(job)
+    local info = redis.call('HMGET', 'job:' .. job, 'owner', 'signature', 'priority')
+    local owner, sig = info[1], info[2]
+    if not owner then
+        return
+    end
+    local rank = -(tonumber(info[3]) or 0) * 4294967296 + tonumber(job)
+    local usage = redis.call('ZSCORE', 'owners:usage', owner) or 0
+    redis.call('ZADD', 'signature:' .. sig .. ':owner:' .. owner .. ':jobs', rank, job)
+    redis.call('ZADD', 'signature:' .. sig .. ':owners', 'NX', usage, owner)
+    redis.call('SADD', 'user:' .. owner .. ':signatures', sig)
+    if redis.call('LLEN', 'signature:' .. sig .. ':ready') == 0 then
+        redis.call('RPUSH', 'signature:' .. sig .. ':ready', sig)
+    end
+end
+
+local function dequeue(job)
+    local info = redis.call('HMGET', 'job:' .. job, 'owner', 'signature')
+    local owner, sig = info[1], info[2]
+    if not owner then
+        return
+    end
+    local queue = 'signature:' .. sig .. ':owner:' .. owner .. ':jobs'
+    redis.call('ZREM', queue, job)
+    if redis.call('ZCARD', queue) == 0 then
+        redis.call('ZREM', 'signature:' .. sig .. ':owners', owner)
+        redis.call('SREM', 'user:' .. owner .. ':signatures', sig)
+    end
+end
+
+local function next_job(worker)
+    local sigs = redis.call('SMEMBERS', 'worker:' .. worker .. ':signatures')
+    while true do
+        local best_owner, best_usage = nil, nil
+        for _, sig in ipairs(sigs) do
+            local head = redis.call('ZRANGE', 'signature:' .. sig .. ':owners', 0, 0, 'WITHSCORES')
+            if head[1] then
+                local usage = tonumber(head[2])
+                if not best_owner or usage < best_usage or
+                   (usage == best_usage and head[1] < best_owner) then
+                    best_owner, best_usage = head[1], usage
+                end
+            end
+        end
+        if not best_owner then
+            return false
+        end
+        local best_job, best_rank = false, nil
+        for _, sig in ipairs(sigs) do
+            local head = redis.call('ZRANGE', 'signature:' .. sig .. ':owner:' .. best_owner .. ':jobs',
+                                    0, 0, 'WITHSCORES')
+            if head[1] then
+                if not best_rank or tonumber(head[2]) < best_rank then
+                    best_job, best_rank = head[1], tonumber(head[2])
+                end
+            else
+                -- A stale owner without queued jobs in the signature.
+                redis.call('ZREM', 'signature:' .. sig .. ':owners', best_owner)
+            end
+        end
+        if best_job then
+            return best_job
+        end
+    end
+end
+"""
+
+
+# Shared helper prepended to the scripts that hand out tasks.
+#
+# Charge an owner for one claimed task. Charges grow by a factor of
+# two every halflife seconds after usage:epoch, and all scores are
+# scaled back down once the growth gets large.
+USAGE = """
+local function charge(owner, now, halflife)
+    now, halflife = tonumber(now), tonumber(halflife)
+    local epoch = tonumber(redis.call('GET', 'usage:epoch'))
+    if not epoch then
+        epoch = now
+        redis.call('SET', 'usage:epoch', now)
+    end
+    local exponent = (now - epoch) / halflife
+    if exponent > 32 then
+        local factor = 2 ^ (-exponent)
+        local keys = {'owners:usage'}
+        for _, sig in ipairs(redis.call('SMEMBERS', 'signatures')) do
+            if redis.call('EXISTS', 'signature:' .. sig .. ':owners') == 1 then
+                table.insert(keys, 'signature:' .. sig .. ':owners')
+            end
+        end
+        for _, key in ipairs(keys) do
+            redis.call('ZUNIONSTORE', key, 1, key, 'WEIGHTS', factor)
+        end
+        redis.call('SET', 'usage:epoch', now)
+        exponent = 0
+    end
+    local amount = 2 ^ exponent
+    redis.call('ZINCRBY', 'owners:usage', amount, owner)
+    for _, sig in ipairs(redis.call('SMEMBERS', 'user:' .. owner .. ':signatures')) do
+        redis.call('ZADD', 'signature:' .. sig .. ':owners', 'XX', 'INCR', amount, owner)
+    end
+end
+"""
+
+
+# Shared helper prepended to the scripts that take tasks off workers.
+#
+# Remove an in flight task from its bundle, freeing the bundle's slot
+# once it has no tasks left.
+RELEASE = """
+local function release(worker, item)
+    local bundle = redis.call('HGET', 'worker:' .. worker .. ':task_bundles', item)
+    if not bundle then
+        return
+    end
+    redis.call('HDEL', 'worker:' .. worker .. ':task_bundles', item)
+    if redis.call('HINCRBY', 'worker:' .. worker .. ':bundles', bundle, -1) <= 0 then
+        redis.call('HDEL', 'worker:' .. worker .. ':bundles', bundle)
+    end
+end
+"""
+
+
+# Shared helper prepended to the scripts that requeue tasks.
+#
+# Return an in flight task of a job to the queue.
+REQUEUE = COUNT + RUNQUEUE + RELEASE + """
+local function requeue(worker, job, task)
+    local item = job .. ',' .. task
+    local pending = redis.call('SREM', 'job:' .. job .. ':tasks:pending', task)
+    local running = redis.call('SREM', 'job:' .. job .. ':tasks:running', task)
+    local claimed = 0
+    if pending + running > 0 then
+        claimed = redis.call('SETBIT', 'job:' .. job .. ':bits:claimed', task, 0)
+    end
+    redis.call('ZREM', 'tasks:leases', item)
+    if worker then
+        redis.call('SREM', 'worker:' .. worker .. ':tasks', item)
+        release(worker, item)
+    end
+    redis.call('DEL', 'job:' .. job .. ':task:' .. task)
+    count(job, 'pending', -pending)
+    count(job, 'running', -running)
+    count(job, 'queued', claimed)
+    if claimed == 1 and redis.call('SISMEMBER', 'jobs:queued', job) == 1 then
+        enqueue(job)
+    end
+end
+"""
+
+
+# Shared helpers prepended to the scripts that hand out tasks.
+#
+# Assign the lowest numbered queued task of a job to a worker as part
+# of a bundle and charge the job's owner for it. Returns the task, or
+# false if the job has no queued tasks left.
+#
+# A bundle of tasks fills a single worker slot. Its size is set by the
+# job, or derived from the job's observed task run times so that a
+# bundle takes about target seconds.
+CLAIM = COUNT + RUNQUEUE + USAGE + """
+local function claim(job, worker, bundle, expires, now, halflife)
+    local info = redis.call('HMGET', 'job:' .. job, 'size', 'owner')
+    local size = tonumber(info[1])
+    if not size then
+        return false
+    end
+    local task = redis.call('BITPOS', 'job:' .. job .. ':bits:claimed', 0)
+    if task >= size then
+        return false
+    end
+    redis.call('SETBIT', 'job:' .. job .. ':bits:claimed', task, 1)
+    task = tostring(task)
+    redis.call('SADD', 'job:' .. job .. ':tasks:pending', task)
+    redis.call('ZADD', 'tasks:leases', expires, job .. ',' .. task)
+    redis.call('SADD', 'worker:' .. worker .. ':tasks', job .. ',' .. task)
+    redis.call('HSET', 'worker:' .. worker .. ':task_bundles', job .. ',' .. task,
+               bundle or job .. ',' .. task)
+    redis.call('HINCRBY', 'worker:' .. worker .. ':bundles',
+               bundle or job .. ',' .. task, 1)
+    redis.call('SET', 'job:' .. job .. ':task:' .. task, worker)
+    count(job, 'queued', -1)
+    count(job, 'pending', 1)
+    charge(info[2], now, halflife)
+    return task
+end
+
+local function bundle_size(job, target, limit)
+    local bundle = redis.call('HGET', 'job:' .. job, 'bundle')
+    if not bundle or tonumber(bundle) > 0 then
+        return tonumber(bundle) or 1
+    end
+    local runtime = redis.call('HMGET', 'job:' .. job .. ':runtime', 'seconds', 'tasks')
+    local tasks = tonumber(runtime[2]) or 0
+    if tasks == 0 then
+        return 1
+    end
+    local average = tonumber(runtime[1]) / tasks
+    limit = tonumber(limit)
+    if average <= 0 then
+        return limit
+    end
+    return math.max(1, math.min(limit, math.floor(tonumber(target) / average)))
+end
+
+local function claim_bundle(job, worker, expires, now, halflife, target, limit)
+    local tasks = {}
+    local bundle = false
+    local size = bundle_size(job, target, limit)
+    while #tasks < size do
+        local task = claim(job, worker, bundle, expires, now, halflife)
+        if not task then
+            break
+        end
+        if not bundle then
+            bundle = job .. ',' .. task
+        end
+        table.insert(tasks, task)
+    end
+    return tasks
+end
+"""
+
+
+# Shared helper prepended to the scripts that fill worker slots.
+#
+# Return the number of bundles a worker can still take.
+SLOTS = """
+local function free_slots(worker)
+    local slots = tonumber(redis.call('GET', 'worker:' .. worker .. ':slots')) or 1
+    return slots - redis.call('HLEN', 'worker:' .. worker .. ':bundles')
+end
+"""
+
+
+# ARGV: worker, pending lease expiry time, current time, usage half life,
+#       bundle run time target, bundle size limit,
+#       number of worker slots or an empty string
+# Returns a list of bundles, each a list of the job followed by its tasks.
+WORKER_AVAILABLE = CLAIM + SLOTS + """
+local worker = ARGV[1]
+if redis.call('SISMEMBER', 'workers:online', worker) == 0 then
+    return {}
+end
+redis.call('SREM', 'workers:busy', worker)
+redis.call('SADD', 'workers:available', worker)
+if ARGV[7] ~= '' then
+    redis.call('SET', 'worker:' .. worker .. ':slots', ARGV[7])
+end
+
+local matches = {}
+local free = free_slots(worker)
+while #matches < free do
+    local job = next_job(worker)
+    if not job then
+        break
+    end
+    local tasks = claim_bundle(job, worker, ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
+    if #tasks > 0 then
+        table.insert(tasks, 1, job)
+        table.insert(matches, tasks)
+    else
+        dequeue(job)
+    end
+end
+return matches
+"""
+
+
+# ARGV: pending lease expiry time, current time, usage half life,
+#       bundle run time target, bundle size limit, followed by a worker
+#       and its number of slots or an empty string for each worker
+# Workers take turns claiming one bundle at a time.
+# Returns a list of bundles, each a list of the worker and the job
+# followed by its tasks.
+WORKERS_AVAILABLE = CLAIM + SLOTS + """
+local workers = {}
+local free = {}
+for i = 6, #ARGV, 2 do
+    local worker = ARGV[i]
+    if redis.call('SISMEMBER', 'workers:online', worker) == 1 then
+        redis.call('SREM', 'workers:busy', worker)
+        redis.call('SADD', 'workers:available', worker)
+        if ARGV[i + 1] ~= '' then
+            redis.call('SET', 'worker:' .. worker .. ':slots', ARGV[i + 1])
+        end
+        free[worker] = free_slots(worker)
+        if free[worker] > 0 then
+            table.insert(workers, worker)
+        end
+    end
+end
+
+local matches = {}
+while #workers > 0 do
+    local waiting = {}
+    for _, worker in ipairs(workers) do
+        local tasks = {}
+        local job = next_job(worker)
+        while job do
+            tasks = claim_bundle(job, worker, ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+            if #tasks > 0 then
+                break
+            end
+            dequeue(job)
+            job = next_job(worker)
+        end
+        if #tasks > 0 then
+            table.insert(tasks, 1, job)
+            table.insert(tasks, 1, worker)
+            table.insert(matches, tasks)
+            free[worker] = free[worker] - 1
+            if free[worker] > 0 then
+                table.insert(waiting, worker)
+            end
+        end
+    end
+    workers = waiting
+end
+return matches
+"""
+
+
+# ARGV: job, pending lease expiry time, current time, usage half life,
+#       bundle run time target, bundle size limit
+# Returns a list of bundles, each a list of the worker followed by the
+# tasks assigned to it.
+JOB_MATCHES = CLAIM + SLOTS + """
+local job = ARGV[1]
+local sig = redis.call('HGET', 'job:' .. job, 'signature')
+if not sig or redis.call('SISMEMBER', 'jobs:queued', job) == 0 then
+    return {}
+end
+local matches = {}
+local workers = redis.call('SINTER', 'signature:' .. sig .. ':workers',
+                                     'workers:available')
+table.sort(workers)
+for _, worker in ipairs(workers) do
+    for slot = 1, free_slots(worker) do
+        local tasks = claim_bundle(job, worker, ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
+        if #tasks == 0 then
+            dequeue(job)
+            return matches
+        end
+        table.insert(tasks, 1, worker)
+        table.insert(matches, tasks)
+    end
+end
+return matches
+"""
+
+
+# ARGV: worker, signature whose ready token the worker took,
+#       running lease expiry time, current time, usage half life,
+#       bundle run time target, bundle size limit
+# Returns the job followed by the tasks claimed and started for the
+# worker, or an empty list.
+PULL_TASK = CLAIM + """
+local worker, sig = ARGV[1], ARGV[2]
+local tasks, job = {}, false
+if redis.call('SISMEMBER', 'workers:online', worker) == 1 then
+    job = next_job(worker)
+    while job do
+        tasks = claim_bundle(job, worker, ARGV[3], ARGV[4], ARGV[5], ARGV[6], ARGV[7])
+        if #tasks > 0 then
+            break
+        end
+        dequeue(job)
+        job = next_job(worker)
+    end
+end
+
+if redis.call('EXISTS', 'signature:' .. sig .. ':owners') == 1 then
+    redis.call('RPUSH', 'signature:' .. sig .. ':ready', sig)
+end
+
+if #tasks == 0 then
+    return {}
+end
+for _, task in ipairs(tasks) do
+    redis.call('SMOVE', 'job:' .. job .. ':tasks:pending',
+                        'job:' .. job .. ':tasks:running', task)
+    count(job, 'pending', -1)
+    count(job, 'running', 1)
+end
+table.insert(tasks, 1, job)
+return tasks
+"""
+
+
+# ARGV: worker, job, task, running lease expiry time
+# Returns 1 if the task was started, 0 otherwise.
+TASK_START = COUNT + """
+local worker, job, task = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('GET', 'job:' .. job .. ':task:' .. task) ~= worker then
+    return 0
+end
+if redis.call('SMOVE', 'job:' .. job .. ':tasks:pending',
+                       'job:' .. job .. ':tasks:running', task) == 0 then
+    return 0
+end
+redis.call('ZADD', 'tasks:leases', 'XX', ARGV[4], job .. ',' .. task)
+count(job, 'pending', -1)
+count(job, 'running', 1)
+return 1
+"""
+
+
+# Shared helper prepended to the scripts that complete tasks.
+#
+# Mark an in flight task as completed, moving its job to
+# jobs:completed once every task is. Returns 1 if the task completed
+# the job, 0 otherwise.
+FINISH = """
+local function finish(worker, job, task)
+    local pending = redis.call('SREM', 'job:' .. job .. ':tasks:pending', task)
+    local running = redis.call('SREM', 'job:' .. job .. ':tasks:running', task)
+    local done = redis.call('SETBIT', 'job:' .. job .. ':bits:completed', task, 1)
+    redis.call('SREM', 'worker:' .. worker .. ':tasks', job .. ',' .. task)
+    release(worker, job .. ',' .. task)
+    redis.call('ZREM', 'tasks:leases', job .. ',' .. task)
+    redis.call('DEL', 'job:' .. job .. ':task:' .. task)
+    count(job, 'pending', -pending)
+    count(job, 'running', -running)
+    if done == 1 then
+        return 0
+    end
+    count(job, 'completed', 1)
+    local completed = redis.call('HGET', 'job:' .. job .. ':counts', 'completed')
+    local info = redis.call('HMGET', 'job:' .. job, 'size', 'signature', 'owner')
+    if tonumber(completed) ~= tonumber(info[1]) then
+        return 0
+    end
+    dequeue(job)
+    redis.call('SREM', 'signature:' .. info[2] .. ':jobs', job)
+    redis.call('SREM', 'user:' .. info[3] .. ':jobs', job)
+    return redis.call('SMOVE', 'jobs:queued', 'jobs:completed', job)
+end
+"""
+
+
+# ARGV: worker, job, task
+# Returns 1 if the task completed the job, 0 otherwise.
+TASK_FINISH = COUNT + RUNQUEUE + RELEASE + FINISH + """
+local worker, job, task = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('GET', 'job:' .. job .. ':task:' .. task) ~= worker then
+    return 0
+end
+return finish(worker, job, task)
+"""
+
+
+# ARGV: worker, job, task
+# Returns 1 if the task was requeued, 0 if it belongs to another worker.
+TASK_RESET = REQUEUE + """
+local worker, job, task = ARGV[1], ARGV[2], ARGV[3]
+local owner = redis.call('GET', 'job:' .. job .. ':task:' .. task)
+if owner and owner ~= worker then
+    return 0
+end
+requeue(worker, job, task)
+return 1
+"""
+
+
+# ARGV: worker, job, task
+# Returns requeued, completed or failed, or nil if the task is not in
+# flight on the worker.
+TASK_TIMEOUT = REQUEUE + FINISH + """
+local worker, job, task = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('GET', 'job:' .. job .. ':task:' .. task) ~= worker then
+    return false
+end
+local timeouts = redis.call('HINCRBY', 'job:' .. job .. ':timeouts', task, 1)
+local retries = tonumber(redis.call('HGET', 'job:' .. job, 'retries')) or 0
+if timeouts <= retries then
+    requeue(worker, job, task)
+    return 'requeued'
+end
+if finish(worker, job, task) == 1 then
+    return 'completed'
+end
+return 'failed'
+"""
+
+
+# ARGV: worker
+# Returns a flat list of job, task pairs that were requeued, or nil
+# if the worker was not online.
+WORKER_OFFLINE = REQUEUE + """
+local worker = ARGV[1]
+if redis.call('SREM', 'workers:online', worker) == 0 then
+    return nil
+end
+redis.call('SREM', 'workers:available', worker)
+redis.call('SREM', 'workers:busy', worker)
+
+for _, cap in ipairs(redis.call('SMEMBERS', 'worker:' .. worker)) do
+    redis.call('SREM', 'capability:' .. cap .. ':workers', worker)
+end
+local sigs = redis.call('SMEMBERS', 'worker:' .. worker .. ':signatures')
+for _, sig in ipairs(sigs) do
+    redis.call('SREM', 'signature:' .. sig .. ':workers', worker)
+end
+
+local resets = {}
+local tasks = redis.call('SMEMBERS', 'worker:' .. worker .. ':tasks')
+for _, item in ipairs(tasks) do
+    local sep = string.find(item, ',', 1, true)
+    local job, task = string.sub(item, 1, sep - 1), string.sub(item, sep + 1)
+    requeue(worker, job, task)
+    table.insert(resets, job)
+    table.insert(resets, task)
+end
+redis.call('DEL', 'worker:' .. worker,
+                  'worker:' .. worker .. ':signatures',
+                  'worker:' .. worker .. ':tasks',
+                  'worker:' .. worker .. ':slots',
+                  'worker:' .. worker .. ':bundles',
+                  'worker:' .. worker .. ':task_bundles')
+return resets
+"""
+
+
+# ARGV: worker, running lease expiry time
+WORKER_HEARTBEAT = """
+local worker = ARGV[1]
+local tasks = redis.call('SMEMBERS', 'worker:' .. worker .. ':tasks')
+for _, item in ipairs(tasks) do
+    local sep = string.find(item, ',', 1, true)
+    local job, task = string.sub(item, 1, sep - 1), string.sub(item, sep + 1)
+    if redis.call('SISMEMBER', 'job:' .. job .. ':tasks:running', task) == 1 then
+        redis.call('ZADD', 'tasks:leases', 'XX', ARGV[2], item)
+    end
+end
+return 0
+"""
+
+
+# ARGV: worker, job, pending lease expiry time, task, ...
+# Returns the tasks that are still pending on the worker.
+TASK_HOLD = """
+local worker, job = ARGV[1], ARGV[2]
+local held = {}
+for i = 4, #ARGV do
+    local task = ARGV[i]
+    if redis.call('GET', 'job:' .. job .. ':task:' .. task) == worker and
+       redis.call('SISMEMBER', 'job:' .. job .. ':tasks:pending', task) == 1 then
+        redis.call('ZADD', 'tasks:leases', 'XX', ARGV[3], job .. ',' .. task)
+        table.insert(held, task)
+    end
+end
+return held
+"""
+
+
+# ARGV: current time
+# Returns a flat list of job, task pairs that were requeued.
+EXPIRE_LEASES = REQUEUE + """
+local resets = {}
+local expired = redis.call('ZRANGEBYSCORE', 'tasks:leases', '-inf', ARGV[1])
+for _, item in ipairs(expired) do
+    local sep = string.find(item, ',', 1, true)
+    local job, task = string.sub(item, 1, sep - 1), string.sub(item, sep + 1)
+    local worker = redis.call('GET', 'job:' .. job .. ':task:' .. task)
+    requeue(worker, job, task)
+    table.insert(resets, job)
+    table.insert(resets, task)
+end
+-- Put back the wake up tokens lost by pull mode workers that died
+-- between taking a token and returning it.
+for _, sig in ipairs(redis.call('SMEMBERS', 'signatures')) do
+    if redis.call('EXISTS', 'signature:' .. sig .. ':owners') == 1 and
+       redis.call('LLEN', 'signature:' .. sig .. ':ready') == 0 then
+        redis.call('RPUSH', 'signature:' .. sig .. ':ready', sig)
+    end
+end
+return resets
+"""
+
+
+SCRIPTS = {
+    'worker_available': WORKER_AVAILABLE,
+    'workers_available': WORKERS_AVAILABLE,
+    'job_matches': JOB_MATCHES,
+    'pull_task': PULL_TASK,
+    'task_start': TASK_START,
+    'task_finish': TASK_FINISH,
+    'task_reset': TASK_RESET,
+    'task_timeout': TASK_TIMEOUT,
+    'task_hold': TASK_HOLD,
+    'worker_offline': WORKER_OFFLINE,
+    'worker_heartbeat': WORKER_HEARTBEAT,
+    'expire_leases': EXPIRE_LEASES}
@@ -0,0 +1,170 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import base64
+import logging
+import os
+import shutil
+import threading
+import zlib
+
+
+log = logging.getLogger(__name__)
+
+
+# The number of bytes read from a task's output at a time.
+READ_SIZE = 65536
+
+
+def compress(data):
+    """Compress output for sending in a stanza."""
+    return base64.b64encode(zlib.compress(data)).decode('ascii')
+
+
+def decompress(data):
+    """Undo compress."""
+    return zlib.decompress(base64.b64decode(data))
+
+
+class SpoolFile(object):
+
+    """
+    A file that one output stream of a task is written to, rotated
+    once it grows past a size limit.
+
+    When the file reaches the limit it is renamed to [path].1, any
+    older rotations move up by one, and rotations beyond the number
+    of backups are deleted. At most (backups + 1) * limit bytes of
+    the stream are kept on disk; the rest is counted as dropped.
+    """
+
+    def __init__(self, path, limit=10485760, backups=1):
+        """
+        Arguments:
+            path    -- The path of the file.
+            limit   -- The size in bytes at which the file is rotated,
+                       or 0 to never rotate.
+            backups -- The number of rotated files to keep.
+        """
+        self.path = path
+        self.limit = limit
+        self.backups = backups
+        self.written = 0
+        self.dropped = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+
+    def write(self, data):
+        with self.lock:
+            self.written += len(data)
+            while data:
+                if self.limit:
+                    room = self.limit - self.size
+                    if room <= 0:
+                        self._rotate()
+                        room = self.limit
+                    chunk, data = data[:room], data[room:]
+                else:
+                    chunk, data = data, b''
+                self.file.write(chunk)
+                self.size += len(chunk)
+
+    def _rotate(self):
+        self.file.close()
+        oldest = '%s.%s' % (self.path, self.backups)
+        if os.path.exists(oldest):
+            self.dropped += os.path.getsize(oldest)
+            os.remove(oldest)
+        for i in range(self.backups - 1, 0, -1):
+            rotated = '%s.%s' % (self.path, i)
+            if os.path.exists(rotated):
+                os.rename(rotated, '%s.%s' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            self.dropped += self.size
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def files(self):
+        """Return the paths of the kept output, oldest first."""
+        paths = ['%s.%s' % (self.path, i)
+                 for i in range(self.backups, 0, -1)]
+        paths.append(self.path)
+        return [path for path in paths if os.path.exists(path)]
+
+    def tail(self, size):
+        """Return up to the last size bytes of the kept output."""
+        self.flush()
+        data = b''
+        for path in reversed(self.files()):
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                length = f.tell()
+                want = size - len(data)
+                f.seek(max(length - want, 0))
+                data = f.read(want) + data
+            if len(data) >= size:
+                break
+        return data
+
+    def chunks(self, size):
+        """Yield the kept output in pieces of at most size bytes."""
+        self.flush()
+        for path in self.files():
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(size)
+                    if not data:
+                        break
+                    yield data
+
+
+class Spool(object):
+
+    """
+    The output of a task, with one SpoolFile for each of its stdout
+    and stderr streams, kept in a directory of its own.
+    """
+
+    streams = ('stdout', 'stderr')
+
+    def __init__(self, path, limit=10485760, backups=1):
+        """
+        Arguments:
+            path    -- The directory to write the output files to.
+            limit   -- The size in bytes at which a file is rotated.
+            backups -- The number of rotated files to keep per stream.
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.files = {}
+        for stream in self.streams:
+            self.files[stream] = SpoolFile(os.path.join(path, stream),
+                                           limit, backups)
+
+    def write(self, stream, data):
+        self.files[stream].write(data)
+
+    def close(self):
+        for spool in self.files.values():
+            spool.close()
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,369 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+from sleekxmpp import Iq, Presence
+from sleekxmpp.xmlstream import ElementBase, register_stanza_plugin
+
+
+class Task(ElementBase):
+
+    """
+    A complete task assignment, or the outcome of one, carried in
+    a single Iq stanza.
+
+    The manager sends the task in an Iq of type set, and the worker
+    answers with an Iq result once the command and its cleanup have
+    finished. A worker that can not take the task answers with an
+    error instead.
+
+    Example stanzas:
+        <iq type="set" to="worker@example.com/kestrel">
+          <task xmlns="kestrel:tasks" job="12" id="3" walltime="3600">
+            <command>./run_task.sh 3</command>
+            <cleanup>./cleanup.sh</cleanup>
+          </task>
+        </iq>
+
+        <iq type="result" from="worker@example.com/kestrel">
+          <task xmlns="kestrel:tasks" job="12" id="3" status="complete" />
+        </iq>
+
+    Stanza Interface:
+        job       -- The ID of the job the task belongs to.
+        id        -- The task's number within the job.
+        command   -- The command to execute.
+        cleanup   -- A command to execute after the task command.
+        walltime  -- The number of seconds the command may run before
+                     the worker stops it.
+        status    -- The outcome of the task: complete, timeout if the
+                     command ran past its walltime, or cancelled.
+        outputs   -- The Output substanzas with the end of the task's
+                     output, included in the outcome by workers that
+                     return it.
+        resources -- A dictionary of the resources the task used, as
+                     described by Resources, included in the outcome
+                     by workers that measure them.
+
+    Methods:
+        add_output -- Attach the end of an output stream.
+    """
+
+    name = 'task'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_task'
+    interfaces = set(('job', 'id', 'command', 'cleanup', 'walltime',
+                      'status', 'outputs', 'resources'))
+    sub_interfaces = set(('command', 'cleanup'))
+
+    def get_resources(self):
+        if self.xml.find('{%s}resources' % self.namespace) is None:
+            return {}
+        resources = self['kestrel_resources']
+        values = {}
+        for key in ('wall', 'utime', 'stime', 'cleanup'):
+            if resources[key]:
+                values[key] = float(resources[key])
+        for key in ('maxrss', 'exit'):
+            if resources[key]:
+                values[key] = int(resources[key])
+        if resources['timeout'] in ('true', '1'):
+            values['timeout'] = True
+        return values
+
+    def set_resources(self, values):
+        resources = self['kestrel_resources']
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif isinstance(value, float):
+                value = '%.3f' % value
+            resources[key] = str(value)
+
+    def del_resources(self):
+        resources = self.xml.find('{%s}resources' % self.namespace)
+        if resources is not None:
+            self.xml.remove(resources)
+
+    def get_outputs(self):
+        return [output for output in self['substanzas']
+                if isinstance(output, Output)]
+
+    def add_output(self, stream, data, dropped=0):
+        """
+        Attach the end of an output stream.
+
+        Arguments:
+            stream  -- Either 'stdout' or 'stderr'.
+            data    -- The output, as returned by kestrel.spool.compress.
+            dropped -- The number of bytes of output not kept.
+        """
+        output = Output()
+        output['stream'] = stream
+        output['data'] = data
+        if dropped:
+            output['dropped'] = dropped
+        self.append(output)
+        return output
+
+
+class Output(ElementBase):
+
+    """
+    A piece of the output of a task, compressed with zlib and
+    base64 encoded.
+
+    Workers may attach the end of each output stream to the outcome
+    of a task, or send the whole output to the manager beforehand
+    as a series of Iq stanzas, numbered from 0, the last of which is
+    marked as final.
+
+    Example stanzas:
+        <iq type="set" to="pool@manager.example.com">
+          <output xmlns="kestrel:tasks" job="12" id="3" stream="stdout"
+                  seq="0" final="true">eJzLSM3JyVcozy/KSQEAGgQEXQ==</output>
+        </iq>
+
+    Stanza Interface:
+        job     -- The ID of the job the task belongs to.
+        id      -- The task's number within the job.
+        stream  -- Either "stdout" or "stderr".
+        seq     -- The position of the piece within the stream.
+        final   -- "true" for the last piece of the stream.
+        dropped -- The number of bytes of output not kept by the worker.
+        data    -- The compressed output.
+    """
+
+    name = 'output'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_output'
+    interfaces = set(('job', 'id', 'stream', 'seq', 'final', 'dropped',
+                      'data'))
+
+    def get_data(self):
+        return self.xml.text or ''
+
+    def set_data(self, value):
+        self.xml.text = value
+
+    def del_data(self):
+        self.xml.text = ''
+
+
+class Resources(ElementBase):
+
+    """
+    The resources a task's command used, as measured by the worker
+    when the command exited.
+
+    Example stanzas:
+        <task xmlns="kestrel:tasks" job="12" id="3" status="complete">
+          <resources wall="1.204" utime="0.810" stime="0.050"
+                     maxrss="10240" exit="0" cleanup="0.010" />
+        </task>
+
+    Stanza Interface:
+        wall    -- The seconds from the start of the command to its exit.
+        utime   -- The seconds of user CPU time used by the command and
+                   the child processes it waited for.
+        stime   -- The seconds of system CPU time, counted the same way.
+        maxrss  -- The peak resident memory in kilobytes.
+        exit    -- The exit status, or minus the signal that killed
+                   the command.
+        cleanup -- The seconds taken by the cleanup command.
+        timeout -- True if the command was stopped for running past
+                   its walltime.
+    """
+
+    name = 'resources'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_resources'
+    interfaces = set(('wall', 'utime', 'stime', 'maxrss', 'exit',
+                      'cleanup', 'timeout'))
+
+
+class Bundle(ElementBase):
+
+    """
+    A bundle of tasks from one job, sent to a worker in a single Iq
+    stanza and run one after the other in one of the worker's slots.
+
+    The worker answers once every task has run, reporting the outcome
+    of each task in the bundle. Tasks that were not run, for example
+    because the bundle was cancelled, are reported as cancelled, and
+    tasks stopped for running past the walltime as timeout.
+
+    Example stanzas:
+        <iq type="set" to="worker@example.com/kestrel">
+          <bundle xmlns="kestrel:tasks" job="12" walltime="3600">
+            <cleanup>./cleanup.sh</cleanup>
+            <task id="3"><command>./run_task.sh 3</command></task>
+            <task id="4"><command>./run_task.sh 4</command></task>
+          </bundle>
+        </iq>
+
+        <iq type="result" from="worker@example.com/kestrel">
+          <bundle xmlns="kestrel:tasks" job="12">
+            <task id="3" status="complete" />
+            <task id="4" status="timeout" />
+          </bundle>
+        </iq>
+
+    Stanza Interface:
+        job      -- The ID of the job the tasks belong to.
+        cleanup  -- A command to execute after each task command.
+        walltime -- The number of seconds each task command may run
+                    before the worker stops it.
+        tasks    -- The Task substanzas, in the order they run.
+
+    Methods:
+        add_task -- Append a task to the bundle.
+    """
+
+    name = 'bundle'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_bundle'
+    interfaces = set(('job', 'cleanup', 'walltime', 'tasks'))
+    sub_interfaces = set(('cleanup',))
+
+    def get_tasks(self):
+        return [task for task in self['substanzas'] if isinstance(task, Task)]
+
+    def add_task(self, id, command=None, status=None):
+        """
+        Append a task to the bundle.
+
+        Arguments:
+            id      -- The task's number within the job.
+            command -- The command to execute.
+            status  -- The outcome of the task.
+        """
+        task = Task()
+        task['id'] = id
+        if command is not None:
+            task['command'] = command
+        if status is not None:
+            task['status'] = status
+        self.append(task)
+        return task
+
+
+class Cancel(ElementBase):
+
+    """
+    A request to stop the tasks of a job that a worker is running or
+    holding in its prefetch queue, carrying every such task at once.
+
+    The worker kills the process groups of the running tasks and
+    drops the prefetched ones, and answers with the tasks it stopped.
+
+    Example stanzas:
+        <iq type="set" to="worker@example.com/kestrel">
+          <cancel xmlns="kestrel:tasks" job="12">
+            <task id="3" />
+            <task id="4" />
+          </cancel>
+        </iq>
+
+        <iq type="result" from="worker@example.com/kestrel">
+          <cancel xmlns="kestrel:tasks" job="12">
+            <task id="3" status="cancelled" />
+          </cancel>
+        </iq>
+
+    Stanza Interface:
+        job   -- The ID of the job the tasks belong to.
+        tasks -- The Task substanzas.
+
+    Methods:
+        add_task -- Add a task to the request.
+    """
+
+    name = 'cancel'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_cancel'
+    interfaces = set(('job', 'tasks'))
+
+    def get_tasks(self):
+        return [task for task in self['substanzas'] if isinstance(task, Task)]
+
+    def add_task(self, id, status=None):
+        """
+        Add a task to the request.
+
+        Arguments:
+            id     -- The task's number within the job.
+            status -- The outcome of the task.
+        """
+        task = Task()
+        task['id'] = id
+        if status is not None:
+            task['status'] = status
+        self.append(task)
+        return task
+
+
+class Slots(ElementBase):
+
+    """
+    The task slots of a worker, included in its presence updates.
+
+    A worker with a prefetch queue also accepts tasks while every
+    slot is in use, and starts them as soon as a slot frees up.
+    Workers in pull mode claim their own tasks from the backend and
+    are never sent tasks by the manager.
+
+    Example stanza:
+        <presence>
+          <status>Ready for Task</status>
+          <slots xmlns="kestrel:tasks" free="3" total="4" prefetch="1"
+                 mode="pull" />
+        </presence>
+
+    Stanza Interface:
+        free     -- The number of additional tasks the worker will accept.
+        total    -- The number of tasks the worker can run at once.
+        prefetch -- The number of tasks the worker will hold waiting
+                    for a free slot.
+        mode     -- Either "pull" for workers that claim their own
+                    tasks, or empty.
+    """
+
+    name = 'slots'
+    namespace = 'kestrel:tasks'
+    plugin_attrib = 'kestrel_slots'
+    interfaces = set(('free', 'total', 'prefetch', 'mode'))
+
+    def get_free(self):
+        return int(self._get_attr('free', '0'))
+
+    def get_total(self):
+        return int(self._get_attr('total', '0'))
+
+    def get_prefetch(self):
+        return int(self._get_attr('prefetch', '0'))
+
+
+# The disco feature advertised by workers that accept Task stanzas.
+DISPATCH_FEATURE = 'kestrel:tasks:dispatch'
+
+# The disco feature advertised by workers that accept Bundle stanzas.
+BUNDLE_FEATURE = 'kestrel:tasks:bundle'
+
+# The disco feature advertised by workers that accept Cancel stanzas.
+CANCEL_FEATURE = 'kestrel:tasks:cancel'
+
+
+register_stanza_plugin(Iq, Task)
+register_stanza_plugin(Iq, Bundle)
+register_stanza_plugin(Iq, Cancel)
+register_stanza_plugin(Iq, Output)
+register_stanza_plugin(Task, Output, iterable=True)
+register_stanza_plugin(Task, Resources)
+register_stanza_plugin(Bundle, Task, iterable=True)
+register_stanza_plugin(Cancel, Task, iterable=True)
+register_stanza_plugin(Presence, Slots)
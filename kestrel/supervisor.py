@@ -0,0 +1,486 @@
+"""
+    Kestrel: An XMPP-based Job Scheduler
+    Copyright (C) 2011 Lance Stout
+    This file is part of Kestrel.
+
+    See the file LICENSE for copying permission.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kestrel.spool import READ_SIZE
+
+
+log = logging.getLogger(__name__)
+
+
+# The number of seconds to wait for the rest of a command's output
+# once it has exited. Background processes the command left behind
+# may hold its output open; their output is not waited for.
+PUMP_TIMEOUT = 5
+
+# The number of seconds a command that ran out of time is given to
+# exit after being sent SIGTERM, before its process group is killed.
+KILL_GRACE = 10
+
+# The number of seconds between checks for exited commands when no
+# SIGCHLD arrives, as when the Supervisor was started off the main
+# thread and could not install a handler.
+REAP_INTERVAL = 0.05
+
+# The number of seconds between checks of every command one by one,
+# which finds the commands that were reaped by someone else.
+SCAN_INTERVAL = 1
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    """
+    Return the Supervisor of this process, starting it on first use.
+    Only one Supervisor should run in a process, since each installs
+    its own SIGCHLD handler.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Supervisor()
+        return _shared
+
+
+class Process(object):
+
+    """
+    A command started by a Supervisor.
+
+    Attributes:
+        pid       -- The process ID, which is also the ID of the process
+                     group the command runs in.
+        started   -- The time the command was started.
+        ended     -- The time the command exited.
+        status    -- The exit status as returned by os.wait4.
+        rusage    -- The resource usage as returned by os.wait4.
+        spool     -- The Spool the command's output is written to.
+        timed_out -- True once the command was stopped for running
+                     past its time limit.
+    """
+
+    def __init__(self, popen, spool, callback):
+        self.popen = popen
+        self.pid = popen.pid
+        self.spool = spool
+        self.callback = callback
+        self.started = time.time()
+        self.ended = None
+        self.status = None
+        self.rusage = None
+        self.streams = set()
+        self.exited = False
+        self.done = False
+        self.timed_out = False
+
+    @property
+    def returncode(self):
+        """The exit code, or minus the signal that killed the command."""
+        if self.status is None:
+            return None
+        if os.WIFSIGNALED(self.status):
+            return -os.WTERMSIG(self.status)
+        return os.WEXITSTATUS(self.status)
+
+
+class Supervisor(object):
+
+    """
+    Start commands and watch them with a fixed number of threads,
+    however many commands are running.
+
+    One thread reaps the commands it started with os.wait4, one
+    copies the output of every running command into its spool using
+    poll, and one runs the completion callbacks in order. A command is
+    done once it has exited and its output has been read to the end.
+
+    The reaper is woken by SIGCHLD when the Supervisor is started on
+    the main thread, and otherwise checks every REAP_INTERVAL seconds.
+    Exited children are looked up with os.waitid without reaping them,
+    and only the process IDs of its own commands are waited for, so
+    other children of the process are left to whoever started them.
+
+    The output thread also stops commands that run past their time
+    limit, with SIGTERM and, once a grace period is over, SIGKILL to
+    their whole process group.
+
+    Use shared() to get the one Supervisor of the process.
+    """
+
+    def __init__(self):
+        self.procs = {}
+        self.lock = threading.Lock()
+        self.children = threading.Condition(self.lock)
+        self.callbacks = queue.Queue()
+
+        # Output pipes and time limits are only changed by the pump
+        # thread, which is woken up through a pipe of its own.
+        self.poller = select.poll()
+        self.streams = {}
+        self.changes = []
+        self.deadlines = {}
+        self.limits = {}
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wake_read, select.POLLIN)
+
+        # SIGCHLD wakes the reaper through a pipe of its own.
+        self.reap_read, self.reap_write = os.pipe()
+        for fd in (self.reap_read, self.reap_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.signalled = False
+        self.previous_handler = None
+        if threading.current_thread().name == 'MainThread':
+            self.previous_handler = signal.signal(signal.SIGCHLD,
+                                                  self._sigchld)
+            signal.siginterrupt(signal.SIGCHLD, False)
+            self.signalled = True
+
+        for name, target in (('Kestrel Reaper', self._reap),
+                             ('Kestrel Output', self._pump),
+                             ('Kestrel Callbacks', self._dispatch)):
+            thread = threading.Thread(name=name, target=target)
+            thread.daemon = True
+            thread.start()
+
+    def spawn(self, command, spool=None, callback=None, stdin=False,
+              env=None, walltime=None, grace=KILL_GRACE):
+        """
+        Start a command in a process group of its own.
+
+        Arguments:
+            command  -- The shell command to run, or a list of the
+                        program and arguments to run without a shell.
+            spool    -- The Spool to copy the command's output to, or
+                        any object with a write(stream, data) method.
+                        The output is discarded when no spool is given.
+            callback -- Called with the Process once the command is done.
+            stdin    -- True to give the command a pipe as its input,
+                        available as process.popen.stdin.
+            env      -- The environment of the command, if not ours.
+            walltime -- The number of seconds the command may run
+                        before it is stopped, or None for no limit.
+            grace    -- The number of seconds the command has to exit
+                        after SIGTERM before it is killed.
+
+        Returns the Process.
+        """
+        if not isinstance(command, list):
+            command = ['sh', '-c', "%s" % command]
+        devnull = None
+        if spool is None:
+            devnull = open(os.devnull, 'wb')
+        output = devnull or subprocess.PIPE
+        try:
+            # Holding the lock keeps the reaper from collecting the
+            # child before its output and limits are registered.
+            with self.lock:
+                popen = subprocess.Popen(command,
+                                         shell=False,
+                                         stdin=subprocess.PIPE if stdin \
+                                               else None,
+                                         stdout=output,
+                                         stderr=output,
+                                         env=env,
+                                         preexec_fn=os.setsid)
+                proc = Process(popen, spool, callback)
+                self.procs[proc.pid] = proc
+                if spool is not None:
+                    for stream, pipe in (('stdout', popen.stdout),
+                                         ('stderr', popen.stderr)):
+                        proc.streams.add(pipe.fileno())
+                        self.changes.append(('stream', proc,
+                                             (pipe, stream)))
+                if walltime:
+                    self.changes.append(('limit', proc, (
+                        proc.started + walltime, grace)))
+                self.children.notify()
+        finally:
+            if devnull is not None:
+                devnull.close()
+        if spool is not None or walltime:
+            self._wake()
+        return proc
+
+    def call(self, func, *args):
+        """Run a function on the callback thread."""
+        self.callbacks.put((func, args))
+
+    def limit(self, proc, walltime, grace=KILL_GRACE):
+        """
+        Stop a running command once it has run for a number of seconds
+        from now, replacing any limit it already had.
+
+        Arguments:
+            proc     -- The Process to limit.
+            walltime -- The number of seconds the command may run.
+            grace    -- The number of seconds the command has to exit
+                        after SIGTERM before it is killed.
+        """
+        with self.lock:
+            self.changes.append(('limit', proc,
+                                 (time.time() + walltime, grace)))
+        self._wake()
+
+    def unlimit(self, proc):
+        """Remove a command's time limit, unless it already ran out."""
+        with self.lock:
+            self.changes.append(('unlimit', proc, None))
+        self._wake()
+
+    def kill(self, proc, sig=signal.SIGKILL):
+        """Send a signal to every process in a command's process group."""
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            pass
+
+    def running(self):
+        """Return the number of commands that have not exited."""
+        with self.lock:
+            return len(self.procs)
+
+    def _wake(self):
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError:
+            pass
+
+    def _sigchld(self, signum, frame):
+        try:
+            os.write(self.reap_write, b'x')
+        except OSError:
+            pass
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+
+    def _reap(self):
+        scanned = time.time()
+        while True:
+            with self.lock:
+                while not self.procs:
+                    self.children.wait()
+            if not self._reap_exited() or \
+               time.time() - scanned >= SCAN_INTERVAL:
+                with self.lock:
+                    pids = list(self.procs)
+                for pid in pids:
+                    self._reap_pid(pid)
+                scanned = time.time()
+            timeout = 1 if self.signalled else REAP_INTERVAL
+            try:
+                # The timeout also covers a SIGCHLD that arrived before
+                # its command was known.
+                if select.select([self.reap_read], [], [], timeout)[0]:
+                    while os.read(self.reap_read, 4096):
+                        pass
+            except (IOError, OSError, select.error):
+                pass
+
+    def _reap_exited(self):
+        """
+        Collect the commands that have exited, taking each exited child
+        in turn rather than checking every command.
+
+        Returns False when the commands must be checked one by one,
+        because an exited child was started by someone else, or
+        os.waitid is not available.
+        """
+        if not hasattr(os, 'waitid'):
+            return False
+        while True:
+            try:
+                # WNOWAIT leaves the child to be reaped, so a child of
+                # someone else keeps its exit status.
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG |
+                                              os.WNOWAIT)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                return e.errno == errno.ECHILD
+            if info is None or info.si_pid == 0:
+                return True
+            with self.lock:
+                ours = info.si_pid in self.procs
+            if not ours:
+                return False
+            self._reap_pid(info.si_pid)
+
+    def _reap_pid(self, pid):
+        """Collect a command that has exited, if it has."""
+        try:
+            pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return
+            if e.errno != errno.ECHILD:
+                log.exception('SUPERVISOR: Error reaping %s' % pid)
+                return
+            # Someone else reaped it, so its status is lost.
+            log.warning('SUPERVISOR: Process %s was reaped elsewhere' % pid)
+            status, rusage = None, None
+        else:
+            if pid == 0:
+                return
+
+        with self.lock:
+            proc = self.procs.pop(pid, None)
+            if proc is None:
+                return
+            proc.ended = time.time()
+            proc.status = status
+            proc.rusage = rusage
+            proc.exited = True
+            # Keep the subprocess module from reaping it again.
+            if proc.popen.returncode is None:
+                proc.popen.returncode = proc.returncode
+            self.changes.append(('exited', proc, None))
+        self._wake()
+        self._finish(proc)
+
+    def _pump(self):
+        while True:
+            timeout = None
+            deadlines = list(self.deadlines.values()) + \
+                        [limit[0] for limit in self.limits.values()]
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0)
+                timeout = int(timeout * 1000)
+            try:
+                events = self.poller.poll(timeout)
+            except (IOError, OSError, select.error):
+                continue
+            self._abandon()
+            self._enforce()
+            for fd, event in events:
+                if fd == self.wake_read:
+                    self._update_streams()
+                    continue
+                if fd not in self.streams:
+                    continue
+                pipe, proc, stream = self.streams[fd]
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except OSError:
+                    data = b''
+                if data:
+                    try:
+                        proc.spool.write(stream, data)
+                    except (IOError, OSError, ValueError):
+                        log.exception('SUPERVISOR: Error writing output')
+                else:
+                    self._close_stream(fd)
+
+    def _update_streams(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError:
+            pass
+        with self.lock:
+            changes = self.changes
+            self.changes = []
+        for change, proc, value in changes:
+            if change == 'stream':
+                pipe, stream = value
+                self.streams[pipe.fileno()] = (pipe, proc, stream)
+                self.poller.register(pipe, select.POLLIN)
+            elif change == 'exited':
+                # Wait a while for output still held open by processes
+                # the command left behind.
+                if proc.streams:
+                    self.deadlines[proc] = proc.ended + PUMP_TIMEOUT
+                if proc in self.limits and not proc.timed_out:
+                    del self.limits[proc]
+            elif change == 'limit':
+                if not proc.exited and not proc.timed_out:
+                    deadline, grace = value
+                    self.limits[proc] = (deadline, grace)
+            elif change == 'unlimit':
+                if not proc.timed_out:
+                    self.limits.pop(proc, None)
+
+    def _abandon(self):
+        """Stop waiting for output from commands that exited too long ago."""
+        now = time.time()
+        for proc, deadline in list(self.deadlines.items()):
+            if deadline > now:
+                continue
+            for fd in [fd for fd in self.streams
+                       if self.streams[fd][1] is proc]:
+                self._close_stream(fd)
+            self.deadlines.pop(proc, None)
+
+    def _enforce(self):
+        """
+        Send SIGTERM to the commands that ran out of time, and SIGKILL
+        to those still running once their grace period is over.
+        """
+        now = time.time()
+        for proc, (deadline, grace) in list(self.limits.items()):
+            if deadline > now:
+                continue
+            if not proc.timed_out:
+                log.info('SUPERVISOR: Stopping %s after its time ran out' % (
+                    proc.pid))
+                proc.timed_out = True
+                self.kill(proc, signal.SIGTERM)
+                self.limits[proc] = (now + grace, grace)
+            else:
+                # The rest of the process group may outlive the command.
+                if not proc.exited:
+                    log.info('SUPERVISOR: Killing %s after SIGTERM' % (
+                        proc.pid))
+                self.kill(proc, signal.SIGKILL)
+                del self.limits[proc]
+
+    def _close_stream(self, fd):
+        pipe, proc, stream = self.streams.pop(fd)
+        self.poller.unregister(fd)
+        pipe.close()
+        with self.lock:
+            proc.streams.discard(fd)
+            closed = not proc.streams
+        if closed:
+            self.deadlines.pop(proc, None)
+        self._finish(proc)
+
+    def _finish(self, proc):
+        with self.lock:
+            if proc.done or not proc.exited or proc.streams:
+                return
+            proc.done = True
+        if proc.callback is not None:
+            self.call(proc.callback, proc)
+
+    def _dispatch(self):
+        while True:
+            func, args = self.callbacks.get()
+            try:
+                func(*args)
+            except:
+                log.exception('SUPERVISOR: Error in completion callback')
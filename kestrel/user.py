@@ -27,6 +27,10 @@ def read_job(file):
         queue=5
         command=./run_task.sh
         cleanup=./cleanup.sh
+        priority=10
+        bundle=auto
+        walltime=3600
+        retries=1
         requires=FOO BAR
                  BAZ
     """
@@ -9,6 +9,8 @@
 import logging
 import sleekxmpp
 
+from kestrel.connection import connection_pool
+
 
 class Worker(sleekxmpp.ClientXMPP):
 
@@ -27,8 +29,37 @@ class Worker(sleekxmpp.ClientXMPP):
         self.register_plugin('xep_0050')
         self.register_plugin('xep_0199')
         self.register_plugin('kestrel_executor',
-                             {'max_tasks': 1},
+                             {'max_tasks': self.config['slots'],
+                              'prefetch': self.config['prefetch'],
+                              'pull': self.config['pull'],
+                              'output_dir': self.config['output_dir'] or None,
+                              'output_limit': self.config['output_limit'],
+                              'output_backups': self.config['output_backups'],
+                              'output_return': self.config['output_return'],
+                              'output_tail': self.config['output_tail'],
+                              'output_keep': self.config['output_keep'],
+                              'runners': self.config['runners'],
+                              'runner_tasks': self.config['runner_tasks'],
+                              'runner_growth': self.config['runner_growth'],
+                              'runner_python': self.config['runner_python'],
+                              'runner_entries': self.config['runner_entries'],
+                              'walltime': self.config['walltime'],
+                              'walltime_grace': self.config['walltime_grace']},
                              module='kestrel.plugins.kestrel_executor')
+        if self.config['pull']:
+            redis = self.config['redis']
+            pool = connection_pool(host=redis['host'] or 'localhost',
+                                   port=redis['port'],
+                                   db=redis['database'],
+                                   path=redis['socket'] or None,
+                                   keepalive=redis['keepalive'])
+            self.register_plugin(
+                    'kestrel_pull',
+                    {'pool': pool,
+                     'running_lease': self.config['running_lease'],
+                     'usage_halflife': self.config['usage_halflife'],
+                     'bundle_target': self.config['bundle_target']},
+                    module='kestrel.plugins.kestrel_pull')
 
         self['xep_0030'].add_identity(category='client',
                                       itype='bot',
@@ -42,8 +73,16 @@ class Worker(sleekxmpp.ClientXMPP):
 
     def start(self, event):
         self.get_roster()
-        self.send_presence()
+        self['kestrel_executor'].send_status()
         self.manager_online(direct=True)
+        self.schedule('Kestrel Heartbeat',
+                      self.config['heartbeat'],
+                      self.heartbeat,
+                      repeat=True)
+
+    def heartbeat(self):
+        """Let the manager know that our running tasks are still alive."""
+        self['xep_0199'].send_ping(self.manager, block=False)
 
     def manager_online(self, presence=None, direct=False):
         if direct or presence['from'] == self.manager:
@@ -0,0 +1,51 @@
+"""
+Backends shared by the Kestrel backend tests.
+
+Every backend is tested: the Redis backends run against fakeredis,
+and the scripted one needs lupa to run its Lua. Both are required,
+so that a missing package fails the tests instead of quietly leaving
+only the in-memory backend tested.
+"""
+
+try:
+    import fakeredis
+    import lupa
+except ImportError as e:
+    raise ImportError('The backend tests need fakeredis and lupa '
+                      '(pip install fakeredis lupa): %s' % e)
+
+from kestrel.memory import MemoryKestrel
+
+
+BACKENDS = ['memory', 'redis', 'scripted']
+
+
+def make_redis():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def make_backend(name, redis=None, **options):
+    """
+    Return a new backend of the given kind.
+
+    Arguments:
+        name    -- One of 'memory', 'redis' or 'scripted'.
+        redis   -- The Redis client to use, a new one by default.
+        options -- Keyword options passed on to the backend.
+    """
+    if name == 'memory':
+        return MemoryKestrel(None, **options)
+    from kestrel.backend import Kestrel, ScriptedKestrel
+    if redis is None:
+        redis = make_redis()
+    if name == 'scripted':
+        return ScriptedKestrel(redis, **options)
+    return Kestrel(redis, **options)
+
+
+def backends(**options):
+    """
+    Yield the name of each backend and a new instance of it.
+    """
+    for name in BACKENDS:
+        yield name, make_backend(name, **options)
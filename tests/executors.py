@@ -0,0 +1,59 @@
+"""
+An executor plugin without an XMPP connection, for testing how it
+runs the tasks it is sent.
+
+The executor is set up by its own plugin_init(), against a stand-in
+client that records the stanzas it sends.
+"""
+
+try:
+    from kestrel.plugins.kestrel_executor import kestrel_executor
+except ImportError:
+    kestrel_executor = None
+
+from managers import JID, Sent, XMPP
+
+
+class Iq(dict):
+
+    """A task or bundle stanza received from the manager."""
+
+    def __init__(self, xmpp, **plugins):
+        dict.__init__(self, plugins)
+        self.xmpp = xmpp
+        self['from'] = JID('pool@example.com')
+
+    def reply(self):
+        reply = Sent(self.xmpp, 'iq')
+        reply['type'] = 'result'
+        return reply
+
+    def exception(self, error):
+        reply = Sent(self.xmpp, 'iq')
+        reply['type'] = 'error'
+        reply['error'] = error
+        reply.send()
+
+
+def make_executor(output_dir, **config):
+    """
+    Return an executor writing its spools under output_dir.
+
+    Arguments:
+        output_dir -- The directory task output is written to.
+        config     -- Plugin options, in place of the defaults.
+    """
+    executor = kestrel_executor.__new__(kestrel_executor)
+    executor.xmpp = XMPP()
+    executor.config = dict({'output_dir': output_dir}, **config)
+    executor.plugin_init()
+    return executor
+
+
+def task_iq(executor, job, task, command, cleanup='', walltime=None):
+    """Return a kestrel:tasks stanza sending a single task."""
+    return Iq(executor.xmpp, kestrel_task={'job': job,
+                                           'id': task,
+                                           'command': command,
+                                           'cleanup': cleanup,
+                                           'walltime': walltime})
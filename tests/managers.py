@@ -0,0 +1,150 @@
+"""
+A manager plugin without an XMPP connection, for testing its handlers.
+
+The manager is set up by its own plugin_init(), against a stand-in
+client that runs raised events through the registered handlers.
+"""
+
+import threading
+
+try:
+    from kestrel.plugins.kestrel_manager.manager import kestrel_manager
+except ImportError:
+    kestrel_manager = None
+
+
+class JID(object):
+
+    """Just enough of a JID for the manager to compare and log it."""
+
+    def __init__(self, full):
+        self.full = full
+        self.jid = full
+        self.bare = full.split('/')[0]
+
+    def __str__(self):
+        return self.full
+
+
+class Stanza(dict):
+
+    """A received stanza, read with stanza['from'] and the like."""
+
+    def __init__(self, sender, **values):
+        dict.__init__(self, values)
+        self['from'] = JID(sender)
+        self.setdefault('to', JID('pool@example.com'))
+
+
+class Sent(dict):
+
+    """A stanza being built and sent, with its plugins as dicts."""
+
+    def __init__(self, xmpp, kind):
+        dict.__init__(self)
+        self.xmpp = xmpp
+        self.kind = kind
+
+    def __missing__(self, key):
+        value = self[key] = Sent(self.xmpp, key)
+        return value
+
+    def add_output(self, stream, data, dropped=0):
+        self.setdefault('output', {})[stream] = data
+
+    def add_task(self, id, **values):
+        task = Sent(self.xmpp, 'task')
+        task['id'] = id
+        task.update(values)
+        self.setdefault('tasks', []).append(task)
+        return task
+
+    def enable(self, name):
+        self[name]
+
+    def send(self, block=True):
+        with self.xmpp.sent_lock:
+            self.xmpp.sent.append(self)
+            self.xmpp.sent_cond.notify_all()
+
+
+class XMPP(object):
+
+    """The parts of a client the plugins use, recording what they do."""
+
+    def __init__(self):
+        self.boundjid = JID('pool@example.com')
+        self.plugin = {}
+        self.stop = threading.Event()
+        self.events = []
+        self.handlers = {}
+        self.scheduled = []
+        self.sent = []
+        self.sent_lock = threading.Lock()
+        self.sent_cond = threading.Condition(self.sent_lock)
+        self.ids = 0
+
+    def Iq(self):
+        iq = Sent(self, 'iq')
+        with self.sent_lock:
+            self.ids += 1
+            iq['id'] = str(self.ids)
+        return iq
+
+    def Presence(self):
+        return Sent(self, 'presence')
+
+    def wait_for(self, count, kind='iq', timeout=10):
+        """Wait until count stanzas of a kind have been sent."""
+        with self.sent_lock:
+            found = lambda: [s for s in self.sent if s.kind == kind]
+            while len(found()) < count:
+                if not self.sent_cond.wait(timeout):
+                    break
+            return found()
+
+    def event(self, name, data=None):
+        self.events.append((name, data))
+        for handler in self.handlers.get(name, []):
+            handler(data)
+
+    def add_event_handler(self, name, handler):
+        self.handlers.setdefault(name, []).append(handler)
+
+    def register_handler(self, handler):
+        pass
+
+    def register_plugin(self, name, config=None, module=None):
+        pass
+
+    def schedule(self, name, seconds, callback, repeat=False):
+        self.scheduled.append(name)
+
+
+def make_manager(backend, **config):
+    """
+    Return a manager using the given backend, with its events
+    handled by a single handler thread.
+
+    Arguments:
+        backend -- The Kestrel backend the manager uses.
+        config  -- Plugin options, in place of the defaults.
+    """
+    manager = kestrel_manager.__new__(kestrel_manager)
+    manager.xmpp = XMPP()
+    manager.config = dict({'backend': 'memory', 'handler_threads': 1},
+                          **config)
+    manager.plugin_init()
+    manager.kestrel = backend
+    return manager
+
+
+def settle(manager, timeout=10):
+    """Wait until the manager has handled every event raised so far."""
+    while True:
+        done = threading.Event()
+        manager.handlers.submit('settle', done.set)
+        if not done.wait(timeout):
+            return False
+        if not manager.handlers.depth():
+            return True
@@ -0,0 +1,79 @@
+import unittest
+
+from backends import backends, make_backend, make_redis
+
+
+class BitmapTestCase(unittest.TestCase):
+
+    def test_unique_claims(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.worker_available('w', 1)
+            job, matches = k.submit_job('1', 'alice', 'c', '', 500,
+                                        ['foo'], bundle=7)
+            matches = [(job, tasks) for worker, tasks in matches]
+            claimed = []
+            while matches:
+                for job, tasks in matches:
+                    claimed.extend(tasks)
+                    for task in tasks:
+                        k.task_finish('w', job, task)
+                matches = k.worker_available('w')
+            self.assertEqual(sorted(int(task) for task in claimed),
+                             list(range(500)), name)
+            status = k.job_status('1')['1']
+            self.assertEqual(status['completed'], 500, name)
+            self.assertEqual(status['queued'], 0, name)
+
+    def test_reset_tasks_reclaimed(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.worker_available('w', 100)
+            job, matches = k.submit_job('1', 'alice', 'c', '', 300, ['foo'],
+                                        bundle=10)
+            claimed = [task for worker, tasks in matches for task in tasks]
+            self.assertEqual(len(claimed), 300, name)
+            for task in ['3', '70', '71', '299']:
+                k.task_reset('w', '1', task)
+            self.assertEqual(k.job_status('1')['1']['queued'], 4, name)
+            for worker, tasks in matches:
+                for task in tasks:
+                    k.task_finish('w', '1', task)
+            matches = k.worker_available('w')
+            self.assertEqual(sorted(task for job, tasks in matches
+                                    for task in tasks),
+                             ['299', '3', '70', '71'], name)
+
+    def test_repeated_finish(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            (job, (task,)), = k.worker_available('w')
+            k.task_start('w', job, task)
+            k.task_finish('w', job, task)
+            k.task_finish('w', job, task)
+            self.assertEqual(k.job_status('1')['1']['completed'], 1, name)
+            (job, (task,)), = k.worker_available('w')
+            k.task_start('w', job, task)
+            self.assertTrue(k.task_finish('w', job, task), name)
+            self.assertEqual(k.user_jobs('alice'), set(), name)
+
+    def test_no_keys_per_queued_task(self):
+        redis = make_redis()
+        k = make_backend('redis', redis=redis)
+        k.submit_job('1', 'alice', 'c', '', 100000, ['foo'])
+        self.assertEqual(len(redis.keys('job:1:*')), 1)
+        k.register_worker('w', ['foo'])
+        (job, (task,)), = k.worker_available('w')
+        self.assertTrue(redis.getbit('job:1:bits:claimed', task))
+        self.assertEqual(redis.get('job:1:task:%s' % task), 'w')
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(BitmapTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,184 @@
+import unittest
+
+from kestrel.backend import BUNDLE_LIMIT, bundle_size, task_seconds
+
+from backends import backends, make_backend, make_redis
+from managers import Stanza, kestrel_manager, make_manager, settle
+
+
+class BundleSizeTestCase(unittest.TestCase):
+
+    def test_fixed(self):
+        self.assertEqual(bundle_size(4, 100, 10, 5), 4)
+        self.assertEqual(bundle_size('3', 0, 0, 5), 3)
+        self.assertEqual(bundle_size(None, 100, 10, 5), 1)
+
+    def test_automatic(self):
+        self.assertEqual(bundle_size(0, 0, 0, 5), 1)
+        self.assertEqual(bundle_size(0, 10, 10, 5), 5)
+        self.assertEqual(bundle_size(0, 100, 10, 5), 1)
+        self.assertEqual(bundle_size(0, 0.001, 10, 5), BUNDLE_LIMIT)
+        self.assertEqual(bundle_size(0, 0, 10, 5), BUNDLE_LIMIT)
+
+    def test_task_seconds(self):
+        resources = {'1': {'wall': 2.0, 'cleanup': 0.5}, '2': {'wall': 1.0}}
+        self.assertEqual(task_seconds(['1', '2'], resources, 0), 3.5)
+        self.assertTrue(task_seconds(['1', '3'], resources, 0) > 1000)
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def test_fixed_bundles(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 7, ['foo'], bundle=3)
+            self.assertEqual(k.worker_available('w', 3),
+                             [('1', ['0', '1', '2']), ('1', ['3', '4', '5']),
+                              ('1', ['6'])], name)
+
+    def test_automatic_bundles(self):
+        for name, k in backends(bundle_target=5):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 20, ['foo'], bundle=0)
+            (job, tasks), = k.worker_available('w')
+            self.assertEqual(tasks, ['0'], name)
+            k.record_runtime('1', 2.0, 2)
+            k.task_finish('w', job, tasks[0])
+            (job, tasks), = k.worker_available('w')
+            self.assertEqual(len(tasks), 5, name)
+
+    def test_bundle_holds_slot(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 4, ['foo'], bundle=2)
+            (job, tasks), = k.worker_available('w')
+            k.task_finish('w', job, tasks[0])
+            self.assertEqual(k.worker_available('w'), [], name)
+            k.task_reset('w', job, tasks[1])
+            self.assertEqual(k.worker_available('w'),
+                             [('1', ['1', '2'])], name)
+
+    def test_late_tasks_held(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 3, ['foo'], bundle=3)
+            (job, tasks), = k.worker_available('w')
+            self.assertTrue(k.task_start('w', job, tasks[0]), name)
+            self.assertFalse(k.task_start('x', job, tasks[1]), name)
+            self.assertEqual(k.task_hold('w', job, tasks[1:]), tasks[1:],
+                             name)
+            k.cancel_job('1', 'alice')
+            self.assertEqual(k.task_hold('w', job, tasks[1:]), [], name)
+            self.assertFalse(k.task_start('w', job, tasks[1]), name)
+
+
+class ClaimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = make_redis()
+        self.k = make_backend('redis', redis=self.redis)
+        self.other = make_backend('redis', redis=self.redis)
+        for worker in ('w', 'x'):
+            self.k.register_worker(worker, ['foo'])
+        self.k.submit_job('1', 'alice', 'c', '', 5, ['foo'], bundle=3)
+
+    def test_watch_conflict(self):
+        conflicts = []
+        unclaimed = self.k._unclaimed
+
+        def claim_meanwhile(pipe, key, size, want):
+            tasks = unclaimed(pipe, key, size, want)
+            if not conflicts:
+                # Another manager claims a bundle after our scan.
+                conflicts.append(self.other._claim_bundle('1', 'x'))
+            return tasks
+
+        self.k._unclaimed = claim_meanwhile
+        usage = self.redis.zscore('owners:usage', 'alice') or 0
+        tasks = self.k._claim_bundle('1', 'w')
+        self.assertEqual(conflicts, [['0', '1', '2']])
+        # The first scan saw the same tasks, but they were not claimed
+        # twice; the claim was retried on what was left.
+        self.assertEqual(tasks, ['3', '4'])
+        self.assertEqual(self.k.task_owner('1', '0'), 'x')
+        self.assertEqual(self.k.task_owner('1', '3'), 'w')
+        status = self.k.job_status('1')['1']
+        self.assertEqual((status['queued'], status['pending']), (0, 5))
+        # Each task was charged once.
+        self.assertAlmostEqual(
+                self.redis.zscore('owners:usage', 'alice') - usage,
+                5 * self.k._usage_scale(self.redis), 3)
+        self.assertEqual(self.k._claim_bundle('1', 'w'), [])
+
+    def test_partial_bundle(self):
+        self.assertEqual(self.k._claim_bundle('1', 'w'), ['0', '1', '2'])
+        self.assertEqual(self.k._claim_bundle('1', 'x'), ['3', '4'])
+        self.k.task_reset('w', '1', '1')
+        # Requeued tasks are claimed again, even on their own.
+        self.assertEqual(self.k._claim_bundle('1', 'x'), ['1'])
+        self.assertEqual(self.k._claim_bundle('1', 'x'), [])
+
+
+@unittest.skipIf(kestrel_manager is None, 'sleekxmpp is not installed')
+class SendBundleTestCase(unittest.TestCase):
+
+    def claim(self, k):
+        k.register_worker('w', ['foo'])
+        k.submit_job('1', 'alice', 'c', '', 3, ['foo'], bundle=3)
+        (job, tasks), = k.worker_available('w')
+        self.assertEqual(tasks, ['0', '1', '2'])
+        manager = make_manager(k)
+        self.addCleanup(manager.handlers.stop)
+        manager.protocols['w'] = 'bundle'
+        return manager
+
+    def reply(self, iq, statuses):
+        tasks = [{'id': task, 'status': status, 'outputs': [],
+                  'resources': {'wall': 1.0, 'exit': 0}}
+                 for task, status in statuses]
+        return Stanza('w', id=iq['id'], type='result',
+                      kestrel_bundle={'job': '1', 'tasks': tasks})
+
+    def test_partial_bundle(self):
+        for name, k in backends():
+            manager = self.claim(k)
+            # Task 1 went back to the queue before the bundle was sent.
+            k.task_reset('w', '1', '1')
+            manager._dispatch_bundle('w', k.get_job('1'), ['0', '1', '2'])
+            iq, = manager.xmpp.wait_for(1)
+            self.assertEqual([task['id'] for task in
+                              iq['kestrel_bundle']['tasks']], ['0', '2'],
+                             name)
+            status = k.job_status('1')['1']
+            self.assertEqual((status['queued'], status['running']), (1, 2),
+                             name)
+
+            # Only task 0 is reported as complete; task 2 is requeued.
+            manager._handle_task_result(self.reply(iq, [('0', 'complete')]))
+            self.assertTrue(settle(manager), name)
+            status = k.job_status('1')['1']
+            self.assertEqual([status[group] for group in
+                              ['queued', 'pending', 'running', 'completed']],
+                             [2, 0, 0, 1], name)
+            self.assertEqual(manager._dispatch_jobs, set(['1']), name)
+
+    def test_nothing_left(self):
+        for name, k in backends():
+            manager = self.claim(k)
+            k.cancel_job('1', 'alice')
+            manager._dispatch_bundle('w', k.get_job('1'), ['0', '1', '2'])
+            self.assertEqual(manager.xmpp.sent, [], name)
+            self.assertEqual(manager.pending, {}, name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(BundleSizeTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(BundleTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(ClaimTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(SendBundleTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
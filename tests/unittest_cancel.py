@@ -0,0 +1,70 @@
+import unittest
+
+from backends import backends
+
+
+class CancelTestCase(unittest.TestCase):
+
+    def submit(self, k):
+        k.register_worker('w', ['foo'])
+        k.worker_available('w', 2)
+        job, matches = k.submit_job('1', 'alice', 'c', '', 5, ['foo'],
+                                    walltime=1)
+        tasks = [task for worker, tasks in matches for task in tasks]
+        k.task_start('w', job, tasks[0])
+        return tasks
+
+    def test_only_owner(self):
+        for name, k in backends():
+            self.submit(k)
+            self.assertEqual(k.cancel_job('1', 'bob'), None, name)
+            self.assertEqual(k.user_jobs('alice'), set(['1']), name)
+
+    def test_cancellations(self):
+        for name, k in backends():
+            tasks = self.submit(k)
+            self.assertEqual(k.cancel_job('1', 'alice'),
+                             {'w': set(tasks)}, name)
+            self.assertEqual(k.user_jobs('alice'), set(), name)
+            for task in tasks:
+                self.assertEqual(k.task_owner('1', task), None, name)
+
+    def test_late_reports_ignored(self):
+        for name, k in backends():
+            tasks = self.submit(k)
+            k.cancel_job('1', 'alice')
+            self.assertFalse(k.task_finish('w', '1', tasks[0]), name)
+            self.assertEqual(k.task_timeout('w', '1', tasks[1]), None, name)
+            k.task_reset('w', '1', tasks[1])
+            self.assertFalse(k.task_start('w', '1', tasks[1]), name)
+            status = k.job_status('1')['1']
+            self.assertEqual([status[group] for group in
+                              ['queued', 'pending', 'running', 'completed']],
+                             [0, 0, 0, 0], name)
+            self.assertEqual(k.pool_status()['queued'], 0, name)
+
+    def test_slots_freed(self):
+        for name, k in backends():
+            self.submit(k)
+            k.submit_job('2', 'alice', 'c', '', 2, ['foo'])
+            self.assertEqual(k.worker_available('w'), [], name)
+            k.cancel_job('1', 'alice')
+            self.assertEqual(k.worker_available('w'),
+                             [('2', ['0']), ('2', ['1'])], name)
+
+    def test_not_requeued(self):
+        for name, k in backends(pending_lease=0):
+            self.submit(k)
+            k.cancel_job('1', 'alice')
+            self.assertEqual(k.expire_leases(), set(), name)
+            self.assertEqual(k.worker_available('w'), [], name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(CancelTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
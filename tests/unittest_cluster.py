@@ -0,0 +1,201 @@
+import threading
+import time
+import unittest
+
+from backends import make_backend, make_redis
+from managers import kestrel_manager, make_manager, settle
+
+from kestrel.cluster import Cluster
+
+
+WORKERS = ['w%03d@example.com/kestrel' % i for i in range(300)]
+
+
+def join(redis, *names, **options):
+    """Start a Cluster for each name, each seeing all the others."""
+    clusters = [Cluster(redis, name, **options) for name in names]
+    for i in range(2):
+        for cluster in clusters:
+            cluster.heartbeat()
+    return clusters
+
+
+class Listener(object):
+
+    """Collect the messages sent to a manager."""
+
+    def __init__(self, cluster):
+        self.messages = []
+        self.received = threading.Condition()
+        cluster.listen(self)
+        # Wait for the subscription to be in place.
+        deadline = time.time() + 10
+        while not cluster.publish(cluster.name, {'ping': True}):
+            if time.time() > deadline:
+                raise AssertionError('%s is not listening' % cluster.name)
+            time.sleep(0.01)
+        self.wait_for(1)
+        del self.messages[:]
+
+    def __call__(self, message):
+        with self.received:
+            self.messages.append(message)
+            self.received.notify_all()
+
+    def wait_for(self, count, timeout=10):
+        with self.received:
+            if len(self.messages) < count:
+                self.received.wait(timeout)
+            return list(self.messages)
+
+
+class RingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = make_redis()
+
+    def test_single_manager(self):
+        a, = join(self.redis, 'a')
+        self.assertTrue(all(a.owns(worker) for worker in WORKERS))
+
+    def test_partitions(self):
+        clusters = join(self.redis, 'a', 'b', 'c')
+        owners = {}
+        for worker in WORKERS:
+            views = set(cluster.owner(worker) for cluster in clusters)
+            # Every manager agrees on where each worker belongs.
+            self.assertEqual(len(views), 1, worker)
+            owners[worker] = views.pop()
+        for cluster in clusters:
+            owned = [w for w in WORKERS if owners[w] == cluster.name]
+            self.assertTrue(50 < len(owned) < 150, cluster.name)
+            self.assertTrue(all(cluster.owns(w) for w in owned))
+
+    def test_leaving_moves_only_its_workers(self):
+        a, b, c = join(self.redis, 'a', 'b', 'c')
+        before = dict((worker, a.owner(worker)) for worker in WORKERS)
+        c.leave()
+        self.assertTrue(a.heartbeat())
+        self.assertTrue(b.heartbeat())
+        for worker in WORKERS:
+            if before[worker] != 'c':
+                self.assertEqual(a.owner(worker), before[worker], worker)
+            self.assertNotEqual(b.owner(worker), 'c', worker)
+
+    def test_expired_member_dropped(self):
+        a, b = join(self.redis, 'a', 'b', lease=0.2)
+        time.sleep(0.3)
+        self.assertTrue(a.heartbeat())
+        self.assertEqual(a.members, ['a'])
+        self.assertTrue(all(a.owns(worker) for worker in WORKERS))
+
+
+class LeaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = make_redis()
+
+    def test_one_leader(self):
+        a, b = join(self.redis, 'a', 'b')
+        self.assertTrue(a.leader)
+        self.assertFalse(b.leader)
+        self.assertEqual(self.redis.get('managers:leader'), 'a')
+
+    def test_takeover_after_lease(self):
+        a, b = join(self.redis, 'a', 'b', lease=0.2)
+        self.assertTrue(a.leader)
+        # The leader stops renewing its lease.
+        time.sleep(0.3)
+        b.heartbeat()
+        self.assertTrue(b.leader)
+        a.heartbeat()
+        self.assertFalse(a.leader)
+
+    def test_resign(self):
+        a, b = join(self.redis, 'a', 'b')
+        a.leave()
+        self.assertFalse(a.leader)
+        b.heartbeat()
+        self.assertTrue(b.leader)
+        # Leaving does not take the lease from another leader.
+        a.leave()
+        self.assertEqual(self.redis.get('managers:leader'), 'b')
+
+
+class PublishTestCase(unittest.TestCase):
+
+    def test_publish(self):
+        redis = make_redis()
+        a, b = join(redis, 'a', 'b')
+        listener = Listener(b)
+        self.assertTrue(a.publish('b', {'event': 'e', 'data': 'd'}))
+        self.assertEqual(listener.wait_for(1), [{'event': 'e', 'data': 'd'}])
+        # Nobody listens for c.
+        self.assertFalse(a.publish('c', {'event': 'e', 'data': 'd'}))
+
+
+@unittest.skipIf(kestrel_manager is None, 'sleekxmpp is not installed')
+class ForwardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = make_redis()
+        self.manager = make_manager(make_backend('redis', redis=self.redis))
+        self.addCleanup(self.manager.handlers.stop)
+        a, self.other = join(self.redis, 'a', 'b')
+        self.manager.cluster = a
+        self.ours = [w for w in WORKERS if a.owns(w)][0]
+        self.theirs = [w for w in WORKERS if not a.owns(w)][0]
+
+    def test_forwarded(self):
+        listener = Listener(self.other)
+        self.manager.kestrel.register_worker(self.theirs, ['foo'])
+        self.manager.xmpp.event('kestrel_worker_busy', self.theirs)
+        self.assertTrue(settle(self.manager))
+        self.assertEqual(listener.wait_for(1),
+                         [{'event': 'kestrel_worker_busy',
+                           'data': self.theirs, 'hops': 1}])
+        self.assertEqual(self.manager.kestrel.busy_workers(), set())
+
+    def test_handled_when_owner_is_gone(self):
+        # Nobody is listening for b's messages.
+        self.manager.kestrel.register_worker(self.theirs, ['foo'])
+        self.manager.xmpp.event('kestrel_worker_busy', self.theirs)
+        self.assertTrue(settle(self.manager))
+        self.assertEqual(self.manager.kestrel.busy_workers(),
+                         set([self.theirs]))
+
+    def test_hops_bounded(self):
+        listener = Listener(self.other)
+        self.manager.kestrel.register_worker(self.theirs, ['foo'])
+        self.manager._handle_cluster_message(
+                {'event': 'kestrel_worker_busy', 'data': self.theirs,
+                 'hops': 2})
+        self.assertTrue(settle(self.manager))
+        # Handled here rather than sent back again.
+        self.assertEqual(listener.messages, [])
+        self.assertEqual(self.manager.kestrel.busy_workers(),
+                         set([self.theirs]))
+        self.assertEqual(self.manager.hops, {})
+
+    def test_discover_hops_cleared(self):
+        self.manager._handle_cluster_message(
+                {'event': 'kestrel_discover_worker', 'data': self.ours,
+                 'hops': 1})
+        self.assertTrue(settle(self.manager))
+        iq, = self.manager.xmpp.wait_for(1)
+        self.assertEqual(iq['to'], self.ours)
+        self.assertTrue('disco_info' in iq)
+        self.assertEqual(self.manager.hops, {})
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(RingTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(LeaderTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(PublishTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(ForwardTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
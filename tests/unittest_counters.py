@@ -0,0 +1,87 @@
+import unittest
+
+from backends import backends
+
+
+GROUPS = ['queued', 'pending', 'running', 'completed']
+
+
+class CounterTestCase(unittest.TestCase):
+
+    def assertCounts(self, k, job, counts, name):
+        status = k.job_status(job)[job]
+        self.assertEqual([status[group] for group in GROUPS], counts, name)
+
+    def assertPool(self, k, counts, name):
+        status = k.pool_status()
+        self.assertEqual([status[group] for group in GROUPS], counts, name)
+
+    def test_transitions(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 5, ['foo'], bundle=3)
+            self.assertCounts(k, '1', [5, 0, 0, 0], name)
+            (job, tasks), = k.worker_available('w')
+            self.assertCounts(k, '1', [2, 3, 0, 0], name)
+            k.task_start('w', job, tasks[0])
+            k.task_start('w', job, tasks[0])
+            self.assertCounts(k, '1', [2, 2, 1, 0], name)
+            k.task_finish('w', job, tasks[0])
+            k.task_finish('w', job, tasks[0])
+            self.assertCounts(k, '1', [2, 2, 0, 1], name)
+            k.task_reset('w', job, tasks[1])
+            self.assertCounts(k, '1', [3, 1, 0, 1], name)
+            k.task_start('w', job, tasks[2])
+            k.worker_offline('w')
+            self.assertCounts(k, '1', [4, 0, 0, 1], name)
+            self.assertPool(k, [4, 0, 0, 1], name)
+
+    def test_pool_sums_jobs(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.worker_available('w', 3)
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            k.submit_job('2', 'bob', 'c', '', 3, ['foo'])
+            k.submit_job('3', 'bob', 'c', '', 1, ['bar'])
+            status = k.pool_status()
+            self.assertEqual((status['online'], status['available']),
+                             (1, 1), name)
+            self.assertPool(k, [3, 3, 0, 0], name)
+            k.worker_busy('w')
+            status = k.pool_status()
+            self.assertEqual((status['available'], status['busy']),
+                             (0, 1), name)
+
+    def test_cancel(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.worker_available('w', 2)
+            job, matches = k.submit_job('1', 'alice', 'c', '', 5, ['foo'])
+            (worker, (task,)) = matches[0]
+            k.task_start(worker, job, task)
+            self.assertEqual(k.cancel_job('1', 'bob'), None, name)
+            self.assertCounts(k, '1', [3, 1, 1, 0], name)
+            self.assertEqual(k.cancel_job('1', 'alice'),
+                             {'w': set(['0', '1'])}, name)
+            self.assertCounts(k, '1', [0, 0, 0, 0], name)
+            self.assertPool(k, [0, 0, 0, 0], name)
+
+    def test_completed_job(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'], bundle=2)
+            (job, tasks), = k.worker_available('w')
+            self.assertFalse(k.task_finish('w', job, tasks[0]), name)
+            self.assertTrue(k.task_finish('w', job, tasks[1]), name)
+            self.assertCounts(k, '1', [0, 0, 0, 2], name)
+            self.assertEqual(k.job_status(), {}, name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(CounterTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
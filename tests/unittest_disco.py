@@ -0,0 +1,128 @@
+import threading
+import types
+import unittest
+
+try:
+    from kestrel.plugins.kestrel_manager.manager import kestrel_manager
+except ImportError:
+    kestrel_manager = None
+
+from backends import backends
+
+
+def fill(k):
+    for i in range(53):
+        k.register_worker('w%02d' % i, ['foo'])
+    for i in range(12):
+        k.submit_job(str(i + 1), 'u%s' % (i % 3), 'c', '', 3, ['foo'])
+
+
+class Manager(object):
+
+    """Just enough of a manager to page through a backend."""
+
+    def __init__(self):
+        self._pages = {}
+        self._pages_lock = threading.Lock()
+        for name in ['_read_page', '_invalidate_pages']:
+            method = getattr(kestrel_manager, name)
+            method = getattr(method, '__func__', method)
+            setattr(self, name, types.MethodType(method, self))
+
+
+class ScanTestCase(unittest.TestCase):
+
+    def scan_all(self, scan):
+        seen = []
+        cursor, batch = scan(0, 5)
+        seen.extend(batch)
+        while cursor:
+            cursor, batch = scan(cursor, 5)
+            seen.extend(batch)
+        return seen
+
+    def test_scan_workers(self):
+        for name, k in backends():
+            fill(k)
+            seen = self.scan_all(lambda cursor, count:
+                                 k.scan_workers('online', cursor, count))
+            self.assertEqual(sorted(seen),
+                             ['w%02d' % i for i in range(53)], name)
+            self.assertEqual(k.count_workers('online'), 53, name)
+            self.assertEqual(k.count_workers('busy'), 0, name)
+
+    def test_scan_jobs(self):
+        for name, k in backends():
+            fill(k)
+            seen = self.scan_all(k.scan_jobs)
+            self.assertEqual(sorted(seen, key=lambda item: int(item[0])),
+                             [(str(i + 1), 'u%s' % (i % 3))
+                              for i in range(12)], name)
+            self.assertEqual(k.count_jobs(), 12, name)
+
+
+@unittest.skipIf(kestrel_manager is None, 'sleekxmpp is not installed')
+class PageTestCase(unittest.TestCase):
+
+    def read_all(self, manager, scan, total, size):
+        seen = []
+        after = ''
+        while True:
+            items, first, last, count = manager._read_page(
+                    after, size, scan, total, list)
+            self.assertTrue(len(items) <= size)
+            if not items:
+                return seen, count
+            seen.extend(items)
+            after = last
+
+    def test_pages(self):
+        manager = Manager()
+        for name, k in backends():
+            fill(k)
+            for size in [1, 7, 100]:
+                seen, count = self.read_all(
+                        manager,
+                        lambda cursor, count:
+                            k.scan_workers('online', cursor, count),
+                        lambda: k.count_workers('online'),
+                        size)
+                self.assertEqual(count, 53, name)
+                self.assertEqual(sorted(seen),
+                                 ['w%02d' % i for i in range(53)], name)
+                seen, count = self.read_all(manager, k.scan_jobs,
+                                            k.count_jobs, size)
+                self.assertEqual(count, 12, name)
+                self.assertEqual(len(set(seen)), 12, name)
+
+    def test_bad_position(self):
+        manager = Manager()
+        for name, k in backends():
+            fill(k)
+            items, first, last, count = manager._read_page(
+                    'junk', 5, k.scan_jobs, k.count_jobs, list)
+            self.assertEqual(first, '0:0', name)
+            self.assertEqual(len(items), 5, name)
+            items, first, last, count = manager._read_page(
+                    'end', 5, k.scan_jobs, k.count_jobs, list)
+            self.assertEqual(items, [], name)
+
+    def test_invalidate_pages(self):
+        manager = Manager()
+        for node in ['queued', 'available', 'busy']:
+            manager._pages[(node, '', 10)] = (0, [], '', '', 0)
+        manager._invalidate_pages('available', 'busy')
+        self.assertEqual(list(manager._pages), [('queued', '', 10)])
+        manager._invalidate_pages()
+        self.assertEqual(manager._pages, {})
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(ScanTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(PageTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
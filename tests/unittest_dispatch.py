@@ -0,0 +1,118 @@
+import threading
+import unittest
+
+from backends import backends
+from managers import kestrel_manager, make_manager
+
+
+@unittest.skipIf(kestrel_manager is None, 'sleekxmpp is not installed')
+class DispatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = []
+
+    def tearDown(self):
+        for manager, thread in self.threads:
+            self.stop(manager, thread)
+            manager.handlers.stop()
+
+    def stop(self, manager, thread):
+        manager.stopping = True
+        with manager._dispatch_cond:
+            manager._dispatch_cond.notify_all()
+        if thread.is_alive():
+            thread.join(5)
+
+    def start(self, k):
+        """
+        Return a manager with its dispatch thread running, and the
+        jobs it dispatched.
+        """
+        manager = make_manager(k)
+        dispatched = []
+        dispatch_job = manager._dispatch_job
+
+        def record(job):
+            dispatched.append(job)
+            dispatch_job(job)
+
+        manager._dispatch_job = record
+        thread = threading.Thread(target=manager._process_dispatch)
+        thread.daemon = True
+        self.threads.append((manager, thread))
+        return manager, thread, dispatched
+
+    def requeue(self, k):
+        """
+        Fill two slots of each of workers w and x with jobs 1 and 2,
+        then requeue the tasks given to w.
+        """
+        for worker in ('w', 'x'):
+            k.register_worker(worker, ['foo'])
+            k.worker_available(worker, 2)
+        claimed = {}
+        for job in ('1', '2'):
+            job, matches = k.submit_job(job, 'alice', 'c', '', 3, ['foo'])
+            for worker, tasks in matches:
+                claimed.setdefault(worker, []).extend(
+                        (job, task) for task in tasks)
+        for job, task in claimed['w']:
+            k.task_reset('w', job, task)
+        return claimed
+
+    def sent(self, manager, count):
+        iqs = manager.xmpp.wait_for(count)
+        return sorted((iq['to'], iq['kestrel_task']['job'],
+                       iq['kestrel_task']['id']) for iq in iqs)
+
+    def test_requests_merged(self):
+        for name, k in backends():
+            claimed = self.requeue(k)
+            self.assertEqual(len(claimed['w']), 2, name)
+            manager, thread, dispatched = self.start(k)
+            manager.protocols.update({'w': 'stanza', 'x': 'stanza'})
+            for i in range(5):
+                manager.dispatch('2')
+                manager.dispatch('1', '2')
+            self.assertEqual(manager._dispatch_jobs, set(['1', '2']), name)
+
+            thread.start()
+            sent = self.sent(manager, 2)
+            self.assertEqual(dispatched, ['1', '2'], name)
+            self.assertEqual([to for to, job, task in sent], ['w', 'w'],
+                             name)
+            self.assertEqual(len(set(sent)), 2, name)
+            self.assertEqual(manager._dispatch_jobs, set(), name)
+
+    def test_no_double_send(self):
+        for name, k in backends():
+            self.requeue(k)
+            manager, thread, dispatched = self.start(k)
+            manager.protocols.update({'w': 'stanza', 'x': 'stanza'})
+            thread.start()
+            requesters = [threading.Thread(target=manager.dispatch,
+                                           args=('1', '2'))
+                          for i in range(20)]
+            for requester in requesters:
+                requester.start()
+            for requester in requesters:
+                requester.join()
+            sent = self.sent(manager, 2)
+            self.stop(manager, thread)
+            # Every slot is full, so dispatching again sends nothing.
+            manager._dispatch_job('1')
+            manager._dispatch_job('2')
+            self.assertEqual(self.sent(manager, 2), sent, name)
+            self.assertEqual(len(manager.xmpp.sent), 2, name)
+            self.assertEqual(len(set(task for to, job, task in sent)), 2,
+                             name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(DispatchTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from executors import Iq, kestrel_executor, make_executor, task_iq
+
+
+class BrokenSupervisor(object):
+
+    """A supervisor that cannot start any command."""
+
+    def spawn(self, command, spool=None, callback=None, **options):
+        raise OSError('fork failed')
+
+
+@unittest.skipIf(kestrel_executor is None, 'sleekxmpp is not installed')
+class StatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.executor = make_executor(self.dir, max_tasks=2)
+        self.xmpp = self.executor.xmpp
+
+    def tearDown(self):
+        self.executor.runner_pool.stop()
+        shutil.rmtree(self.dir)
+
+    def test_completed(self):
+        self.executor._handle_task(task_iq(self.executor, '1', '0',
+                                           'exit 3'))
+        reply, = self.xmpp.wait_for(1)
+        self.assertEqual(reply['kestrel_task']['status'], 'complete')
+        self.assertEqual(reply['kestrel_task']['resources']['exit'], 3)
+        presence = self.xmpp.wait_for(1, 'presence')[-1]
+        self.assertEqual(presence['kestrel_slots']['free'], 2)
+
+    def test_failed_to_start(self):
+        self.executor.supervisor = BrokenSupervisor()
+        self.executor._handle_task(task_iq(self.executor, '1', '0', 'true'))
+        reply, = self.xmpp.wait_for(1)
+        self.assertEqual(reply['type'], 'error')
+        # The slot is free again, and the manager is told so.
+        self.assertEqual(self.executor.tasks, {})
+        presences = self.xmpp.wait_for(1, 'presence', timeout=5)
+        self.assertTrue(presences)
+        self.assertEqual(presences[-1]['kestrel_slots']['free'], 2)
+
+
+@unittest.skipIf(kestrel_executor is None, 'sleekxmpp is not installed')
+class PrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.executor = make_executor(self.dir, max_tasks=1, prefetch=1)
+        self.xmpp = self.executor.xmpp
+
+    def tearDown(self):
+        self.cancel('0', '1', '2')
+        self.executor.runner_pool.stop()
+        shutil.rmtree(self.dir)
+
+    def send(self, task, command):
+        self.executor._handle_task(task_iq(self.executor, '1', task,
+                                           command))
+
+    def cancel(self, *tasks):
+        self.executor._handle_cancel(
+                Iq(self.xmpp, kestrel_cancel={
+                    'job': '1', 'tasks': [{'id': task} for task in tasks]}))
+
+    def replies(self, count):
+        return dict((iq['kestrel_task']['id'], iq['kestrel_task']['status'])
+                    for iq in self.xmpp.wait_for(count)
+                    if 'kestrel_task' in iq)
+
+    def cancelled(self):
+        return [[task['id'] for task in iq['kestrel_cancel']['tasks']]
+                for iq in self.xmpp.wait_for(0)
+                if 'kestrel_cancel' in iq]
+
+    def test_depth(self):
+        self.send('0', 'sleep 30')
+        self.send('1', 'true')
+        self.assertEqual(list(self.executor.tasks), ['1,0'])
+        self.assertEqual([entry[0] for entry in self.executor.waiting],
+                         ['1,1'])
+        presence = self.xmpp.wait_for(1, 'presence')[-1]
+        self.assertEqual(presence['type'], 'dnd')
+        self.assertEqual(presence['kestrel_slots']['free'], 0)
+        # Both the slot and the prefetch queue are full.
+        self.assertRaises(Exception, self.send, '2', 'true')
+        self.assertFalse('1,2' in self.executor.members)
+        self.assertFalse(self.executor._has_room())
+
+    def test_started_when_slot_frees(self):
+        self.send('0', 'sleep 0.2')
+        self.send('1', 'exit 0')
+        self.assertEqual(self.replies(2), {'0': 'complete', '1': 'complete'})
+        self.assertEqual(self.executor.tasks, {})
+        self.assertEqual(len(self.executor.waiting), 0)
+
+    def test_cancel_prefetched(self):
+        ran = os.path.join(self.dir, 'ran')
+        self.send('0', 'sleep 30')
+        self.send('1', 'touch %s' % ran)
+        self.cancel('1')
+        self.assertEqual(self.replies(2), {'1': 'cancelled'})
+        self.assertEqual(self.cancelled(), [['1']])
+        self.assertFalse(os.path.exists(ran))
+        self.assertEqual(len(self.executor.waiting), 0)
+        self.assertEqual(list(self.executor.members), ['1,0'])
+        self.assertTrue(self.executor._has_room())
+        # The place it held takes another task.
+        self.send('2', 'true')
+        self.assertEqual([entry[0] for entry in self.executor.waiting],
+                         ['1,2'])
+        self.cancel('0')
+        # The running task is killed, which lets the next one start.
+        replies = self.replies(5)
+        self.assertEqual(sorted(replies), ['0', '1', '2'])
+        self.assertEqual(replies['1'], 'cancelled')
+        self.assertEqual(replies['2'], 'complete')
+        self.assertEqual(self.cancelled(), [['1'], ['0']])
+        self.assertFalse(os.path.exists(ran))
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(StatusTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(PrefetchTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
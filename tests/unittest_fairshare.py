@@ -0,0 +1,97 @@
+import time
+import unittest
+
+from backends import backends, make_backend, make_redis
+
+
+def run_tasks(k, count):
+    """Run tasks on worker w one at a time, returning their jobs."""
+    jobs = []
+    for i in range(count):
+        matches = k.worker_available('w')
+        if not matches:
+            break
+        (job, (task,)), = matches
+        k.task_start('w', job, task)
+        k.task_finish('w', job, task)
+        jobs.append(job)
+    return jobs
+
+
+class FairShareTestCase(unittest.TestCase):
+
+    def test_owners_take_turns(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 20, ['foo'])
+            k.submit_job('2', 'bob', 'c', '', 3, ['foo'])
+            self.assertEqual(run_tasks(k, 8),
+                             ['1', '2', '1', '2', '1', '2', '1', '1'], name)
+
+    def test_priority(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 20, ['foo'])
+            k.submit_job('2', 'bob', 'c', '', 3, ['foo'])
+            k.submit_job('3', 'alice', 'c', '', 2, ['foo'], 5)
+            self.assertEqual(run_tasks(k, 10),
+                             ['3', '2', '3', '2', '1', '2',
+                              '1', '1', '1', '1'], name)
+            self.assertEqual(k.job_status('1')['1']['priority'], 0, name)
+
+    def test_past_usage(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 20, ['foo'])
+            run_tasks(k, 4)
+            k.worker_busy('w')
+            k.submit_job('2', 'bob', 'c', '', 10, ['foo'])
+            self.assertEqual(run_tasks(k, 6),
+                             ['2', '2', '2', '2', '1', '2'], name)
+
+    def test_usage_decays(self):
+        for name, k in backends(halflife=0.05):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 20, ['foo'])
+            run_tasks(k, 4)
+            k.worker_busy('w')
+            time.sleep(0.5)
+            k.submit_job('2', 'bob', 'c', '', 10, ['foo'])
+            self.assertEqual(run_tasks(k, 4), ['2', '1', '2', '1'], name)
+
+    def test_other_signatures(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.register_worker('x', ['bar'])
+            k.submit_job('1', 'alice', 'c', '', 4, ['bar'])
+            k.submit_job('2', 'alice', 'c', '', 4, ['foo'])
+            k.submit_job('3', 'bob', 'c', '', 4, ['foo'])
+            for job, tasks in k.worker_available('x', 3):
+                k.task_finish('x', job, tasks[0])
+            self.assertEqual(run_tasks(k, 4), ['3', '3', '3', '2'], name)
+
+    def test_signature_usage(self):
+        for name in ('redis', 'scripted'):
+            redis = make_redis()
+            k = make_backend(name, redis=redis)
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 4, ['foo'])
+            k.worker_busy('w')
+            sig = redis.hget('job:1', 'signature')
+            before = redis.zscore('signature:%s:owners' % sig, 'alice')
+            pipe = redis.pipeline()
+            k._add_usage(pipe, 'alice', [sig], 1.5)
+            # The charge replies with the new score, not a count.
+            self.assertEqual(pipe.execute()[-1], before + 1.5, name)
+            self.assertEqual(redis.zscore('signature:%s:owners' % sig,
+                                          'alice'), before + 1.5, name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(FairShareTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
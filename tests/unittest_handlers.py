@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+import unittest
+
+from kestrel.handlers import HandlerPool
+
+
+class HandlerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = HandlerPool(threads=4, size=5, name='Test Handler')
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def drain(self):
+        """Stop the pool and wait for every queued call to run."""
+        self.pool.stop()
+        for t in self.pool.threads:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+
+    def test_order_per_key(self):
+        calls = {}
+        lock = threading.Lock()
+
+        def record(key, i):
+            with lock:
+                calls.setdefault(key, []).append(i)
+
+        keys = ['worker%s@example.com' % n for n in range(10)]
+        for i in range(100):
+            for key in keys:
+                self.pool.submit(key, record, key, i)
+        self.drain()
+        for key in keys:
+            self.assertEqual(calls[key], list(range(100)), key)
+
+    def test_errors_contained(self):
+        calls = []
+
+        def fail():
+            raise ValueError('failed')
+
+        logging.disable(logging.ERROR)
+        try:
+            self.pool.submit('a', fail)
+            self.pool.submit('a', calls.append, 1)
+            self.drain()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(calls, [1])
+
+    def test_handler_submits_to_full_queue(self):
+        calls = []
+
+        def spawn(n):
+            # Fill the queue serving this same key from a pool thread,
+            # which must never block on it.
+            for i in range(n):
+                self.pool.submit('a', calls.append, i)
+
+        self.pool.submit('a', spawn, 50)
+        deadline = time.time() + 5
+        while len(calls) < 50 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(calls, list(range(50)))
+
+    def test_outside_callers_wait(self):
+        started = threading.Event()
+        release = threading.Event()
+        self.pool.submit('a', lambda: (started.set(), release.wait(5)))
+        started.wait(5)
+        for i in range(5):
+            self.pool.submit('a', lambda: None)
+
+        submitted = threading.Event()
+
+        def submit():
+            self.pool.submit('a', lambda: None)
+            submitted.set()
+
+        t = threading.Thread(target=submit)
+        t.start()
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        t.join(5)
+
+    def test_wrap(self):
+        calls = []
+        handler = self.pool.wrap(calls.append, lambda data: data['from'])
+        for i in range(10):
+            handler({'from': 'w', 'i': i})
+        self.drain()
+        self.assertEqual([data['i'] for data in calls], list(range(10)))
+
+    def test_stopped(self):
+        calls = []
+        self.drain()
+        self.pool.submit('a', calls.append, 1)
+        self.assertEqual(self.pool.depth(), 0)
+        self.assertEqual(calls, [])
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(HandlerPoolTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,81 @@
+import time
+import unittest
+
+from backends import backends
+
+
+class LeaseTestCase(unittest.TestCase):
+
+    def test_pending_lease_expires(self):
+        for name, k in backends(pending_lease=0.05):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'])
+            (job, (task,)), = k.worker_available('w')
+            self.assertEqual(k.expire_leases(), set(), name)
+            time.sleep(0.1)
+            self.assertEqual(k.expire_leases(), set(['1']), name)
+            self.assertEqual(k.job_status('1')['1']['queued'], 1, name)
+            self.assertEqual(k.task_owner(job, task), None, name)
+            self.assertFalse(k.task_start('w', job, task), name)
+            self.assertEqual(k.worker_available('w'), [('1', ['0'])], name)
+
+    def test_running_lease_renewed(self):
+        for name, k in backends(pending_lease=0.05, running_lease=0.3):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'])
+            (job, (task,)), = k.worker_available('w')
+            self.assertTrue(k.task_start('w', job, task), name)
+            for i in range(4):
+                time.sleep(0.05)
+                k.worker_heartbeat('w')
+                self.assertEqual(k.expire_leases(), set(), name)
+            self.assertEqual(k.job_status('1')['1']['running'], 1, name)
+            time.sleep(0.35)
+            self.assertEqual(k.expire_leases(), set(['1']), name)
+            self.assertEqual(k.job_status('1')['1']['queued'], 1, name)
+
+    def test_heartbeat_skips_pending(self):
+        for name, k in backends(pending_lease=0.05):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'])
+            k.worker_available('w')
+            time.sleep(0.1)
+            k.worker_heartbeat('w')
+            self.assertEqual(k.expire_leases(), set(['1']), name)
+
+    def test_hold_renews_pending(self):
+        for name, k in backends(pending_lease=0.2):
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 3, ['foo'], bundle=3)
+            (job, tasks), = k.worker_available('w')
+            self.assertTrue(k.task_start('w', job, tasks[0]), name)
+            for i in range(4):
+                time.sleep(0.05)
+                self.assertEqual(k.task_hold('w', job, tasks[1:]),
+                                 tasks[1:], name)
+                self.assertEqual(k.expire_leases(), set(), name)
+            self.assertEqual(k.task_hold('x', job, tasks[1:]), [], name)
+            time.sleep(0.25)
+            self.assertEqual(k.expire_leases(), set(['1']), name)
+            self.assertEqual(k.task_hold('w', job, tasks[1:]), [], name)
+
+    def test_offline_worker_requeued(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'], bundle=2)
+            (job, tasks), = k.worker_available('w')
+            k.task_start('w', job, tasks[0])
+            k.worker_offline('w')
+            status = k.job_status('1')['1']
+            self.assertEqual((status['queued'], status['pending'],
+                              status['running']), (2, 0, 0), name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(LeaseTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
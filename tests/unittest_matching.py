@@ -0,0 +1,127 @@
+import unittest
+
+from kestrel.backend import canonical, signature, signature_requirements
+
+from backends import backends
+
+
+class SignatureTestCase(unittest.TestCase):
+
+    def test_canonical(self):
+        self.assertEqual(canonical([' foo', 'Bar', '', None, 'FOO']),
+                         ['BAR', 'FOO'])
+
+    def test_signature(self):
+        self.assertEqual(signature(['foo', 'bar']), 'BAR,FOO')
+        self.assertEqual(signature(['bar', 'foo']), 'BAR,FOO')
+        self.assertEqual(signature([]), '')
+
+    def test_signature_requirements(self):
+        self.assertEqual(signature_requirements('BAR,FOO'),
+                         set(['BAR', 'FOO']))
+        self.assertEqual(signature_requirements(''), set())
+
+
+class MatchingTestCase(unittest.TestCase):
+
+    def test_job_matches_capable_workers(self):
+        for name, k in backends():
+            k.register_worker('both', ['foo', 'bar'])
+            k.register_worker('foo', ['foo'])
+            k.worker_available('both')
+            k.worker_available('foo')
+            job, matches = k.submit_job('1', 'alice', 'c', '', 3,
+                                        ['bar', 'foo'])
+            self.assertEqual([worker for worker, tasks in matches],
+                             ['both'], name)
+
+    def test_worker_registered_after_job(self):
+        for name, k in backends():
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo', 'bar'])
+            k.register_worker('foo', ['foo'])
+            k.register_worker('both', ['Bar', 'FOO'])
+            self.assertEqual(k.worker_available('foo'), [], name)
+            self.assertEqual(k.worker_available('both'), [('1', ['0'])],
+                             name)
+
+    def test_no_requirements(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, [])
+            self.assertEqual(k.worker_available('w'), [('1', ['0'])], name)
+
+    def test_shared_signature(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'])
+            k.submit_job('2', 'alice', 'c', '', 1, ['FOO '])
+            self.assertEqual(k.get_job('1')['signature'],
+                             k.get_job('2')['signature'])
+            jobs = set()
+            for i in range(2):
+                for job, tasks in k.worker_available('w'):
+                    k.task_finish('w', job, tasks[0])
+                    jobs.add(job)
+            self.assertEqual(jobs, set(['1', '2']), name)
+
+    def test_offline_worker(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.worker_available('w')
+            k.worker_offline('w')
+            job, matches = k.submit_job('1', 'alice', 'c', '', 1, ['foo'])
+            self.assertEqual(matches, [], name)
+            self.assertEqual(k.worker_available('w'), [], name)
+
+
+class WorkersAvailableTestCase(unittest.TestCase):
+
+    def test_turns(self):
+        for name, k in backends():
+            for worker in ('w1', 'w2', 'w3'):
+                k.register_worker(worker, ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 4, ['foo'])
+            matches = k.workers_available({'w1': 2, 'w2': 2, 'w3': 2})
+            # A short queue is spread over the pool.
+            self.assertEqual([worker for worker, job, tasks in matches],
+                             ['w1', 'w2', 'w3', 'w1'], name)
+            tasks = [task for worker, job, claimed in matches
+                     for task in claimed]
+            self.assertEqual(sorted(tasks), ['0', '1', '2', '3'], name)
+            self.assertEqual(set(job for worker, job, claimed in matches),
+                             set(['1']), name)
+
+    def test_slots(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 4, ['foo'])
+            self.assertEqual(len(k.workers_available({'w': 2})), 2, name)
+            # Slots already announced are kept.
+            k.worker_busy('w')
+            self.assertEqual(k.workers_available({'w': None}), [], name)
+            self.assertEqual(k.busy_workers(), set(), name)
+            k.task_finish('w', '1', '0')
+            self.assertEqual(k.workers_available({'w': None}),
+                             [('w', '1', ['2'])], name)
+
+    def test_offline_workers_skipped(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.register_worker('x', ['foo'])
+            k.worker_offline('x')
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            matches = k.workers_available({'w': 1, 'x': 1, 'y': 1})
+            self.assertEqual(matches, [('w', '1', ['0'])], name)
+            self.assertEqual(k.worker_available('x'), [], name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(SignatureTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(MatchingTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(WorkersAvailableTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from kestrel.memory import MemoryKestrel
+
+
+def snapshot(k, jobs):
+    """Return everything a client can see of a backend's state."""
+    state = {'pool': k.pool_status(),
+             'online': sorted(k.online_workers()),
+             'available': sorted(k.available_workers())}
+    for job in jobs:
+        state[job] = (k.get_job(job), k.job_status(job),
+                      [k.task_owner(job, task) for task in range(6)])
+    for owner in ['alice', 'bob']:
+        state[owner] = sorted(k.user_jobs(owner))
+    return state
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_pool(self, k):
+        k.register_worker('w1', ['foo'])
+        k.register_worker('w2', ['foo', 'bar'])
+        k.worker_available('w1', 2)
+        k.submit_job('1', 'alice', 'c', '', 6, ['foo'], priority=1,
+                     bundle=2)
+        k.submit_job('2', 'bob', 'c', '', 3, ['bar'], walltime=10,
+                     retries=1)
+        (job, tasks), = k.worker_available('w2')
+        k.task_start('w2', job, tasks[0])
+        k.task_finish('w2', job, tasks[0])
+        k.task_timeout('w1', '1', '0')
+        k.record_resources('1', {'0': {'wall': 2.0, 'maxrss': 1024}})
+        k.cancel_job('2', 'bob')
+        k.worker_available('w2')
+        time.sleep(0.1)
+        k.expire_leases()
+        k.worker_offline('w1')
+
+    def test_replay(self):
+        k = MemoryKestrel(self.path, pending_lease=0.05)
+        self.run_pool(k)
+        expected = snapshot(k, ['1', '2'])
+
+        recovered = MemoryKestrel(self.path, pending_lease=0.05)
+        self.assertEqual(snapshot(recovered, ['1', '2']), expected)
+
+    def test_snapshot(self):
+        k = MemoryKestrel(self.path, pending_lease=0.05, compact_every=4)
+        self.run_pool(k)
+        expected = snapshot(k, ['1', '2'])
+        self.assertTrue(os.path.exists(self.path + '.snapshot'))
+
+        recovered = MemoryKestrel(self.path, pending_lease=0.05)
+        self.assertEqual(snapshot(recovered, ['1', '2']), expected)
+        recovered = MemoryKestrel(self.path, pending_lease=0.05)
+        self.assertEqual(snapshot(recovered, ['1', '2']), expected)
+
+    def test_truncated_entry(self):
+        k = MemoryKestrel(self.path)
+        k.register_worker('w', ['foo'])
+        k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+        expected = snapshot(k, ['1'])
+        with open(self.path, 'a') as journal:
+            journal.write('{"t": 1, "m": "submit_job", "a": ["2", "bo')
+
+        recovered = MemoryKestrel(self.path)
+        self.assertEqual(snapshot(recovered, ['1']), expected)
+        self.assertEqual(recovered.user_jobs('bob'), set())
+
+    def test_without_journal(self):
+        k = MemoryKestrel(None)
+        self.run_pool(k)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(JournalTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,135 @@
+import time
+import unittest
+
+from backends import BACKENDS, make_backend, make_redis
+
+from kestrel.migrate import SCHEMA_VERSION, migrate, schema_version
+
+
+REDIS_BACKENDS = [name for name in BACKENDS if name != 'memory']
+
+
+def version_one(redis):
+    """Store a pool in the version 1 key layout."""
+    redis.sadd('workers:online', 'w')
+    redis.sadd('worker:w', 'foo')
+    redis.sadd('worker:w:tasks', '1,1')
+    redis.sadd('jobs:queued', '1')
+    redis.sadd('jobs:completed', '2')
+    for job, owner, size in [('1', 'alice', 4), ('2', 'bob', 1)]:
+        redis.set('job:%s:owner' % job, owner)
+        redis.set('job:%s:command' % job, 'echo')
+        redis.set('job:%s:cleanup' % job, '')
+        redis.set('job:%s:size' % job, size)
+        redis.sadd('job:%s:requirements' % job, 'foo')
+    redis.sadd('job:1:tasks:queued', '2', '3')
+    redis.sadd('job:1:tasks:running', '1')
+    redis.sadd('job:1:tasks:completed', '0')
+    redis.set('job:1:task:1', 'w')
+    redis.sadd('job:2:tasks:completed', '0')
+
+
+def sent_task(redis):
+    """Add a task that was sent to a worker but not yet started."""
+    redis.set('job:1:size', 5)
+    redis.sadd('job:1:tasks:pending', '4')
+    redis.sadd('worker:w:tasks', '1,4')
+    redis.set('job:1:task:4', 'w')
+    redis.set('job:1:task:4:is_pending', 'True')
+
+
+class MigrateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = make_redis()
+        version_one(self.redis)
+
+    def test_schema_version(self):
+        self.assertEqual(schema_version(self.redis), 1)
+        migrate(self.redis)
+        self.assertEqual(schema_version(self.redis), SCHEMA_VERSION)
+
+    def test_job_records(self):
+        migrate(self.redis)
+        self.assertEqual(self.redis.keys('job:1:owner'), [])
+        self.assertEqual(self.redis.keys('job:1:tasks:queued'), [])
+        for name in REDIS_BACKENDS:
+            k = make_backend(name, redis=self.redis)
+            job = k.get_job('1')
+            self.assertEqual((job['owner'], job['command'], job['size'],
+                              job['requirements']),
+                             ('alice', 'echo', '4', set(['FOO'])), name)
+            self.assertEqual(k.user_jobs('alice'), set(['1']), name)
+            self.assertEqual(k.user_jobs('bob'), set(), name)
+            status = k.job_status('1')['1']
+            self.assertEqual([status[group] for group in
+                              ['queued', 'pending', 'running', 'completed']],
+                             [2, 0, 1, 1], name)
+
+    def test_migrated_pool_runs(self):
+        for name in REDIS_BACKENDS:
+            redis = make_redis()
+            version_one(redis)
+            migrate(redis)
+            k = make_backend(name, redis=redis)
+            k.register_worker('x', ['foo'])
+            claimed = []
+            for i in range(2):
+                for job, tasks in k.worker_available('x'):
+                    claimed.extend(tasks)
+                    k.task_finish('x', job, tasks[0])
+            self.assertEqual(sorted(claimed), ['2', '3'], name)
+            self.assertEqual(k.worker_available('x'), [], name)
+            self.assertTrue(k.task_finish('w', '1', '1'), name)
+            self.assertEqual(k.job_status('1')['1']['completed'], 4, name)
+
+    def test_leases(self):
+        sent_task(self.redis)
+        started = time.time()
+        migrate(self.redis, 15, 60)
+        self.assertEqual(self.redis.keys('*is_pending'), [])
+        leases = dict(self.redis.zrange('tasks:leases', 0, -1,
+                                        withscores=True))
+        self.assertEqual(sorted(leases), ['1,1', '1,4'])
+        self.assertTrue(started + 60 <= leases['1,1'] <= time.time() + 60)
+        self.assertTrue(started + 15 <= leases['1,4'] <= time.time() + 15)
+
+        # Migrating again keeps the leases as they are.
+        migrate(self.redis, 30, 90)
+        self.assertEqual(dict(self.redis.zrange('tasks:leases', 0, -1,
+                                                withscores=True)), leases)
+
+    def test_expired_leases(self):
+        for name in REDIS_BACKENDS:
+            redis = make_redis()
+            version_one(redis)
+            sent_task(redis)
+            migrate(redis, -1, -1)
+            k = make_backend(name, redis=redis)
+            self.assertEqual(set(k.expire_leases()), set(['1']), name)
+            status = k.job_status('1')['1']
+            self.assertEqual([status[group] for group in
+                              ['queued', 'pending', 'running', 'completed']],
+                             [4, 0, 0, 1], name)
+
+    def test_repeated_migration(self):
+        migrate(self.redis)
+        before = dict((key, self.redis.type(key))
+                      for key in self.redis.keys())
+        migrate(self.redis)
+        after = dict((key, self.redis.type(key))
+                     for key in self.redis.keys())
+        self.assertEqual(before, after)
+        self.assertEqual(self.redis.hgetall('job:1:counts'),
+                         {'queued': '2', 'pending': '0',
+                          'running': '1', 'completed': '1'})
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(MigrateTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,59 @@
+import unittest
+
+from backends import backends
+from managers import Stanza, kestrel_manager, make_manager, settle
+
+
+WORKER = 'w@example.com/kestrel'
+
+
+@unittest.skipIf(kestrel_manager is None, 'sleekxmpp is not installed')
+class OfflineTestCase(unittest.TestCase):
+
+    def start_tasks(self, k):
+        k.register_worker(WORKER, ['foo'])
+        k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+        for job, tasks in k.worker_available(WORKER, 2):
+            for task in tasks:
+                k.task_start(WORKER, job, task)
+        self.assertEqual(k.job_status('1')['1']['running'], 2)
+
+    def test_ping_timeout(self):
+        for name, k in backends():
+            self.start_tasks(k)
+            manager = make_manager(k)
+            self.addCleanup(manager.handlers.stop)
+            manager.protocols[WORKER] = 'bundle'
+
+            # The server answers for a worker that is gone.
+            manager._handle_ping_error(
+                    Stanza(WORKER, type='error',
+                           error={'condition': 'remote-server-timeout'}))
+            self.assertTrue(settle(manager), name)
+
+            self.assertTrue(('kestrel_worker_offline', WORKER) in
+                            manager.xmpp.events, name)
+            self.assertFalse(WORKER in manager.protocols, name)
+            self.assertFalse(WORKER in k.online_workers(), name)
+            self.assertEqual(k.job_status('1')['1']['queued'], 2, name)
+            self.assertEqual(manager._dispatch_jobs, set(['1']), name)
+
+    def test_unavailable_presence(self):
+        for name, k in backends():
+            self.start_tasks(k)
+            manager = make_manager(k)
+            self.addCleanup(manager.handlers.stop)
+            manager.xmpp.event('kestrel_worker_offline', WORKER)
+            self.assertTrue(settle(manager), name)
+            self.assertEqual(k.job_status('1')['1']['queued'], 2, name)
+            self.assertEqual(manager._dispatch_jobs, set(['1']), name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(OfflineTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,91 @@
+import unittest
+
+from backends import BACKENDS, make_backend, make_redis
+
+
+REDIS_BACKENDS = [name for name in BACKENDS if name != 'memory']
+
+
+class PullTestCase(unittest.TestCase):
+
+    def backends(self):
+        for name in REDIS_BACKENDS:
+            redis = make_redis()
+            k = make_backend(name, redis=redis)
+            k.register_worker('w', ['foo'])
+            yield name, redis, k
+
+    def take_token(self, redis, k, name):
+        queues = k.pull_queues('w')
+        self.assertEqual(queues, ['signature:FOO:ready'], name)
+        popped = redis.lpop(queues[0])
+        self.assertEqual(popped, 'FOO', name)
+        return popped
+
+    def test_token_placed(self):
+        for name, redis, k in self.backends():
+            k.submit_job('1', 'alice', 'c', '', 3, ['foo'])
+            k.submit_job('2', 'alice', 'c', '', 3, ['foo'])
+            self.assertEqual(redis.lrange('signature:FOO:ready', 0, -1),
+                             ['FOO'], name)
+
+    def test_pull_task(self):
+        for name, redis, k in self.backends():
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            sig = self.take_token(redis, k, name)
+            self.assertEqual(k.pull_task('w', sig), ('1', ['0']), name)
+            self.assertEqual(k.job_status('1')['1']['running'], 1, name)
+            sig = self.take_token(redis, k, name)
+            self.assertEqual(k.pull_task('w', sig), ('1', ['1']), name)
+            # A drained run queue is only noticed by the next claim.
+            sig = self.take_token(redis, k, name)
+            self.assertEqual(k.pull_task('w', sig), None, name)
+            self.assertEqual(redis.llen('signature:FOO:ready'), 0, name)
+            self.assertFalse(k.pull_finish('w', '1', '0'), name)
+            self.assertTrue(k.pull_finish('w', '1', '1'), name)
+            self.assertEqual(redis.lrange('jobs:finished', 0, -1), ['1'],
+                             name)
+
+    def test_pull_timeout(self):
+        for name, redis, k in self.backends():
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'], walltime=1)
+            sig = self.take_token(redis, k, name)
+            self.assertEqual(k.pull_task('w', sig), ('1', ['0']), name)
+            self.assertEqual(k.pull_timeout('w', '1', '0'), 'completed',
+                             name)
+            self.assertEqual(redis.lrange('jobs:finished', 0, -1), ['1'],
+                             name)
+
+    def test_offline_worker(self):
+        for name, redis, k in self.backends():
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            sig = self.take_token(redis, k, name)
+            k.worker_offline('w')
+            self.assertEqual(k.pull_task('w', sig), None, name)
+            self.assertEqual(redis.lrange('signature:FOO:ready', 0, -1),
+                             ['FOO'], name)
+
+    def test_lost_token_restored(self):
+        for name, redis, k in self.backends():
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'])
+            k.submit_job('2', 'alice', 'c', '', 2, ['bar'])
+            self.take_token(redis, k, name)
+            k.expire_leases()
+            self.assertEqual(redis.lrange('signature:FOO:ready', 0, -1),
+                             ['FOO'], name)
+            self.assertEqual(redis.lrange('signature:BAR:ready', 0, -1),
+                             ['BAR'], name)
+            k.cancel_job('1', 'alice')
+            redis.delete('signature:FOO:ready')
+            k.expire_leases()
+            self.assertEqual(redis.llen('signature:FOO:ready'), 0, name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(PullTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
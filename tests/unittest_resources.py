@@ -0,0 +1,72 @@
+import unittest
+
+from kestrel.backend import resource_counts, resource_summary
+from kestrel.metrics import bucket
+
+from backends import backends
+
+
+USED = {'0': {'wall': 1.5, 'utime': 1.0, 'stime': 0.5, 'cleanup': 0.25,
+              'maxrss': 1000, 'exit': 0},
+        '1': {'wall': 3.0, 'utime': 2.0, 'stime': 0.5, 'maxrss': 3000,
+              'exit': 2},
+        '2': {'wall': 10.0, 'exit': -15, 'timeout': True}}
+
+
+class ResourceTestCase(unittest.TestCase):
+
+    def test_bucket(self):
+        self.assertEqual(bucket(0), 0)
+        self.assertEqual(bucket(-1), 0)
+        self.assertEqual(bucket(1), 1)
+        self.assertEqual(bucket(1.5), 2)
+        self.assertEqual(bucket(1024), 1024)
+        self.assertEqual(bucket(1025), 2048)
+
+    def test_resource_counts(self):
+        counts, wall, maxrss = resource_counts(USED['0'])
+        self.assertEqual(counts, {'tasks': 1, 'wall': 1.5, 'utime': 1.0,
+                                  'stime': 0.5, 'cleanup': 0.25,
+                                  'maxrss': 1000})
+        self.assertEqual((wall, maxrss), ('2', '1024'))
+        counts, wall, maxrss = resource_counts(USED['2'])
+        self.assertEqual(counts, {'tasks': 1, 'wall': 10.0, 'failed': 1,
+                                  'timeouts': 1})
+        self.assertEqual((wall, maxrss), ('16', None))
+
+    def test_resource_summary(self):
+        summary = resource_summary({}, {}, {})
+        self.assertEqual((summary['tasks'], summary['wall']), (0, 0.0))
+        summary = resource_summary({'tasks': '2', 'wall': '3.0',
+                                    'failed': '1'},
+                                   {'2': '1', '1': '1'}, {})
+        self.assertEqual(summary['wall'], 1.5)
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['wall_histogram'], [(1.0, 1), (2.0, 1)])
+
+    def test_job_status(self):
+        for name, k in backends():
+            k.submit_job('1', 'alice', 'c', '', 3, ['foo'])
+            k.record_resources('1', {'0': USED['0']})
+            k.record_resources('1', {'1': USED['1'], '2': USED['2']})
+            summary = k.job_status('1')['1']['resources']
+            self.assertEqual((summary['tasks'], summary['failed'],
+                              summary['timeouts']), (3, 2, 1), name)
+            self.assertAlmostEqual(summary['wall'], 14.5 / 3, 6, name)
+            self.assertAlmostEqual(summary['utime'], 1.0, 6, name)
+            self.assertAlmostEqual(summary['cleanup'], 0.25 / 3, 6, name)
+            self.assertAlmostEqual(summary['maxrss'], 4000.0 / 3, 6, name)
+            self.assertEqual(summary['wall_histogram'],
+                             [(2.0, 1), (4.0, 1), (16.0, 1)], name)
+            self.assertEqual(summary['maxrss_histogram'],
+                             [(1024.0, 1), (4096.0, 1)], name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(ResourceTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,200 @@
+import errno
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from kestrel import supervisor
+from kestrel.runner import RunnerPool, load, parse
+from kestrel.spool import Spool
+
+
+ENTRY_POINTS = '''
+import os
+import sys
+import time
+
+
+def echo(*args):
+    print(' '.join(args))
+    sys.stderr.write('err\\n')
+
+
+def status(code):
+    return int(code)
+
+
+def fail():
+    raise ValueError('failed')
+
+
+def leave(code):
+    sys.exit(int(code))
+
+
+def pid():
+    print(os.getpid())
+
+
+def sleep(seconds):
+    time.sleep(float(seconds))
+'''
+
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse('python:pkg.mod:func a b 3'),
+                         ('pkg.mod:func', ['a', 'b', '3']))
+        self.assertEqual(parse('python:pkg.mod:func'),
+                         ('pkg.mod:func', []))
+
+    def test_shell_commands(self):
+        self.assertEqual(parse('echo python:a:b'), None)
+        self.assertEqual(parse('python:module 3'), None)
+        self.assertEqual(parse('python:a:b:c 3'), None)
+
+    def test_load(self):
+        self.assertTrue(load('os.path:join') is os.path.join)
+        self.assertTrue(load('kestrel.runner:RunnerPool.run') is
+                        RunnerPool.run)
+
+
+class RunnerPoolTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        with open(os.path.join(cls.dir, 'kestrel_entry_points.py'),
+                  'w') as module:
+            module.write(ENTRY_POINTS)
+        # The interpreters inherit the environment the pool was
+        # created with.
+        cls.path = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+                [cls.dir] + [p for p in [cls.path] if p])
+        try:
+            cls.pool = RunnerPool(supervisor.shared(), idle=2, tasks=3)
+        finally:
+            if cls.path is None:
+                del os.environ['PYTHONPATH']
+            else:
+                os.environ['PYTHONPATH'] = cls.path
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.stop()
+        shutil.rmtree(cls.dir)
+
+    def run_task(self, function, args=(), walltime=None, grace=5,
+                 pool=None):
+        spool = Spool(tempfile.mkdtemp(dir=self.dir))
+        done = threading.Event()
+        task = (pool or self.pool).run('kestrel_entry_points:%s' % function,
+                                       list(args), spool,
+                                       lambda task: done.set(),
+                                       walltime, grace)
+        self.addCleanup(spool.close)
+        self.assertTrue(done.wait(20))
+        return task, spool
+
+    def warm_pool(self, *functions):
+        """Return a new pool with interpreters started for functions."""
+        pool = RunnerPool(supervisor.shared(), idle=2)
+        pool.env = self.pool.env
+        self.addCleanup(pool.stop)
+        pool.warm(['kestrel_entry_points:%s' % f for f in functions])
+        return pool
+
+    def output(self, spool, stream='stdout'):
+        return spool.files[stream].tail(1000).decode('utf-8')
+
+    def test_output(self):
+        task, spool = self.run_task('echo', ['hello', 'world'])
+        self.assertEqual(task.returncode, 0)
+        self.assertEqual(self.output(spool), 'hello world\n')
+        self.assertEqual(self.output(spool, 'stderr'), 'err\n')
+        self.assertFalse(task.timed_out)
+        self.assertTrue(task.rusage.ru_maxrss > 0)
+
+    def test_status(self):
+        self.assertEqual(self.run_task('status', ['5'])[0].returncode, 5)
+        self.assertEqual(self.run_task('leave', ['4'])[0].returncode, 4)
+        task, spool = self.run_task('fail')
+        self.assertEqual(task.returncode, 1)
+        self.assertTrue('ValueError' in self.output(spool, 'stderr'))
+
+    def test_warm_reuse(self):
+        pids = [self.output(self.run_task('pid')[1]) for i in range(6)]
+        # Each interpreter is replaced after three tasks.
+        self.assertEqual(len(set(pids)), 2)
+        self.assertEqual(pids[:3], [pids[0]] * 3)
+
+    def test_walltime(self):
+        task, spool = self.run_task('sleep', ['30'], walltime=0.3)
+        self.assertTrue(task.timed_out)
+        self.assertEqual(task.returncode, -signal.SIGTERM)
+        task, spool = self.run_task('sleep', ['0'], walltime=5)
+        self.assertFalse(task.timed_out)
+        self.assertEqual(task.returncode, 0)
+
+    def test_warm(self):
+        pool = self.warm_pool('pid', 'echo')
+        self.assertEqual([runner.entry for runner in pool.idle],
+                         ['kestrel_entry_points:pid',
+                          'kestrel_entry_points:echo'])
+        started = pool.idle[0].process.pid
+        self.assertEqual(self.output(self.run_task('pid', pool=pool)[1]),
+                         '%s\n' % started)
+        self.assertEqual(len(pool.idle), 2)
+
+    def test_start_failure(self):
+        pool = self.warm_pool('pid')
+        runner = pool.idle[-1]
+
+        def broken(task, args):
+            raise IOError(errno.EPIPE, 'Broken pipe')
+
+        runner.start = broken
+        called = []
+        self.assertRaises(IOError, pool.run, 'kestrel_entry_points:pid', [],
+                          None, called.append)
+        # The interpreter is let go instead of going back to the pool.
+        self.assertFalse(runner in pool.idle)
+        deadline = time.time() + 20
+        while runner.process.ended is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(runner.process.exited)
+        self.assertEqual(runner.task, None)
+        self.assertEqual(called, [])
+
+    def test_exited_during_task(self):
+        threads = []
+        done = threading.Event()
+
+        def callback(task):
+            threads.append(threading.current_thread().name)
+            done.set()
+
+        pool = self.warm_pool('sleep')
+        task = pool.run('kestrel_entry_points:sleep', ['30'], None,
+                        callback)
+        os.kill(task.pid, signal.SIGKILL)
+        self.assertTrue(done.wait(20))
+        self.assertEqual(task.returncode, -signal.SIGKILL)
+        # Reported in order with the other completions.
+        self.assertEqual(threads, ['Kestrel Callbacks'])
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(ParseTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(RunnerPoolTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,141 @@
+import random
+import time
+import unittest
+
+from backends import BACKENDS, make_backend
+
+
+def normalize(value):
+    """Return a value with its sets and dicts in a comparable form."""
+    if isinstance(value, dict):
+        return sorted((str(key), normalize(item))
+                      for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sorted(normalize(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, bool) or value is None:
+        return value
+    return str(value)
+
+
+def run(k, seed):
+    """
+    Run a random sequence of operations against a backend and return
+    everything it answered.
+    """
+    rand = random.Random(seed)
+    workers = ['w%d' % i for i in range(4)]
+    caps = {'w0': ['foo'], 'w1': ['foo'], 'w2': ['bar'],
+            'w3': ['foo', 'bar']}
+    owners = ['alice', 'bob', 'carol']
+    held = dict((worker, []) for worker in workers)
+    jobs = []
+    answers = []
+
+    def give(worker, job, tasks):
+        held[worker].extend((job, task) for task in tasks)
+
+    for worker in workers:
+        k.register_worker(worker, caps[worker])
+        answers.append(k.worker_available(worker, 2))
+
+    for step in range(300):
+        op = rand.random()
+        worker = rand.choice(workers)
+        if op < 0.1 or not jobs:
+            job = str(len(jobs) + 1)
+            jobs.append(job)
+            result = k.submit_job(job, rand.choice(owners), 'c', '',
+                                  rand.randint(1, 8),
+                                  rand.choice([['foo'], ['bar'],
+                                               ['foo', 'bar']]),
+                                  rand.randint(0, 2), rand.randint(1, 3))
+            for name, tasks in result[1]:
+                give(name, job, tasks)
+            answers.append(result)
+        elif op < 0.25:
+            result = k.worker_available(worker)
+            for job, tasks in result:
+                give(worker, job, tasks)
+            answers.append(result)
+        elif op < 0.3:
+            result = k.workers_available(dict((name, None)
+                                              for name in workers))
+            for name, job, tasks in result:
+                give(name, job, tasks)
+            answers.append(result)
+        elif op < 0.45 and held[worker]:
+            job, task = rand.choice(held[worker])
+            answers.append(k.task_start(worker, job, task))
+        elif op < 0.5 and held[worker]:
+            job = held[worker][0][0]
+            answers.append(k.task_hold(worker, job,
+                                       [task for item, task in held[worker]
+                                        if item == job]))
+        elif op < 0.7 and held[worker]:
+            job, task = held[worker].pop(0)
+            answers.append(k.task_finish(worker, job, task))
+        elif op < 0.75 and held[worker]:
+            job, task = held[worker].pop(0)
+            answers.append(k.task_reset(worker, job, task))
+        elif op < 0.8 and held[worker]:
+            job, task = held[worker].pop(0)
+            answers.append(k.task_timeout(worker, job, task))
+        elif op < 0.85:
+            answers.append(k.worker_busy(worker))
+        elif op < 0.88:
+            answers.append(k.worker_offline(worker))
+            held[worker] = []
+            k.register_worker(worker, caps[worker])
+        elif op < 0.92:
+            answers.append(k.worker_heartbeat(worker))
+        elif op < 0.95:
+            job = rand.choice(jobs)
+            answers.append(k.cancel_job(job, rand.choice(owners)))
+        else:
+            answers.append(k.job_matches(rand.choice(jobs)))
+        answers.append(k.pool_status())
+
+    for job in jobs:
+        status = k.job_status(job)[job]
+        del status['resources']
+        answers.append(status)
+    return normalize(answers)
+
+
+class ParityTestCase(unittest.TestCase):
+
+    """
+    The Lua scripts and the in-memory backend must answer every call
+    the same way as the plain Python backend.
+    """
+
+    def setUp(self):
+        # Usage charges grow with the time they are made at, so the
+        # clock is stopped for owners with equal usage to tie exactly.
+        self.time = time.time
+        now = self.time()
+        time.time = lambda: now
+
+    def tearDown(self):
+        time.time = self.time
+
+    def test_parity(self):
+        for seed in range(3):
+            expected = run(make_backend('redis'), seed)
+            for name in BACKENDS:
+                if name == 'redis':
+                    continue
+                self.assertEqual(run(make_backend(name), seed), expected,
+                                 '%s, seed %s' % (name, seed))
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(ParityTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from kestrel.spool import Spool, SpoolFile, compress, decompress
+
+
+class SpoolFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'stdout')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, spool, count):
+        data = b''.join(('%d\n' % i).encode('ascii') for i in range(count))
+        for i in range(0, len(data), 7):
+            spool.write(data[i:i + 7])
+        spool.flush()
+        return data
+
+    def test_no_rotation(self):
+        spool = SpoolFile(self.path, limit=0)
+        data = self.write(spool, 1000)
+        self.assertEqual(spool.files(), [self.path])
+        self.assertEqual(b''.join(spool.chunks(100)), data)
+        self.assertEqual(spool.dropped, 0)
+        spool.close()
+
+    def test_rotation(self):
+        spool = SpoolFile(self.path, limit=100, backups=2)
+        data = self.write(spool, 200)
+        self.assertEqual(spool.files(), [self.path + '.2', self.path + '.1',
+                                         self.path])
+        for path in spool.files():
+            self.assertTrue(os.path.getsize(path) <= 100)
+        kept = b''.join(spool.chunks(64))
+        self.assertEqual(spool.written, len(data))
+        self.assertEqual(spool.dropped + len(kept), len(data))
+        self.assertTrue(data.endswith(kept))
+        self.assertTrue(len(kept) > 200)
+        spool.close()
+
+    def test_without_backups(self):
+        spool = SpoolFile(self.path, limit=100, backups=0)
+        data = self.write(spool, 200)
+        self.assertEqual(spool.files(), [self.path])
+        kept = b''.join(spool.chunks(64))
+        self.assertEqual(spool.dropped + len(kept), len(data))
+        self.assertTrue(data.endswith(kept))
+        spool.close()
+
+    def test_tail(self):
+        spool = SpoolFile(self.path, limit=100, backups=2)
+        data = self.write(spool, 200)
+        self.assertEqual(spool.tail(10), data[-10:])
+        self.assertEqual(spool.tail(150), data[-150:])
+        kept = b''.join(spool.chunks(64))
+        self.assertEqual(spool.tail(100000), kept)
+        spool.close()
+
+    def test_chunks(self):
+        spool = SpoolFile(self.path, limit=100, backups=1)
+        self.write(spool, 100)
+        for chunk in spool.chunks(30):
+            self.assertTrue(0 < len(chunk) <= 30)
+        spool.close()
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_streams(self):
+        path = os.path.join(self.dir, 'job', 'task')
+        spool = Spool(path, limit=100)
+        spool.write('stdout', b'out')
+        spool.write('stderr', b'err')
+        self.assertEqual(spool.files['stdout'].tail(10), b'out')
+        self.assertEqual(spool.files['stderr'].tail(10), b'err')
+        spool.remove()
+        self.assertFalse(os.path.exists(path))
+
+    def test_compress(self):
+        data = b'output\n' * 1000
+        packed = compress(data)
+        self.assertTrue(len(packed) < len(data))
+        self.assertEqual(decompress(packed), data)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(SpoolFileTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(SpoolTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
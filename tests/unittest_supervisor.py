@@ -0,0 +1,174 @@
+import logging
+import os
+import subprocess
+import threading
+import unittest
+
+from kestrel import supervisor
+
+
+class Output(object):
+
+    """Collect a command's output, as a Spool would."""
+
+    def __init__(self):
+        self.data = {'stdout': b'', 'stderr': b''}
+        self.lock = threading.Lock()
+
+    def write(self, stream, data):
+        with self.lock:
+            self.data[stream] += data
+
+
+class Waiter(object):
+
+    """A completion callback that can be waited on."""
+
+    def __init__(self, count=1):
+        self.count = count
+        self.procs = []
+        self.done = threading.Event()
+
+    def __call__(self, proc):
+        self.procs.append(proc)
+        if len(self.procs) == self.count:
+            self.done.set()
+
+    def wait(self, timeout=10):
+        return self.done.wait(timeout)
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = supervisor.shared()
+
+    def test_shared(self):
+        self.assertTrue(supervisor.shared() is self.supervisor)
+
+    def test_exit_codes(self):
+        waiter = Waiter(9)
+        for i in range(9):
+            self.supervisor.spawn('exit %d' % (i % 3), Output(), waiter)
+        self.assertTrue(waiter.wait())
+        self.assertEqual(sorted(proc.returncode for proc in waiter.procs),
+                         [0, 0, 0, 1, 1, 1, 2, 2, 2])
+        for proc in waiter.procs:
+            self.assertTrue(proc.exited)
+            self.assertTrue(proc.rusage is not None)
+
+    def test_signalled(self):
+        waiter = Waiter()
+        self.supervisor.spawn('kill -9 $$', Output(), waiter)
+        self.assertTrue(waiter.wait())
+        self.assertEqual(waiter.procs[0].returncode, -9)
+
+    def test_output(self):
+        output = Output()
+        waiter = Waiter()
+        self.supervisor.spawn('echo out; echo err >&2; seq 1 20000',
+                              output, waiter)
+        self.assertTrue(waiter.wait())
+        lines = output.data['stdout'].decode('ascii').split('\n')
+        self.assertEqual(lines[0], 'out')
+        self.assertEqual(lines[-2], '20000')
+        self.assertEqual(output.data['stderr'], b'err\n')
+
+    def test_without_output(self):
+        waiter = Waiter()
+        self.supervisor.spawn(['true'], None, waiter)
+        self.assertTrue(waiter.wait())
+        self.assertEqual(waiter.procs[0].returncode, 0)
+
+    def test_stdin_and_env(self):
+        output = Output()
+        waiter = Waiter()
+        env = dict(os.environ, KESTREL_TEST='env')
+        proc = self.supervisor.spawn('cat; echo $KESTREL_TEST', output,
+                                     waiter, stdin=True, env=env)
+        proc.popen.stdin.write(b'in\n')
+        proc.popen.stdin.close()
+        self.assertTrue(waiter.wait())
+        self.assertEqual(output.data['stdout'], b'in\nenv\n')
+
+    def test_foreign_children(self):
+        waiter = Waiter(10)
+        for i in range(10):
+            self.supervisor.spawn('sleep 0.1', Output(), waiter)
+        # A child started elsewhere in the process must keep its own
+        # exit status for whoever started it.
+        child = subprocess.Popen(['sh', '-c', 'sleep 0.2; exit 7'])
+        self.assertEqual(child.wait(), 7)
+        self.assertTrue(waiter.wait())
+        self.assertEqual(self.supervisor.running(), 0)
+
+    def test_only_exited_reaped(self):
+        waited = []
+        reap_pid = self.supervisor._reap_pid
+
+        def record(pid):
+            waited.append(pid)
+            reap_pid(pid)
+
+        scan_interval = supervisor.SCAN_INTERVAL
+        supervisor.SCAN_INTERVAL = 3600
+        self.supervisor._reap_pid = record
+        try:
+            slow = Waiter()
+            running = self.supervisor.spawn('sleep 1', Output(), slow)
+            waiter = Waiter(20)
+            for i in range(20):
+                self.supervisor.spawn('true', Output(), waiter)
+            self.assertTrue(waiter.wait())
+            # The running command is not waited for on every exit.
+            self.assertFalse(running.pid in waited)
+            self.assertTrue(slow.wait())
+            self.assertEqual(waited.count(running.pid), 1)
+        finally:
+            supervisor.SCAN_INTERVAL = scan_interval
+            del self.supervisor._reap_pid
+
+    def test_callback_errors(self):
+        waiter = Waiter()
+
+        def fail(proc):
+            raise ValueError('failed')
+
+        logging.disable(logging.ERROR)
+        try:
+            self.supervisor.spawn('true', Output(), fail)
+            self.supervisor.spawn('true', Output(), waiter)
+            self.assertTrue(waiter.wait())
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+class ThreadTestCase(unittest.TestCase):
+
+    """A Supervisor started off the main thread polls for exits."""
+
+    def test_without_sigchld(self):
+        started = []
+        thread = threading.Thread(
+                target=lambda: started.append(supervisor.Supervisor()))
+        thread.start()
+        thread.join()
+        polling = started[0]
+        self.assertFalse(polling.signalled)
+        waiter = Waiter(3)
+        for i in range(3):
+            polling.spawn('exit %d' % i, Output(), waiter)
+        self.assertTrue(waiter.wait())
+        self.assertEqual(sorted(proc.returncode for proc in waiter.procs),
+                         [0, 1, 2])
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(SupervisorTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(ThreadTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,108 @@
+import signal
+import threading
+import time
+import unittest
+
+from kestrel import supervisor
+
+from backends import backends
+
+
+class WalltimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = supervisor.shared()
+
+    def run_command(self, command, **options):
+        done = threading.Event()
+        procs = []
+
+        def finished(proc):
+            procs.append(proc)
+            done.set()
+
+        proc = self.supervisor.spawn(command, None, finished, **options)
+        return proc, procs, done
+
+    def test_stopped(self):
+        started = time.time()
+        proc, procs, done = self.run_command('sleep 30', walltime=0.2,
+                                             grace=5)
+        self.assertTrue(done.wait(10))
+        self.assertTrue(proc.timed_out)
+        self.assertEqual(proc.returncode, -signal.SIGTERM)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_killed_after_grace(self):
+        proc, procs, done = self.run_command(
+                ['sh', '-c', 'trap "" TERM; while true; do sleep 0.05; done'],
+                walltime=0.2, grace=0.3)
+        self.assertTrue(done.wait(10))
+        self.assertTrue(proc.timed_out)
+        self.assertEqual(proc.returncode, -signal.SIGKILL)
+
+    def test_within_walltime(self):
+        proc, procs, done = self.run_command('sleep 0.1; exit 3',
+                                             walltime=5)
+        self.assertTrue(done.wait(10))
+        self.assertFalse(proc.timed_out)
+        self.assertEqual(proc.returncode, 3)
+
+    def test_limit_and_unlimit(self):
+        proc, procs, done = self.run_command('sleep 30')
+        self.supervisor.limit(proc, 0.1, grace=5)
+        self.assertTrue(done.wait(10))
+        self.assertTrue(proc.timed_out)
+
+        proc, procs, done = self.run_command('sleep 0.4', walltime=0.2)
+        self.supervisor.unlimit(proc)
+        self.assertTrue(done.wait(10))
+        self.assertFalse(proc.timed_out)
+        self.assertEqual(proc.returncode, 0)
+
+
+class TimeoutTestCase(unittest.TestCase):
+
+    def test_requeued_then_failed(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 2, ['foo'], walltime=10,
+                         retries=1)
+            self.assertEqual(k.get_job('1')['walltime'], '10.0', name)
+            (job, (task,)), = k.worker_available('w')
+            k.task_start('w', job, task)
+            self.assertEqual(k.task_timeout('w', job, task), 'requeued',
+                             name)
+            self.assertEqual(k.task_timeout('w', job, task), None, name)
+            self.assertEqual(k.job_status('1')['1']['queued'], 2, name)
+
+            (job, (task,)), = k.worker_available('w')
+            self.assertEqual(task, '0', name)
+            self.assertEqual(k.task_timeout('w', job, task), 'failed', name)
+            (job, (task,)), = k.worker_available('w')
+            self.assertEqual(k.task_timeout('w', job, task), 'requeued',
+                             name)
+            (job, (task,)), = k.worker_available('w')
+            self.assertEqual(k.task_timeout('w', job, task), 'completed',
+                             name)
+            self.assertEqual(k.job_status('1')['1']['completed'], 2, name)
+
+    def test_without_retries(self):
+        for name, k in backends():
+            k.register_worker('w', ['foo'])
+            k.submit_job('1', 'alice', 'c', '', 1, ['foo'], walltime=10)
+            (job, (task,)), = k.worker_available('w')
+            self.assertEqual(k.task_timeout('x', job, task), None, name)
+            self.assertEqual(k.task_timeout('w', job, task), 'completed',
+                             name)
+
+
+def suite():
+        loader = unittest.TestLoader()
+        suite = unittest.TestSuite()
+        suite.addTest(loader.loadTestsFromTestCase(WalltimeTestCase))
+        suite.addTest(loader.loadTestsFromTestCase(TimeoutTestCase))
+        return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())